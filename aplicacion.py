@@ -1,27 +1,16 @@
-from database_manager import DatabaseManager
-from sql_agent import SQLAgent
+from arranque import calentar, tiempos
+from database_manager import obtener_db_compartida
+from sql_agent import extraer_sql, obtener_agente_sql
 from bi_agent import BIAgent
+from result_table import TablaResultados
 import os
 from dotenv import load_dotenv
 
-def mostrar_resultados(columns, results):
-    """Muestra los resultados de la consulta en formato tabular"""
-    print("\nResultados:")
-    print("-" * 80)
-    headers = " | ".join(f"{col:<15}" for col in columns)
-    print(headers)
-    print("-" * 80)
-    
-    for row in results:
-        formatted_row = [str(val)[:15] for val in row]
-        row_str = " | ".join(f"{val:<15}" for val in formatted_row)
-        print(row_str)
-    
-    print("=" * 80)
-
 def main():
     # Cargar las variables del archivo .env
     load_dotenv()
+    # Modelos, pool y librerías pesadas se cargan en segundo plano mientras se prepara el asistente
+    calentar()
     # Configuración de la base de datos
     db_config = {
         "host": os.getenv("DB_HOST"),
@@ -32,22 +21,25 @@ def main():
     }
 
     try:
-        # Inicializar el gestor de base de datos
-        db = DatabaseManager(**db_config)
-        db.connect()
+        # Inicializar el gestor de base de datos con el pool compartido
+        db = obtener_db_compartida(db_config)
         #db.crear_esquema_tienda()
         
         # Obtener el esquema y crear el agente
-        schema = db.obtener_esquema_bd()
-        agent = SQLAgent()
-        agent.inicializar(schema)
+        agent = obtener_agente_sql(db.obtener_esquema_bd(), db.huella_esquema)
         
         # Inicializar el agente BI
         bi_agent = BIAgent()
         
+        tiempos.marcar("asistente listo")
         print("\n¡Asistente listo! Escribe 'salir' para terminar.")
+        print("Escribe 'fijar' para validar el SQL de la última consulta.")
+        print("Escribe 'pagina N' para ver otra página de los últimos resultados.")
         print("=" * 50)
 
+        ultima_pregunta = None
+        ultima_tabla = None
+
         # Bucle principal
         while True:
             pregunta = input("\nTu consulta: ")
@@ -55,25 +47,70 @@ def main():
             if pregunta.lower() in ['salir', 'exit', 'quit']:
                 print("\n¡Hasta luego!")
                 break
+
+            if pregunta.lower() == 'fijar':
+                if ultima_pregunta and agent.fijar_consulta(ultima_pregunta):
+                    print("SQL de la última consulta fijado en la caché")
+                else:
+                    print("No hay consulta que fijar")
+                continue
+
+            partes = pregunta.split()
+            if len(partes) == 2 and partes[0].lower() == 'pagina' and partes[1].isdigit():
+                if ultima_tabla is not None:
+                    print(ultima_tabla.texto(int(partes[1])))
+                else:
+                    print("No hay resultados que paginar")
+                continue
             
             try:
+                # El agente solo se reconstruye si el esquema cambió desde la última pregunta
+                agent = obtener_agente_sql(db.obtener_esquema_bd(), db.huella_esquema)
                 # Generar y ejecutar la consulta
                 print("\nGenerando consulta SQL...")
-                query = agent.generar_consulta(pregunta)
-                print(f"\nConsulta SQL generada:\n{query}\n")
+                texto_sql = ""
+                for token in agent.generar_consulta_stream(pregunta):
+                    texto_sql += token
+                    print(token, end="", flush=True)
+                query = extraer_sql(texto_sql)
+                print(f"\n\nConsulta SQL generada:\n{query}\n")
                 
                 print("Ejecutando consulta...")
-                columns, results = db.ejecutar_consulta(query)
+                stream = db.consultar_stream(query)
+                if stream.rechazo is not None and stream.rechazo.regenerar:
+                    # La guardia de coste rechazó la consulta: pedir otra al LLM una vez
+                    print(f"Consulta rechazada ({stream.rechazo.motivo}). Generando otra...")
+                    query = agent.corregir_consulta(pregunta, query, stream.rechazo.motivo)
+                    print(f"\nConsulta SQL corregida:\n{query}\n")
+                    stream = db.consultar_stream(query)
+                results = stream.leer_tabla()
+                columns = results.columns
+                if columns == ["Error"]:
+                    agent.descartar_consulta(pregunta)
+                else:
+                    ultima_pregunta = pregunta
+                if not results:
+                    results = TablaResultados(columns, [["No se encontraron resultados"]])
                 
-                mostrar_resultados(columns, results)
+                # Solo se imprime la primera página; el resto con 'pagina N'
+                print(results.texto())
+                ultima_tabla = results
                 
                 # Generar script de gráfico
-                print("\nGenerando script de gráfico...")
-                script = bi_agent.generar_script_grafico(columns, results)
-                if script:
-                    print("\nScript de gráfico generado:\n")
-                    print(script)
-                    bi_agent.ejecutar_script(script.replace("```", ""))
+                print("\nGenerando gráfico...")
+                for evento in bi_agent.generar_grafico_stream(columns, results):
+                    if "token" in evento:
+                        print(evento["token"], end="", flush=True)
+                    else:
+                        grafico = evento["grafico"]
+                print()
+                print(BIAgent.describir_metodo(grafico))
+                if grafico["png"] is not None:
+                    with open("grafico.png", "wb") as f:
+                        f.write(grafico["png"])
+                elif grafico["script"]:
+                    with open("grafico.png", "wb") as f:
+                        f.write(bi_agent.ejecutar_script(grafico["script"]))
             except Exception as e:
                 print(f"Error al procesar la consulta: {e}")
                 
@@ -81,6 +118,12 @@ def main():
         print(f"Error en la aplicación: {e}")
     finally:
         if 'db' in locals():
+            print(f"Estadísticas del pool: {db.estadisticas_pool()}")
+            if db.estadisticas_replicas() is not None:
+                print(f"Estadísticas de réplicas: {db.estadisticas_replicas()}")
+            print(f"Estadísticas de la caché de resultados: {db.estadisticas_cache_resultados()}")
+            if 'agent' in locals() and agent.cache is not None:
+                print(f"Estadísticas de la caché SQL: {agent.cache.estadisticas()}")
             db.close()
 
 if __name__ == "__main__":
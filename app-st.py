@@ -1,77 +1,95 @@
 import streamlit as st
-from database_manager import DatabaseManager
-from sql_agent import SQLAgent
-from bi_agent import BIAgent
-import os
-from dotenv import load_dotenv
-import matplotlib.pyplot as plt
+from arranque import calentar
+from database_manager import obtener_db_compartida
+from sql_agent import extraer_sql, obtener_agente_sql
+from bi_agent import BIAgent, extraer_codigo
 from PIL import Image
+from result_table import TablaResultados
 import io
-import plotly.io as pio
+from script_sandbox import ErrorScript, obtener_pool_scripts
+from tracing import iniciar_servidor_metricas, tracer
 
-if "resultados_texto" not in st.session_state:
-    st.session_state.resultados_texto = None
+# Streamlit re-ejecuta el script en cada interacción; el servidor y el calentamiento solo arrancan una vez
+iniciar_servidor_metricas()
+calentar()
+
+if "tabla" not in st.session_state:
+    st.session_state.tabla = None
 if "script" not in st.session_state:
     st.session_state.script = None
+if "datos" not in st.session_state:
+    st.session_state.datos = None
+if "grafico" not in st.session_state:
+    st.session_state.grafico = None
 
 
-def procesar_consulta(pregunta):
-    """Procesa la consulta en lenguaje natural y devuelve los resultados y el script del gráfico."""
-    load_dotenv()
-    db_config = {
-        "host": os.getenv("DB_HOST"),
-        "port": os.getenv("DB_PORT"),
-        "user": os.getenv("DB_USER"),
-        "password": os.getenv("DB_PASSWORD"), 
-        "database": os.getenv("DB_NAME") 
-    }
-    
+def procesar_consulta(pregunta, placeholder=None):
+    """Procesa la consulta en lenguaje natural y devuelve la tabla de resultados y el gráfico."""
     try:
-        db = DatabaseManager(**db_config)
-        db.connect()
-        schema = db.obtener_esquema_bd()
-        agent = SQLAgent()
-        agent.inicializar(schema)
+        with tracer.span("pipeline"):
+            # Pool compartido por todo el proceso: no se abre ni cierra conexión por pregunta
+            db = obtener_db_compartida()
+            schema = db.obtener_esquema_bd()
+            # Agente compartido entre peticiones: solo se reconstruye si cambia el esquema
+            agent = obtener_agente_sql(schema, db.huella_esquema)
         
-        query = agent.generar_consulta(pregunta)
-        columns, results = db.ejecutar_consulta(query)
-        resultados_texto = mostrar_resultados(columns, results)
+            texto_sql = ""
+            for token in agent.generar_consulta_stream(pregunta):
+                texto_sql += token
+                if placeholder is not None:
+                    # El SQL aparece a medida que el modelo lo escribe
+                    placeholder.code(texto_sql, language="sql")
+            query = extraer_sql(texto_sql)
+            stream = db.consultar_stream(query)
+            if stream.rechazo is not None and stream.rechazo.regenerar:
+                # La guardia de coste rechazó la consulta: pedir otra al LLM una vez
+                query = agent.corregir_consulta(pregunta, query, stream.rechazo.motivo)
+                if placeholder is not None:
+                    placeholder.code(query, language="sql")
+                stream = db.consultar_stream(query)
+            columns = stream.columns
+            results = TablaResultados(columns)
+            for lote in stream:
+                if not results:
+                    # Mostrar la primera página en cuanto llega, sin esperar al resto
+                    primera_pagina = TablaResultados(columns, lote).texto()
+                results.agregar(lote)
+                if placeholder is not None:
+                    placeholder.text(f"{primera_pagina}\nCargando filas... {len(results)} recibidas")
+            if placeholder is not None:
+                placeholder.empty()
+            if columns == ["Error"]:
+                # No reutilizar SQL que no se pudo ejecutar
+                agent.descartar_consulta(pregunta)
+            if not results:
+                results = TablaResultados(columns, [["No se encontraron resultados"]])
+            results.truncado = stream.truncado
         
-        bi_agent = BIAgent()
-        script = bi_agent.generar_script_grafico(columns, results)
+            bi_agent = BIAgent()
+            script = ""
+            for evento in bi_agent.generar_grafico_stream(columns, results):
+                if "token" in evento:
+                    script += evento["token"]
+                    if placeholder is not None:
+                        placeholder.code(script, language="python")
+                else:
+                    grafico = evento["grafico"]
+            if placeholder is not None:
+                placeholder.empty()
         
-        return resultados_texto, script
+            return results, grafico, bi_agent.datos
     except Exception as e:
-        return f"Error al procesar la consulta: {e}", None
-    finally:
-        if 'db' in locals():
-            db.close()
-
-def mostrar_resultados(columns, results):
-    """Devuelve los resultados de la consulta en formato de texto."""
-    resultado = "\nResultados:\n" + "-" * 80 + "\n"
-    headers = " | ".join(f"{col:<15}" for col in columns)
-    resultado += headers + "\n" + "-" * 80 + "\n"
-    
-    for row in results:
-        formatted_row = [str(val)[:15] for val in row]
-        row_str = " | ".join(f"{val:<15}" for val in formatted_row)
-        resultado += row_str + "\n"
-    
-    resultado += "=" * 80
-    return resultado
+        return TablaResultados(["Error"], [[f"Error al procesar la consulta: {e}"]]), None, None
 
-def ejecutar_script(script):
-    """Ejecuta el script del gráfico."""
-    # Aquí asumimos que el script es compatible con matplotlib
+def ejecutar_script(script, datos=None):
+    """Ejecuta el script del gráfico en el pool de procesos aislados y devuelve el PNG, o None si falla."""
     try:
-        #namespace = {}
-        exec(script)
+        png = obtener_pool_scripts().ejecutar(extraer_codigo(script), datos)
         print("Script ejecutado con éxito.")
-    except Exception as e:
+        return png
+    except ErrorScript as e:
         print(f"Error al ejecutar el script: {e}")
-    
-    #return namespace['plt']
+        return None
 
 # Configuración de la aplicación Streamlit
 st.title("Consulta SQL con Streamlit")
@@ -80,18 +98,34 @@ st.write("Introduce una consulta en lenguaje natural para obtener resultados SQL
 pregunta = st.text_input("Tu consulta:")
 
 if st.button("Procesar Consulta"):
-    resultados_texto, script = procesar_consulta(pregunta)
-    st.session_state.resultados_texto = resultados_texto
-    st.session_state.script = script
+    tabla, grafico, datos = procesar_consulta(pregunta, st.empty())
+    st.session_state.tabla = tabla
+    st.session_state.grafico = grafico
+    st.session_state.script = grafico["script"] if grafico else None
+    st.session_state.datos = datos
 
 # Mostrar resultados si existen
-if st.session_state.resultados_texto:
-    st.text_area("Resultados de la Consulta", st.session_state.resultados_texto, height=200)
+if st.session_state.tabla is not None:
+    tabla = st.session_state.tabla
+    # Solo se formatea la página elegida; la tabla completa queda en la sesión
+    pagina = 1
+    if tabla.paginas() > 1:
+        pagina = st.number_input("Página", min_value=1, max_value=tabla.paginas(), value=1, step=1)
+    st.text_area("Resultados de la Consulta", tabla.texto(int(pagina)), height=200)
+
+if st.session_state.grafico:
+    st.caption(BIAgent.describir_metodo(st.session_state.grafico))
+    if st.session_state.grafico["png"] is not None:
+        st.image(st.session_state.grafico["png"])
 
 if st.session_state.script:
     st.text_area("Script del Gráfico", st.session_state.script, height=200)
     if st.button("Generar Gráfico"):
-        ejecutar_script(st.session_state.script)
+        png = ejecutar_script(st.session_state.script, st.session_state.datos)
+        if png is not None:
+            st.image(png)
+        else:
+            st.error("No se pudo ejecutar el script del gráfico")
         #img_bytes = pio.to_image(fig, format="png")
         #img = Image.open(io.BytesIO(img_bytes))
         #img.save("grafico_convertido.png")
@@ -99,6 +133,8 @@ if st.session_state.script:
 
         if st.button("Realizar otra consulta"):
             # Limpiar estado
-            st.session_state.resultados_texto = None
+            st.session_state.tabla = None
             st.session_state.script = None
+            st.session_state.datos = None
+            st.session_state.grafico = None
             st.experimental_rerun()
\ No newline at end of file
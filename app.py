@@ -1,78 +1,107 @@
+from arranque import calentar, tiempos
+
+# Los modelos, el pool y las librerías pesadas se cargan en segundo plano
+# mientras se importa Gradio y se construye la interfaz
+calentar()
+
 import gradio as gr
-from database_manager import DatabaseManager
-from sql_agent import SQLAgent
-from bi_agent import BIAgent
+import io
 import os
-from dotenv import load_dotenv
+from PIL import Image
+from bi_agent import BIAgent
+from pipeline import PipelineAsync
+from result_table import TablaResultados
+from tracing import iniciar_servidor_metricas
 
-def procesar_consulta(pregunta):
-    """Procesa la consulta en lenguaje natural y devuelve los resultados y el script del gráfico."""
-    load_dotenv()
-    db_config = {
-        "host": os.getenv("DB_HOST"),
-        "port": os.getenv("DB_PORT"),
-        "user": os.getenv("DB_USER"),
-        "password": os.getenv("DB_PASSWORD"), 
-        "database": os.getenv("DB_NAME") 
-    }
-    
-    try:
-        db = DatabaseManager(**db_config)
-        db.connect()
-        schema = db.obtener_esquema_bd()
-        agent = SQLAgent()
-        agent.inicializar(schema)
-        
-        query = agent.generar_consulta(pregunta)
-        columns, results = db.ejecutar_consulta(query)
-        resultados_texto = mostrar_resultados(columns, results)
-        
-        bi_agent = BIAgent()
-        script = bi_agent.generar_script_grafico(columns, results)
-        ejecutar_script(script)
-        
-        return resultados_texto, script
-    except Exception as e:
-        return f"Error al procesar la consulta: {e}", None
-    finally:
-        if 'db' in locals():
-            db.close()
+_pipeline = None
 
-def mostrar_resultados(columns, results):
-    """Devuelve los resultados de la consulta en formato de texto."""
-    resultado = "\nResultados:\n" + "-" * 80 + "\n"
-    headers = " | ".join(f"{col:<15}" for col in columns)
-    resultado += headers + "\n" + "-" * 80 + "\n"
-    
-    for row in results:
-        formatted_row = [str(val)[:15] for val in row]
-        row_str = " | ".join(f"{val:<15}" for val in formatted_row)
-        resultado += row_str + "\n"
-    
-    resultado += "=" * 80
-    return resultado
+def obtener_pipeline():
+    """Crea el pipeline asíncrono la primera vez, ya dentro del bucle de eventos de Gradio."""
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = PipelineAsync()
+    return _pipeline
 
-def ejecutar_script(script):
-    """Ejecuta el script del gráfico."""
-    # Aquí asumimos que el script es compatible con matplotlib
+async def procesar_consulta(pregunta):
+    """Procesa la consulta en lenguaje natural y va devolviendo los resultados y el script del gráfico.
+
+    Además del texto devuelve la tabla completa y la página mostrada, que la
+    interfaz guarda para pasar de página sin repetir la consulta.
+    """
+    resultados_texto = None
+    tabla = None
     try:
-        namespace = {}
-        exec(script, namespace)
-        print("Script ejecutado con éxito.")
+        script = ""
+        async for evento in obtener_pipeline().procesar(pregunta):
+            if evento["etapa"] == "sql_token":
+                # El SQL aparece a medida que el modelo lo escribe
+                yield f"Generando SQL...\n\n{evento['texto']}", None, None, None, 1
+            elif evento["etapa"] == "regenerando":
+                yield f"Consulta rechazada ({evento['motivo']}).\nGenerando otra consulta...", None, None, None, 1
+            elif evento["etapa"] == "parcial":
+                # Mostrar la primera página en cuanto llega, sin esperar al resto
+                parcial = TablaResultados(evento["columns"], evento["results"])
+                yield parcial.texto() + "\nCargando más filas...", None, None, None, 1
+            elif evento["etapa"] == "resultados":
+                tabla = evento["results"]
+                resultados_texto = tabla.texto()
+                # La tabla se devuelve ya; el gráfico sigue generándose en segundo plano
+                yield resultados_texto, "# Generando gráfico...", None, tabla, 1
+            elif evento["etapa"] == "grafico_token":
+                script += evento["token"]
+                yield resultados_texto, f"# Generando script del gráfico...\n\n{script}", None, tabla, 1
+            elif evento["etapa"] == "grafico":
+                grafico = evento["grafico"]
+                metodo = BIAgent.describir_metodo(grafico)
+                imagen = None
+                if grafico["png"] is not None:
+                    imagen = Image.open(io.BytesIO(grafico["png"]))
+                yield resultados_texto, f"# {metodo}\n\n{grafico['script'] or ''}", imagen, tabla, 1
     except Exception as e:
-        print(f"Error al ejecutar el script: {e}")
-    
-    return namespace['fig']
+        yield f"Error al procesar la consulta: {e}", None, None, None, 1
+
+def cambiar_pagina(tabla, pagina, paso):
+    """Formatea solo la página pedida de la tabla guardada en la sesión."""
+    if tabla is None:
+        return gr.update(), 1
+    pagina = min(max(1, int(pagina or 1) + paso), tabla.paginas())
+    return tabla.texto(pagina), pagina
 
 
 # Configuración de la interfaz de Gradio
-iface = gr.Interface(
-    fn=procesar_consulta,
-    inputs="text",
-    outputs=["text", "text"],
-    live=False,
-    title="Consulta SQL con Gradio",
-    description="Introduce una consulta en lenguaje natural para obtener resultados SQL y generar gráficos."
-)
+with gr.Blocks(title="Consulta SQL con Gradio") as iface:
+    gr.Markdown("# Consulta SQL con Gradio\n"
+                "Introduce una consulta en lenguaje natural para obtener resultados SQL y generar gráficos.")
+    pregunta = gr.Textbox(label="Consulta")
+    with gr.Row():
+        enviar = gr.Button("Enviar", variant="primary")
+        parar = gr.Button("Parar")
+    resultados = gr.Textbox(label="Resultados", lines=20)
+    with gr.Row():
+        anterior = gr.Button("Página anterior")
+        pagina = gr.Number(value=1, precision=0, label="Página")
+        siguiente = gr.Button("Página siguiente")
+    script = gr.Textbox(label="Script del gráfico")
+    imagen = gr.Image(label="Gráfico")
+    # La tabla completa se queda en el servidor; al navegador solo va la página visible
+    tabla = gr.State(None)
 
+    salidas = [resultados, script, imagen, tabla, pagina]
+    consulta = enviar.click(procesar_consulta, inputs=pregunta, outputs=salidas)
+    envio = pregunta.submit(procesar_consulta, inputs=pregunta, outputs=salidas)
+    anterior.click(lambda t, p: cambiar_pagina(t, p, -1), inputs=[tabla, pagina], outputs=[resultados, pagina])
+    siguiente.click(lambda t, p: cambiar_pagina(t, p, 1), inputs=[tabla, pagina], outputs=[resultados, pagina])
+    pagina.submit(lambda t, p: cambiar_pagina(t, p, 0), inputs=[tabla, pagina], outputs=[resultados, pagina])
+    # Al parar se cancela la tarea y el pipeline cancela la consulta en PostgreSQL
+    parar.click(None, cancels=[consulta, envio])
+
+# La cola es necesaria para enviar resultados parciales desde un generador. Como el
+# pipeline es asíncrono, cada petición solo ocupa el bucle de eventos mientras espera;
+# los límites reales de LLM y base de datos los ponen los semáforos del pipeline
+iface.queue(
+    default_concurrency_limit=int(os.getenv("GRADIO_CONCURRENCY", "32")),
+    max_size=int(os.getenv("GRADIO_QUEUE_SIZE", "256"))
+)
+iniciar_servidor_metricas()
+tiempos.marcar("interfaz lista")
 iface.launch()
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""Arranque rápido de las aplicaciones
+
+Las librerías pesadas (langchain, pandas, numpy, matplotlib, plotly, psycopg2) se
+importan en el primer uso, no al importar los módulos de la aplicación.
+calentar() hace en segundo plano, mientras se construye la interfaz, todo
+lo que si no pagaría la primera pregunta: importa esas librerías, carga en
+Ollama los modelos de SQL y de gráficos con keep-alive, abre el pool de
+conexiones con el esquema ya leído, procesa en Ollama el prefijo del prompt
+SQL con ese esquema y arranca los trabajadores de scripts.
+Los tiempos de cada fase se imprimen al terminar y quedan como spans
+"arranque" en las trazas.
+
+Comprobación del presupuesto de importación (sale con código 1 si se supera):
+    python arranque.py --presupuesto 1.0
+"""
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+from tracing import tracer
+
+# Referencia para medir el arranque: la primera importación de este módulo
+INICIO = time.perf_counter()
+
+MODULOS_PESADOS = ("langchain_community.llms", "langchain_core.prompts", "numpy", "pandas",
+                   "matplotlib.figure", "plotly.graph_objects", "psycopg2")
+# Lo que importan las aplicaciones antes de mostrar la interfaz
+MODULOS_APLICACION = ("database_manager", "sql_agent", "bi_agent", "pipeline")
+
+
+def parametros_ollama():
+    """URL del servidor de Ollama, cuánto mantiene cargado cada modelo y su ventana de contexto
+
+    Todas las peticiones usan el mismo num_ctx: si cambia, Ollama recarga el
+    modelo y se pierde el prefijo ya procesado.
+    """
+    load_dotenv()
+    return {
+        "base_url": os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"),
+        "keep_alive": os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+        "num_ctx": int(os.getenv("OLLAMA_NUM_CTX", "8192")),
+    }
+
+
+def _generar(cuerpo, timeout):
+    """Petición sin streaming a /api/generate con los parámetros comunes; devuelve la respuesta"""
+    parametros = parametros_ollama()
+    cuerpo = dict(cuerpo, keep_alive=parametros["keep_alive"], stream=False,
+                  options=dict(cuerpo.get("options", {}), num_ctx=parametros["num_ctx"]))
+    peticion = urllib.request.Request(
+        parametros["base_url"].rstrip("/") + "/api/generate",
+        data=json.dumps(cuerpo).encode("utf-8"),
+        headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(peticion, timeout=timeout) as respuesta:
+        return json.loads(respuesta.read())
+
+
+def precargar_modelo(modelo, timeout=300):
+    """Carga el modelo en memoria con una petición sin prompt a /api/generate"""
+    _generar({"model": modelo}, timeout)
+
+
+def evaluar_prompt(modelo, prompt, timeout=300):
+    """Procesa el prompt generando un solo token; devuelve (tokens procesados, segundos de prefill)
+
+    Ollama reutiliza la caché KV del prefijo que coincide con la petición
+    anterior, así que los tokens procesados son solo los que no estaban ya.
+    También sirve para dejar un prefijo procesado antes de la primera pregunta.
+    """
+    respuesta = _generar({"model": modelo, "prompt": prompt, "options": {"num_predict": 1}}, timeout)
+    return respuesta.get("prompt_eval_count", 0), respuesta.get("prompt_eval_duration", 0) / 1e9
+
+
+class TiemposArranque:
+    """Duración de cada fase del arranque, medida desde INICIO"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fases = {}  # fase -> (segundos, error)
+        self.hitos = {}  # hito -> segundos desde INICIO
+        self.terminado = threading.Event()
+
+    def marcar(self, hito):
+        """Registra e imprime un momento del arranque, por ejemplo cuándo la interfaz está lista"""
+        segundos = time.perf_counter() - INICIO
+        with self._lock:
+            self.hitos[hito] = segundos
+        print(f"Arranque: {hito} a los {segundos:.2f} s")
+
+    def medir(self, fase, funcion, *args):
+        with tracer.span("arranque", fase=fase) as span:
+            inicio = time.perf_counter()
+            error = None
+            try:
+                funcion(*args)
+            except Exception as e:
+                error = str(e)
+                span.registrar(error_fase=error)
+            with self._lock:
+                self.fases[fase] = (time.perf_counter() - inicio, error)
+
+    def informe(self):
+        with self._lock:
+            partes = [f"{hito} a los {segundos:.2f} s" for hito, segundos in self.hitos.items()]
+            for fase, (segundos, error) in self.fases.items():
+                partes.append(f"{fase} {segundos:.2f} s" + (f" (error: {error})" if error else ""))
+        return "Arranque: " + "; ".join(partes)
+
+
+tiempos = TiemposArranque()
+
+_calentamiento = None
+_calentamiento_lock = threading.Lock()
+
+
+def _importar_pesados():
+    for modulo in MODULOS_PESADOS:
+        importlib.import_module(modulo)
+
+
+def _abrir_base_de_datos():
+    from database_manager import obtener_db_compartida
+
+    db = obtener_db_compartida()
+    # Deja el esquema en la caché y al menos una conexión probada en el pool
+    db.obtener_esquema_bd()
+
+
+def _preparar_agente_sql():
+    from database_manager import obtener_db_compartida
+    from sql_agent import obtener_agente_sql
+
+    db = obtener_db_compartida()
+    schema = db.obtener_esquema_bd()
+    obtener_agente_sql(schema, db.huella_esquema).calentar_prefijo()
+
+
+def _arrancar_pool_scripts():
+    from script_sandbox import obtener_pool_scripts
+
+    obtener_pool_scripts()
+
+
+def calentar(base_de_datos=True, modelos=True, scripts=True):
+    """Lanza el calentamiento en segundo plano (una sola vez por proceso) y devuelve su hilo"""
+    global _calentamiento
+    with _calentamiento_lock:
+        if _calentamiento is not None:
+            return _calentamiento
+
+        fases = [("importaciones", _importar_pesados)]
+        if base_de_datos:
+            fases.append(("base de datos", _abrir_base_de_datos))
+        if scripts:
+            fases.append(("trabajadores de scripts", _arrancar_pool_scripts))
+        if modelos:
+            from bi_agent import BIAgent
+            from sql_agent import SQLAgent
+
+            for modelo in dict.fromkeys((SQLAgent.MODELO, BIAgent.MODELO)):
+                fases.append((f"modelo {modelo}", lambda m=modelo: precargar_modelo(m)))
+            if base_de_datos:
+                # Deja en la caché KV de Ollama el prefijo con el esquema
+                fases.append(("prefijo SQL", _preparar_agente_sql))
+
+        def ejecutar():
+            # Las fases esperan sobre todo a red y a disco: en paralelo tardan lo que la más lenta
+            hilos = [threading.Thread(target=tiempos.medir, args=(fase, funcion), daemon=True)
+                     for fase, funcion in fases]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+            tiempos.marcar("calentamiento terminado")
+            tiempos.terminado.set()
+            print(tiempos.informe())
+
+        _calentamiento = threading.Thread(target=ejecutar, name="calentamiento", daemon=True)
+        _calentamiento.start()
+        return _calentamiento
+
+
+def medir_importacion(modulos=MODULOS_APLICACION):
+    """Importa los módulos en un intérprete limpio; devuelve (segundos, módulos pesados cargados)"""
+    codigo = (
+        "import json, sys, time\n"
+        "inicio = time.perf_counter()\n"
+        f"for modulo in {list(modulos)!r}:\n"
+        "    __import__(modulo)\n"
+        "segundos = time.perf_counter() - inicio\n"
+        f"pesados = [m for m in {list(MODULOS_PESADOS)!r} if m in sys.modules]\n"
+        "print(json.dumps({'segundos': segundos, 'pesados': pesados}))\n"
+    )
+    salida = subprocess.run([sys.executable, "-c", codigo], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    resultado = json.loads(salida.stdout.strip().splitlines()[-1])
+    return resultado["segundos"], resultado["pesados"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comprueba el tiempo de importación de la aplicación")
+    parser.add_argument("--presupuesto", type=float, default=1.0, help="segundos máximos de importación")
+    args = parser.parse_args()
+
+    segundos, pesados = medir_importacion()
+    print(f"Importación de {', '.join(MODULOS_APLICACION)}: {segundos:.3f} s "
+          f"(presupuesto {args.presupuesto:.3f} s)")
+    if pesados:
+        print(f"Se importaron librerías pesadas al arrancar: {', '.join(pesados)}")
+    if segundos > args.presupuesto or pesados:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Modo por lotes: responde una lista de preguntas sin interfaz
+
+Lee las preguntas de un JSONL (campo "pregunta" y opcionalmente "id") o de
+un CSV (columna "pregunta", o la primera columna), descarta las repetidas
+(misma pregunta normalizada) y las procesa con el pipeline asíncrono, con
+límites de concurrencia separados para el LLM, la base de datos y los
+gráficos. Por cada pregunta única escribe en el directorio de salida:
+
+    <clave>/consulta.sql
+    <clave>/resultados.csv   (o .parquet con --formato parquet)
+    <clave>/grafico.png      (y grafico.py si el script lo generó el LLM)
+
+estado.jsonl registra cada pregunta terminada; al relanzar con la misma
+salida se saltan las que ya terminaron bien, de modo que una ejecución
+interrumpida se reanuda. Las que tienen resultados pero no gráfico quedan
+como "sin_grafico" y se repiten salvo con --sin-graficos. indice.csv relaciona cada fila de la entrada con
+su clave y resumen.json guarda las cifras del resumen final.
+
+Uso:
+    python batch.py preguntas.jsonl --salida informes/ [--max-llm 2] [--max-db 8]
+"""
+import argparse
+import asyncio
+import csv
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+import time
+
+from pipeline import PipelineAsync
+from sql_cache import normalizar_pregunta
+from tracing import percentiles
+
+
+def leer_preguntas(ruta):
+    """Devuelve [(id, pregunta)] en el orden del archivo, ignorando líneas vacías"""
+    preguntas = []
+    with open(ruta, encoding="utf-8", newline="") as f:
+        if ruta.lower().endswith(".csv"):
+            lector = csv.reader(f)
+            cabecera = next(lector, None)
+            if cabecera is None:
+                return preguntas
+            columna = cabecera.index("pregunta") if "pregunta" in cabecera else 0
+            columna_id = cabecera.index("id") if "id" in cabecera else None
+            for numero, fila in enumerate(lector, start=2):
+                if len(fila) > columna and fila[columna].strip():
+                    preguntas.append((fila[columna_id] if columna_id is not None else str(numero),
+                                      fila[columna].strip()))
+        else:
+            for numero, linea in enumerate(f, start=1):
+                if not linea.strip():
+                    continue
+                dato = json.loads(linea)
+                if isinstance(dato, str):
+                    dato = {"pregunta": dato}
+                preguntas.append((str(dato.get("id", numero)), dato["pregunta"].strip()))
+    return preguntas
+
+
+def clave_pregunta(pregunta):
+    return hashlib.sha1(normalizar_pregunta(pregunta).encode("utf-8")).hexdigest()[:16]
+
+
+def _escribir_atomico(ruta, escribir, modo="w"):
+    """Escribe en un temporal y lo renombra: un corte nunca deja un archivo a medias"""
+    temporal = ruta + ".tmp"
+    with open(temporal, modo, **({"encoding": "utf-8", "newline": ""} if "b" not in modo else {})) as f:
+        escribir(f)
+    os.replace(temporal, ruta)
+
+
+def motor_parquet_disponible():
+    """Indica si pandas tiene con qué escribir parquet (pyarrow o fastparquet)"""
+    return any(importlib.util.find_spec(motor) is not None for motor in ("pyarrow", "fastparquet"))
+
+
+def _escribir_resultados(directorio, columns, results, formato):
+    if formato == "parquet":
+        import pandas as pd
+
+        ruta = os.path.join(directorio, "resultados.parquet")
+        temporal = ruta + ".tmp"
+        pd.DataFrame([list(fila) for fila in results], columns=columns).to_parquet(temporal, index=False)
+        os.replace(temporal, ruta)
+        return ruta
+
+    def escribir(f):
+        escritor = csv.writer(f)
+        escritor.writerow(columns)
+        escritor.writerows(results)
+
+    ruta = os.path.join(directorio, "resultados.csv")
+    _escribir_atomico(ruta, escribir)
+    return ruta
+
+
+class EjecucionLote:
+    """Procesa las preguntas únicas que faltan y registra cada una en estado.jsonl"""
+
+    def __init__(self, pipeline, salida, formato="csv", graficos=True, concurrencia=4):
+        self.pipeline = pipeline
+        self.salida = salida
+        self.formato = formato
+        self.graficos = graficos
+        self.concurrencia = asyncio.Semaphore(concurrencia)
+        self.ruta_estado = os.path.join(salida, "estado.jsonl")
+        self.resultados = []
+
+    def terminadas(self):
+        """Estado más reciente de cada clave ya procesada en ejecuciones anteriores"""
+        estado = {}
+        if os.path.exists(self.ruta_estado):
+            with open(self.ruta_estado, encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        registro = json.loads(linea)
+                    except ValueError:
+                        # Línea cortada por una interrupción: esa pregunta se repite
+                        continue
+                    estado[registro["clave"]] = registro
+        return estado
+
+    def _registrar(self, registro):
+        self.resultados.append(registro)
+        with open(self.ruta_estado, "a", encoding="utf-8") as f:
+            f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def terminada(self, registro):
+        """Indica si una pregunta ya registrada no hay que repetirla al reanudar"""
+        estado = (registro or {}).get("estado")
+        return estado == "ok" or (estado == "sin_grafico" and not self.graficos)
+
+    async def _procesar(self, clave, pregunta):
+        directorio = os.path.join(self.salida, clave)
+        os.makedirs(directorio, exist_ok=True)
+        inicio = time.perf_counter()
+        registro = {"clave": clave, "pregunta": pregunta, "estado": "ok", "error": None,
+                    "filas": 0, "truncado": False, "grafico": None}
+        eventos = self.pipeline.procesar(pregunta)
+        try:
+            async for evento in eventos:
+                if evento["etapa"] == "sql":
+                    query = evento["query"]
+                    _escribir_atomico(os.path.join(directorio, "consulta.sql"),
+                                      lambda f: f.write(query + "\n"))
+                elif evento["etapa"] == "resultados":
+                    columns, results = evento["columns"], evento["results"]
+                    if columns == ["Error"]:
+                        registro.update(estado="error", error=str(results[0][0]))
+                        break
+                    # Sin filas el pipeline devuelve una fila de aviso: se escribe solo la cabecera
+                    _escribir_resultados(directorio, columns, results if evento["filas"] else [],
+                                         self.formato)
+                    registro.update(filas=evento["filas"], truncado=evento["truncado"])
+                    if not self.graficos:
+                        break
+                elif evento["etapa"] == "grafico":
+                    grafico = evento["grafico"]
+                    registro["grafico"] = grafico["metodo"]
+                    if grafico["script"]:
+                        _escribir_atomico(os.path.join(directorio, "grafico.py"),
+                                          lambda f: f.write(grafico["script"]))
+                    if grafico["png"] is not None:
+                        _escribir_atomico(os.path.join(directorio, "grafico.png"),
+                                          lambda f: f.write(grafico["png"]), "wb")
+                    elif registro["filas"]:
+                        # Sin filas no hay nada que graficar; con filas, el gráfico falló
+                        registro.update(estado="sin_grafico",
+                                        error=f"No se generó el gráfico (método {grafico['metodo']})")
+        except Exception as e:
+            registro.update(estado="error", error=f"{type(e).__name__}: {e}")
+        finally:
+            # Cerrar el generador cancela el gráfico pendiente si se salió antes
+            await eventos.aclose()
+        registro["duracion"] = round(time.perf_counter() - inicio, 3)
+        self._registrar(registro)
+        marca = "ok" if registro["estado"] == "ok" else f"{registro['estado']}: {registro['error']}"
+        print(f"[{len(self.resultados)}] {pregunta[:70]} -> {marca} ({registro['duracion']:.1f} s)")
+
+    async def _con_limite(self, clave, pregunta):
+        async with self.concurrencia:
+            await self._procesar(clave, pregunta)
+
+    async def ejecutar(self, pendientes):
+        await asyncio.gather(*(self._con_limite(clave, pregunta) for clave, pregunta in pendientes))
+
+
+def escribir_indice(salida, preguntas, estado):
+    def escribir(f):
+        escritor = csv.writer(f)
+        escritor.writerow(["id", "pregunta", "clave", "estado", "error"])
+        for id_pregunta, pregunta in preguntas:
+            clave = clave_pregunta(pregunta)
+            registro = estado.get(clave, {})
+            escritor.writerow([id_pregunta, pregunta, clave, registro.get("estado", "pendiente"),
+                               registro.get("error") or ""])
+
+    _escribir_atomico(os.path.join(salida, "indice.csv"), escribir)
+
+
+def resumen(preguntas, unicas, saltadas, resultados, segundos, pipeline):
+    duraciones = [r["duracion"] for r in resultados]
+    correctas = sum(1 for r in resultados if r["estado"] == "ok")
+    sin_grafico = sum(1 for r in resultados if r["estado"] == "sin_grafico")
+    return {
+        "preguntas": len(preguntas),
+        "unicas": unicas,
+        "ya_terminadas": saltadas,
+        "procesadas": len(resultados),
+        "correctas": correctas,
+        "sin_grafico": sin_grafico,
+        "errores": len(resultados) - correctas - sin_grafico,
+        "segundos": round(segundos, 3),
+        "preguntas_por_segundo": round(len(resultados) / segundos, 3) if segundos else None,
+        "filas": sum(r["filas"] for r in resultados),
+        "latencia": percentiles(duraciones),
+        "graficos": {metodo: sum(1 for r in resultados if r["grafico"] == metodo)
+                     for metodo in sorted({r["grafico"] for r in resultados if r["grafico"]})},
+        "pool": pipeline.db.estadisticas_pool(),
+        "replicas": pipeline.db.estadisticas_replicas(),
+        "cache_resultados": pipeline.db.estadisticas_cache_resultados(),
+        "coalescencia": pipeline.estadisticas_coalescencia(),
+    }
+
+
+async def _main_async(args):
+    preguntas = leer_preguntas(args.entrada)
+    unicas = {}
+    for _, pregunta in preguntas:
+        unicas.setdefault(clave_pregunta(pregunta), pregunta)
+
+    os.makedirs(args.salida, exist_ok=True)
+    pipeline = PipelineAsync(max_llm=args.max_llm, max_db=args.max_db, max_graficos=args.max_graficos)
+    lote = EjecucionLote(pipeline, args.salida, args.formato, not args.sin_graficos,
+                         args.concurrencia or args.max_llm + args.max_db)
+    anteriores = lote.terminadas()
+    pendientes = [(clave, pregunta) for clave, pregunta in unicas.items()
+                  if not lote.terminada(anteriores.get(clave))]
+    print(f"{len(preguntas)} preguntas, {len(unicas)} únicas, "
+          f"{len(unicas) - len(pendientes)} ya terminadas, {len(pendientes)} pendientes")
+
+    inicio = time.perf_counter()
+    try:
+        await lote.ejecutar(pendientes)
+    finally:
+        segundos = time.perf_counter() - inicio
+        escribir_indice(args.salida, preguntas, lote.terminadas())
+        informe = resumen(preguntas, len(unicas), len(unicas) - len(pendientes),
+                          lote.resultados, segundos, pipeline)
+        _escribir_atomico(os.path.join(args.salida, "resumen.json"),
+                          lambda f: json.dump(informe, f, ensure_ascii=False, indent=2, default=str))
+        print(f"\nProcesadas {informe['procesadas']} preguntas en {informe['segundos']:.1f} s "
+              f"({informe['preguntas_por_segundo'] or 0:.2f} por segundo): "
+              f"{informe['correctas']} correctas, {informe['sin_grafico']} sin gráfico, "
+              f"{informe['errores']} con error")
+        latencia = informe["latencia"]
+        if latencia["n"]:
+            print(f"Latencia por pregunta: p50 {latencia['p50']:.1f} s, p95 {latencia['p95']:.1f} s, "
+                  f"p99 {latencia['p99']:.1f} s")
+        print(f"Filas escritas: {informe['filas']:,}; gráficos: {informe['graficos']}")
+        pipeline.db.close()
+    return informe
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Responde en lote las preguntas de un JSONL o CSV")
+    parser.add_argument("entrada", help="archivo .jsonl o .csv con las preguntas")
+    parser.add_argument("--salida", required=True, help="directorio de resultados (permite reanudar)")
+    parser.add_argument("--formato", choices=("csv", "parquet"), default="csv")
+    parser.add_argument("--max-llm", type=int, default=int(os.getenv("PIPELINE_MAX_LLM", "2")),
+                        help="generaciones de SQL simultáneas")
+    parser.add_argument("--max-db", type=int, default=int(os.getenv("PIPELINE_MAX_DB", "8")),
+                        help="consultas simultáneas a la base de datos")
+    parser.add_argument("--max-graficos", type=int, default=int(os.getenv("PIPELINE_MAX_GRAFICOS", "2")),
+                        help="gráficos generados a la vez")
+    parser.add_argument("--concurrencia", type=int,
+                        help="preguntas en curso a la vez (por defecto max-llm + max-db)")
+    parser.add_argument("--sin-graficos", action="store_true", help="escribir solo SQL y resultados")
+    args = parser.parse_args()
+    if args.formato == "parquet" and not motor_parquet_disponible():
+        # Mejor fallar aquí que tras ejecutar cada consulta
+        parser.error("--formato parquet necesita pyarrow o fastparquet (pip install pyarrow)")
+
+    informe = asyncio.run(_main_async(args))
+    sys.exit(1 if informe["errores"] else 0)
+
+
+if __name__ == "__main__":
+    main()
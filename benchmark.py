@@ -0,0 +1,335 @@
+"""Benchmark sin conexión del pipeline pregunta -> SQL -> resultados -> gráfico
+
+Sustituye Ollama por un modelo simulado determinista con latencia configurable
+y respuestas predefinidas, carga la base de datos de pruebas a varias escalas
+y mide latencia por etapa (p50/p95/p99), throughput con N clientes
+concurrentes y memoria residente máxima. Los resultados se guardan en JSON
+para poder comparar ejecuciones.
+
+    python benchmark.py --base-datos ragdb_bench --escalas 1,10 --clientes 1,4,16
+    python benchmark.py --comparar .cache/benchmarks/anterior.json .cache/benchmarks/actual.json
+
+El benchmark borra y recrea las tablas de la tienda: usa siempre una base de datos
+dedicada (--base-datos o BENCH_DB_NAME).
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from database_manager import DatabaseManager, cargar_config_bd, cargar_config_limites, cargar_config_pool
+from pipeline import PipelineAsync
+from result_cache import ResultCache
+from schema_cache import directorio_cache
+from tracing import percentiles, tracer
+
+# Preguntas del benchmark y el SQL que devuelve el modelo simulado para cada una
+PREGUNTAS = {
+    "total de ventas por categoria": """
+        SELECT c.nombre AS categoria, SUM(v.total) AS total
+        FROM ventas v
+        JOIN productos p ON p.id_producto = v.id_producto
+        JOIN categorias c ON c.id_categoria = p.id_categoria
+        GROUP BY c.nombre
+        ORDER BY total DESC""",
+    "ventas por mes": """
+        SELECT date_trunc('month', fecha_venta)::date AS mes, SUM(total) AS total
+        FROM ventas
+        GROUP BY mes
+        ORDER BY mes""",
+    "los 10 clientes que mas han comprado": """
+        SELECT cl.nombre, SUM(v.total) AS total
+        FROM ventas v
+        JOIN clientes cl ON cl.id_cliente = v.id_cliente
+        GROUP BY cl.id_cliente, cl.nombre
+        ORDER BY total DESC
+        LIMIT 10""",
+    "productos con poco stock": """
+        SELECT nombre, stock
+        FROM productos
+        WHERE stock < 20
+        ORDER BY stock""",
+    "ventas de 2024 con su producto": """
+        SELECT v.fecha_venta, p.nombre AS producto, v.cantidad, v.total
+        FROM ventas v
+        JOIN productos p ON p.id_producto = v.id_producto
+        WHERE v.fecha_venta >= DATE '2024-01-01'
+        ORDER BY v.fecha_venta""",
+}
+
+# Script que devuelve el modelo simulado cuando el gráfico no sale por reglas
+SCRIPT_GRAFICO = '''```python
+import io
+from matplotlib.figure import Figure
+
+# Graficar la primera columna numérica frente al número de fila
+fig = Figure(figsize=(10, 6))
+ax = fig.add_subplot()
+numericas = df.select_dtypes("number").columns
+if len(numericas):
+    ax.plot(range(len(df)), df[numericas[0]])
+fig.savefig(io.BytesIO(), format="png")
+```
+Este script dibuja la primera columna numérica.'''
+
+class LLMSimulado:
+    """Sustituto determinista de Ollama con la misma interfaz que usan los agentes
+
+    `responder(prompt)` devuelve el texto completo. La latencia se modela como
+    un tiempo hasta el primer token más un ritmo fijo de tokens por segundo.
+    """
+
+    def __init__(self, responder, latencia_primer_token=0.3, tokens_por_segundo=50.0):
+        self.responder = responder
+        self.latencia_primer_token = latencia_primer_token
+        self.segundos_por_token = 1 / tokens_por_segundo if tokens_por_segundo else 0.0
+        self.llamadas = 0
+
+    def _tokens(self, prompt):
+        self.llamadas += 1
+        return re.findall(r"\s*\S+|\s+", self.responder(prompt))
+
+    def invoke(self, prompt):
+        tokens = self._tokens(prompt)
+        time.sleep(self.latencia_primer_token + len(tokens) * self.segundos_por_token)
+        return "".join(tokens)
+
+    async def ainvoke(self, prompt):
+        tokens = self._tokens(prompt)
+        await asyncio.sleep(self.latencia_primer_token + len(tokens) * self.segundos_por_token)
+        return "".join(tokens)
+
+    def stream(self, prompt):
+        tokens = self._tokens(prompt)
+        time.sleep(self.latencia_primer_token)
+        for token in tokens:
+            time.sleep(self.segundos_por_token)
+            yield token
+
+    async def astream(self, prompt):
+        tokens = self._tokens(prompt)
+        await asyncio.sleep(self.latencia_primer_token)
+        for token in tokens:
+            await asyncio.sleep(self.segundos_por_token)
+            yield token
+
+
+def responder_sql(prompt):
+    """Devuelve el SQL predefinido de la pregunta que aparece en el prompt"""
+    # La pregunta va al final del prompt; las más largas primero para no confundir prefijos
+    for pregunta in sorted(PREGUNTAS, key=len, reverse=True):
+        if pregunta in prompt:
+            return f"```sql\n{PREGUNTAS[pregunta].strip()};\n```\nEsta consulta responde a la pregunta."
+    return "```sql\nSELECT COUNT(*) AS ventas FROM ventas;\n```"
+
+
+def responder_script(prompt):
+    return SCRIPT_GRAFICO
+
+
+def rss_pico_mb():
+    """Memoria residente máxima del proceso desde que arrancó (None si no se puede medir)"""
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa en KiB y macOS en bytes
+    return round(pico / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+async def medir(db, args, clientes):
+    """Lanza args.peticiones preguntas repartidas entre `clientes` clientes concurrentes"""
+    pipeline = PipelineAsync(
+        db=db,
+        llm_sql=LLMSimulado(responder_sql, args.latencia_llm, args.tokens_por_segundo),
+        llm_graficos=LLMSimulado(responder_script, args.latencia_llm, args.tokens_por_segundo),
+        usar_cache_sql=args.con_cache,
+    )
+    # Fuera de la medición: esquema y agente SQL ya construidos
+    await pipeline.agente_sql()
+
+    etapas = defaultdict(list)
+    lock = threading.Lock()
+
+    def registrar_span(span):
+        # Los spans de la base de datos terminan en hilos del pool
+        with lock:
+            etapas[span.nombre].append(span.duracion)
+
+    preguntas = list(PREGUNTAS)
+    pendientes = [preguntas[i % len(preguntas)] for i in range(args.peticiones)]
+    pendientes.reverse()
+    latencias, hasta_resultados, errores = [], [], 0
+
+    async def cliente():
+        nonlocal errores
+        while pendientes:
+            pregunta = pendientes.pop()
+            inicio = time.perf_counter()
+            try:
+                async for evento in pipeline.procesar(pregunta):
+                    if evento["etapa"] == "resultados":
+                        hasta_resultados.append(time.perf_counter() - inicio)
+                latencias.append(time.perf_counter() - inicio)
+            except Exception as e:
+                errores += 1
+                print(f"Error en '{pregunta}': {e}", file=sys.stderr)
+
+    anular = tracer.suscribir(registrar_span)
+    try:
+        inicio = time.perf_counter()
+        await asyncio.gather(*(cliente() for _ in range(clientes)))
+        duracion = time.perf_counter() - inicio
+    finally:
+        anular()
+
+    return {
+        "clientes": clientes,
+        "peticiones": args.peticiones,
+        "errores": errores,
+        "duracion_s": round(duracion, 3),
+        "throughput_rps": round(len(latencias) / duracion, 3) if duracion else None,
+        "latencia": percentiles(latencias),
+        "hasta_resultados": percentiles(hasta_resultados),
+        "etapas": {nombre: percentiles(valores) for nombre, valores in sorted(etapas.items())},
+        "rss_pico_mb": rss_pico_mb(),
+    }
+
+
+def ejecutar(args):
+    db_config = cargar_config_bd()
+    db_config["database"] = args.base_datos
+    resultados = []
+    for escala in args.escalas:
+        db = DatabaseManager(**db_config, pool_config=cargar_config_pool(),
+                             result_cache=ResultCache(64 * 1024 * 1024) if args.con_cache else None,
+                             **cargar_config_limites())
+        db.connect()
+        try:
+            if args.no_cargar:
+                filas = None
+            else:
+                print(f"Cargando datos sintéticos a escala {escala}...")
+                inicio = time.perf_counter()
+                filas = db.generar_datos_tienda(escala)
+                print(f"  {filas} en {time.perf_counter() - inicio:.1f} s")
+            for clientes in args.clientes:
+                print(f"Escala {escala}, {clientes} clientes concurrentes...")
+                with open(os.devnull, "w") as nulo, \
+                        contextlib.redirect_stdout(sys.stdout if args.verbose else nulo):
+                    medicion = asyncio.run(medir(db, args, clientes))
+                medicion.update(escala=escala, filas=filas)
+                resultados.append(medicion)
+                latencia = medicion["latencia"]
+                print(f"  {medicion['throughput_rps']} peticiones/s, p50 {latencia['p50']} s, "
+                      f"p95 {latencia['p95']} s, p99 {latencia['p99']} s, "
+                      f"RSS pico {medicion['rss_pico_mb']} MB, errores {medicion['errores']}")
+        finally:
+            db.close()
+    return resultados
+
+
+def commit_actual():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(base, actual):
+    """Imprime la variación de p50 y p95 por escala, clientes y etapa entre dos ejecuciones"""
+    indice = {(r["escala"], r["clientes"]): r for r in base["resultados"]}
+    print(f"Comparando {base.get('commit')} ({base['fecha']}) con {actual.get('commit')} ({actual['fecha']})")
+    for resultado in actual["resultados"]:
+        anterior = indice.get((resultado["escala"], resultado["clientes"]))
+        if anterior is None:
+            continue
+        print(f"\nEscala {resultado['escala']}, {resultado['clientes']} clientes: "
+              f"{anterior['throughput_rps']} -> {resultado['throughput_rps']} peticiones/s")
+        filas = [("total", anterior["latencia"], resultado["latencia"])]
+        filas += [(etapa, anterior["etapas"].get(etapa), valores)
+                  for etapa, valores in resultado["etapas"].items()]
+        for etapa, antes, ahora in filas:
+            if not antes:
+                continue
+            cambios = []
+            for p in ("p50", "p95"):
+                if antes[p] and ahora[p] is not None:
+                    cambios.append(f"{p} {antes[p]:.4f} -> {ahora[p]:.4f} s ({ahora[p] / antes[p] - 1:+.1%})")
+            print(f"  {etapa:<24} " + ", ".join(cambios))
+
+
+def _lista_enteros(texto):
+    return [int(valor) for valor in texto.split(",") if valor.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sin conexión del pipeline de consultas")
+    parser.add_argument("--base-datos", default=os.getenv("BENCH_DB_NAME"),
+                        help="base de datos dedicada al benchmark (se borran sus tablas)")
+    parser.add_argument("--escalas", type=_lista_enteros, default=[1, 10],
+                        help="factores de escala de los datos sintéticos, separados por comas")
+    parser.add_argument("--clientes", type=_lista_enteros, default=[1, 4, 16],
+                        help="niveles de concurrencia, separados por comas")
+    parser.add_argument("--peticiones", type=int, default=50, help="peticiones por medición")
+    parser.add_argument("--latencia-llm", type=float, default=0.3,
+                        help="segundos hasta el primer token del modelo simulado")
+    parser.add_argument("--tokens-por-segundo", type=float, default=50.0,
+                        help="ritmo de generación del modelo simulado (0 = instantáneo)")
+    parser.add_argument("--con-cache", action="store_true",
+                        help="mantener las cachés de SQL y de resultados (mide el camino caliente)")
+    parser.add_argument("--no-cargar", action="store_true",
+                        help="reutilizar los datos ya cargados en lugar de regenerarlos")
+    parser.add_argument("--salida", help="archivo JSON de resultados")
+    parser.add_argument("--comparar", nargs="+", metavar="JSON",
+                        help="ejecución base con la que comparar; con dos archivos solo compara")
+    parser.add_argument("--verbose", action="store_true", help="no silenciar la salida del pipeline")
+    args = parser.parse_args()
+
+    if args.comparar and len(args.comparar) > 2:
+        parser.error("--comparar admite uno o dos archivos")
+    if args.comparar and len(args.comparar) == 2:
+        with open(args.comparar[0], encoding="utf-8") as f, open(args.comparar[1], encoding="utf-8") as g:
+            comparar(json.load(f), json.load(g))
+        return
+    if not args.base_datos:
+        parser.error("indica una base de datos de pruebas con --base-datos o BENCH_DB_NAME: "
+                     "el benchmark borra y recrea las tablas de la tienda")
+
+    informe = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit_actual(),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "parametros": {k: v for k, v in vars(args).items() if k not in ("comparar", "salida")},
+        "resultados": ejecutar(args),
+    }
+
+    salida = args.salida or os.path.join(
+        directorio_cache(), "benchmarks", f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(salida) or ".", exist_ok=True)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(informe, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados guardados en {salida}")
+
+    if args.comparar:
+        with open(args.comparar[0], encoding="utf-8") as f:
+            comparar(json.load(f), informe)
+
+
+if __name__ == "__main__":
+    main()
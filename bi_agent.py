@@ -1,41 +1,256 @@
-from langchain_community.llms import Ollama
-from langchain_core.callbacks import CallbackManager
-from langchain_core.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain_core.prompts import PromptTemplate
-import pandas as pd
+import asyncio
+import json
 import re
-from decimal import Decimal
+
+from arranque import parametros_ollama
+from schema_retriever import estimar_tokens
+from script_sandbox import obtener_pool_scripts
+from tracing import tracer
 
 class BIAgent:
-    def __init__(self):
-        self.llm = Ollama(
-            model="codellama",
-            callback_manager=CallbackManager([StreamingStdOutCallbackHandler()]),
-            temperature=0.1
-        )
+    MODELO = "codellama"
+
+    def __init__(self, max_filas_grafico=200, filas_muestra=10, llm=None, pool_scripts=None):
+        # Los tokens se entregan a la interfaz con los métodos *_stream
+        self.llm = llm or self._crear_llm()
+        self.max_filas_grafico = max_filas_grafico
+        self.filas_muestra = filas_muestra
+        # Datos reducidos de la última petición; se inyectan al ejecutar el script
+        self.datos = None
+        # Sin pool propio se usa el compartido, que se crea al ejecutar el primer script
+        self.pool_scripts = pool_scripts
+
+    def _crear_llm(self):
+        # langchain, pandas y matplotlib se importan en el primer uso, no al arrancar
+        from langchain_community.llms import Ollama
+
+        return Ollama(model=self.MODELO, temperature=0.1, **parametros_ollama())
+
+    def _preparar_datos(self, columns, results):
+        """Convierte el resultado a DataFrame reducido y lo guarda para la ejecución
+
+        Con una TablaResultados el DataFrame se monta sobre sus columnas ya
+        convertidas, sin copiar las filas.
+        """
+        from data_reducer import a_dataframe, reducir
+
+        df = a_dataframe(columns, results)
+        df, reduccion = reducir(df, max_filas=self.max_filas_grafico)
+        self.datos = df
+        return df, reduccion
 
     def generar_script_grafico(self, columns, results, tipo_grafico='bar'):
         """
         Genera un script de Python que crea un gráfico usando Plotly
         """
+        with tracer.span("generar_grafico", metodo="llm") as span:
+            try:
+                # Convertir resultados a un DataFrame de pandas con tipos nativos
+                df, reduccion = self._preparar_datos(columns, results)
+                return self._script_desde_datos(df, reduccion, tipo_grafico, span)
+            except Exception as e:
+                print(f"Error al generar el script de gráfico: {e}")
+                span.registrar(metodo="error")
+                return None
+
+    def generar_script_grafico_stream(self, columns, results, tipo_grafico='bar'):
+        """
+        Genera el script token a token y corta la generación al cerrarse el bloque de código
+        """
+        # El span se crea al llamar, no al iterar: así hereda el span activo del llamador
+        span = tracer.iniciar("generar_grafico", modo="stream", metodo="llm")
+        return self._generar_script_grafico_stream(columns, results, tipo_grafico, span)
+
+    def _generar_script_grafico_stream(self, columns, results, tipo_grafico, span):
         try:
-            # Convertir resultados a un DataFrame de pandas
-            df = pd.DataFrame(results, columns=columns)
-            for col in df.columns:
-                if df[col].apply(lambda x: isinstance(x, Decimal)).any():
-                    df[col] = df[col].astype(float)
-
-            data_dict = df.to_dict(orient="records")
-
-            # Crear el prompt
-            prompt = self._crear_prompt(data_dict, tipo_grafico)
-            print(prompt)
-            # Generar el script de gráfico usando el modelo de lenguaje
-            script = self.llm.invoke(prompt)
-            return script
+            df, reduccion = self._preparar_datos(columns, results)
+            yield from self._stream_script(self._prompt_grafico(df, reduccion, tipo_grafico, span), span)
         except Exception as e:
             print(f"Error al generar el script de gráfico: {e}")
+            span.registrar(metodo="error")
+        finally:
+            span.terminar()
+
+    def _stream_script(self, prompt, span):
+        acumulado = ""
+        fragmentos = 0
+        try:
+            for token in self.llm.stream(prompt):
+                token, completo = _recortar_token(acumulado, token)
+                acumulado += token
+                fragmentos += 1
+                yield token
+                if completo:
+                    # Cerrar el stream evita pagar por los tokens que vendrían después
+                    break
+        finally:
+            span.registrar(tokens_completion=fragmentos)
+
+    async def _astream_script(self, prompt, span):
+        acumulado = ""
+        fragmentos = 0
+        try:
+            async for token in self.llm.astream(prompt):
+                token, completo = _recortar_token(acumulado, token)
+                acumulado += token
+                fragmentos += 1
+                yield token
+                if completo:
+                    break
+        finally:
+            span.registrar(tokens_completion=fragmentos)
+
+    def _prompt_grafico(self, df, reduccion, tipo_grafico, span=None):
+        from data_reducer import perfil_columnas
+
+        # El prompt solo recibe un perfil de columnas y una muestra, no todas las filas
+        resumen = {
+            "filas": len(df),
+            "reduccion": reduccion,
+            "columnas": perfil_columnas(df),
+            "muestra": df.head(self.filas_muestra).astype(str).to_dict(orient="records"),
+        }
+
+        # Crear el prompt
+        prompt = self._crear_prompt(json.dumps(resumen, ensure_ascii=False, default=str), tipo_grafico)
+        print(prompt)
+        if span is not None:
+            span.registrar(tokens_prompt=estimar_tokens(prompt))
+        return prompt
+
+    def _script_desde_datos(self, df, reduccion, tipo_grafico, span):
+        # Generar el script de gráfico usando el modelo de lenguaje
+        script = self.llm.invoke(self._prompt_grafico(df, reduccion, tipo_grafico, span))
+        span.registrar(tokens_completion=estimar_tokens(script))
+        return script
+
+    def generar_grafico(self, columns, results, tipo_grafico='bar', usar_reglas=True):
+        """
+        Genera el gráfico por reglas si la forma de los datos lo permite y, si no, con el LLM
+
+        Devuelve un diccionario con 'metodo' ('reglas' o 'llm'), 'spec', 'png', 'script'
+        y 'datos' (el DataFrame reducido sobre el que se ejecuta el script).
+        """
+        with tracer.span("generar_grafico", modo="completo") as span:
+            try:
+                df, reduccion = self._preparar_datos(columns, results)
+                grafico = self._grafico_por_reglas(df, usar_reglas)
+                if grafico is None:
+                    grafico = {"metodo": "llm", "spec": None, "png": None, "datos": df,
+                               "script": self._script_desde_datos(df, reduccion, tipo_grafico, span)}
+            except Exception as e:
+                print(f"Error al generar el gráfico: {e}")
+                grafico = {"metodo": "error", "spec": None, "png": None, "script": None, "datos": None}
+            span.registrar(metodo=grafico["metodo"])
+            return grafico
+
+    async def agenerar_grafico(self, columns, results, tipo_grafico='bar', usar_reglas=True):
+        """
+        Versión asíncrona de generar_grafico: el trabajo de pandas/matplotlib va a un
+        hilo y la llamada al LLM usa el cliente asíncrono
+        """
+        with tracer.span("generar_grafico", modo="completo") as span:
+            try:
+                df, reduccion = await asyncio.to_thread(self._preparar_datos, columns, results)
+                grafico = await asyncio.to_thread(self._grafico_por_reglas, df, usar_reglas)
+                if grafico is None:
+                    prompt = self._prompt_grafico(df, reduccion, tipo_grafico, span)
+                    script = await self.llm.ainvoke(prompt)
+                    span.registrar(tokens_completion=estimar_tokens(script))
+                    grafico = {"metodo": "llm", "spec": None, "png": None, "datos": df, "script": script}
+            except Exception as e:
+                print(f"Error al generar el gráfico: {e}")
+                grafico = {"metodo": "error", "spec": None, "png": None, "script": None, "datos": None}
+            span.registrar(metodo=grafico["metodo"])
+            return grafico
+
+    def generar_grafico_stream(self, columns, results, tipo_grafico='bar', usar_reglas=True):
+        """
+        Como generar_grafico, pero entrega {'token': ...} mientras el LLM escribe el
+        script y termina con {'grafico': ...}
+        """
+        span = tracer.iniciar("generar_grafico", modo="stream")
+        return self._generar_grafico_stream(columns, results, tipo_grafico, usar_reglas, span)
+
+    def _generar_grafico_stream(self, columns, results, tipo_grafico, usar_reglas, span):
+        grafico = None
+        try:
+            df, reduccion = self._preparar_datos(columns, results)
+            grafico = self._grafico_por_reglas(df, usar_reglas)
+            if grafico is None:
+                script = ""
+                prompt = self._prompt_grafico(df, reduccion, tipo_grafico, span)
+                for token in self._stream_script(prompt, span):
+                    script += token
+                    yield {"token": token}
+                grafico = {"metodo": "llm", "spec": None, "png": None, "script": script, "datos": df}
+        except Exception as e:
+            print(f"Error al generar el gráfico: {e}")
+            grafico = {"metodo": "error", "spec": None, "png": None, "script": None, "datos": None}
+        finally:
+            if grafico is not None:
+                span.registrar(metodo=grafico["metodo"])
+            span.terminar()
+        yield {"grafico": grafico}
+
+    def agenerar_grafico_stream(self, columns, results, tipo_grafico='bar', usar_reglas=True):
+        """Versión asíncrona de generar_grafico_stream"""
+        span = tracer.iniciar("generar_grafico", modo="stream")
+        return self._agenerar_grafico_stream(columns, results, tipo_grafico, usar_reglas, span)
+
+    async def _agenerar_grafico_stream(self, columns, results, tipo_grafico, usar_reglas, span):
+        grafico = None
+        try:
+            df, reduccion = await asyncio.to_thread(self._preparar_datos, columns, results)
+            grafico = await asyncio.to_thread(self._grafico_por_reglas, df, usar_reglas)
+            if grafico is None:
+                script = ""
+                prompt = self._prompt_grafico(df, reduccion, tipo_grafico, span)
+                async for token in self._astream_script(prompt, span):
+                    script += token
+                    yield {"token": token}
+                grafico = {"metodo": "llm", "spec": None, "png": None, "script": script, "datos": df}
+        except Exception as e:
+            print(f"Error al generar el gráfico: {e}")
+            grafico = {"metodo": "error", "spec": None, "png": None, "script": None, "datos": None}
+        finally:
+            if grafico is not None:
+                span.registrar(metodo=grafico["metodo"])
+            span.terminar()
+        yield {"grafico": grafico}
+
+    def _grafico_por_reglas(self, df, usar_reglas):
+        from chart_rules import elegir_grafico, renderizar_png
+
+        spec = elegir_grafico(df) if usar_reglas else None
+        if spec is None:
             return None
+        print(f"Gráfico generado por reglas: {spec['tipo']}")
+        return {"metodo": "reglas", "spec": spec, "png": renderizar_png(df, spec),
+                "script": None, "datos": df}
+
+    @staticmethod
+    def describir_metodo(grafico):
+        """Texto para la interfaz que indica cómo se generó el gráfico"""
+        if grafico["metodo"] == "reglas":
+            spec = grafico["spec"]
+            return (f"Gráfico generado por el motor de reglas, sin LLM "
+                    f"(tipo {spec['tipo']}, x={spec['x']}, y={', '.join(spec['y'])})")
+        if grafico["metodo"] == "llm":
+            return "Gráfico generado con un script de codellama"
+        return "No se pudo generar el gráfico"
+
+    def ejecutar_script(self, script, datos=None):
+        """
+        Ejecuta el script generado en un proceso aislado con el DataFrame disponible
+        como `df` y devuelve el PNG de la figura; lanza ErrorScript si falla
+        """
+        with tracer.span("ejecutar_script") as span:
+            pool = self.pool_scripts or obtener_pool_scripts()
+            png = pool.ejecutar(extraer_codigo(script), self.datos if datos is None else datos)
+            span.registrar(bytes=len(png))
+            print("Script ejecutado con éxito.")
+            return png
 
 
     def _crear_prompt(self, data, tipo_grafico):
@@ -47,17 +262,17 @@ Rol del sistema: Eres un experimentado asistente de generación de código en Py
 
 Instrucciones para la generación del script:
 
-1- Debes recibir un diccionario con datos como parámetro de entrada. Este diccionario contendrá los valores que se utilizarán para crear el grafico.
+1- Debes recibir un resumen de los datos como parámetro de entrada: el número de filas, las columnas con su tipo y estadísticas, y una muestra de filas.
 
 2- El script debe utilizar la librería matplotlib para crear un gráfico.
 
-3- Basándote en el diccionario proporcionado, elige automáticamente el tipo de gráfico de matplotlib que mejor represente los datos (por ejemplo: línea, barras, pastel, dispersión, etc.).
+3- Basándote en el resumen proporcionado, elige automáticamente el tipo de gráfico de matplotlib que mejor represente los datos (por ejemplo: línea, barras, pastel, dispersión, etc.).
 
-4- Incluir el diccionario con datos en el script generado como un dataframe pandas, para utilizarlo en el scrip del grafico.
+4- Los datos ya existen en una variable llamada df (un dataframe pandas con las columnas descritas). No definas ni modifiques df, utilízalo directamente en el script del grafico.
 
 5- Asegúrate de incluir comentarios en el script para explicar cada paso del proceso.
 
-6- El script solo debe crear el grafico. el script debe guardar el grafico en un archivo con nombre: grafico.png. El script debe ejecutar las instrucciones desde el script principal, sin funciones.
+6- El script solo debe crear el grafico. No guardes el grafico en un archivo ni llames a plt.show(): la figura se captura automáticamente. El script debe ejecutar las instrucciones desde el script principal, sin funciones.
 
 7- Genera solo el script, sin comentarios al final del script generado.
 
@@ -67,3 +282,17 @@ Entrada :
 
 """
         return template.format(data=data, tipo_grafico=tipo_grafico)
+
+
+def extraer_codigo(script):
+    """Devuelve el código de un bloque ``` si el modelo lo incluyó, o el texto tal cual"""
+    bloque = re.search(r"```(?:python|py)?\s*\n(.*?)(?:```|$)", script, re.DOTALL)
+    return bloque.group(1) if bloque else script
+
+
+def _recortar_token(acumulado, token):
+    """Recorta el token si cierra el bloque de código; devuelve (token, bloque cerrado)"""
+    bloque = re.search(r"```[^\n]*\n.*?```", acumulado + token, re.DOTALL)
+    if not bloque:
+        return token, False
+    return token[:bloque.end() - len(acumulado)], True
@@ -0,0 +1,131 @@
+import io
+
+import pandas as pd
+import plotly.graph_objects as go
+from matplotlib.figure import Figure
+
+# Resultados que no son datos y nunca se grafican
+COLUMNAS_SIN_DATOS = (["Error"], ["Affected rows"])
+
+
+def _tipos(df):
+    numericas = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])
+                 and not pd.api.types.is_bool_dtype(df[c])]
+    fechas = [c for c in df.columns if pd.api.types.is_datetime64_any_dtype(df[c])]
+    categoricas = [c for c in df.columns if c not in numericas and c not in fechas]
+    return numericas, fechas, categoricas
+
+
+def _es_identificador(col):
+    """Columnas id, id_* o *_id no sirven como medida, se repitan o no
+
+    Se decide solo por el nombre: un id_categoria repetido sigue siendo una
+    clave, y una medida agregada (un total por categoría) suele tener un valor
+    distinto por fila sin dejar de ser medida.
+    """
+    nombre = str(col).lower()
+    return nombre == "id" or nombre.startswith("id_") or nombre.endswith("_id")
+
+
+def elegir_grafico(df, max_categorias_pastel=6):
+    """Elige un gráfico por reglas a partir de tipos y cardinalidad, o None si ninguna aplica"""
+    if df is None or list(df.columns) in COLUMNAS_SIN_DATOS or len(df) < 2:
+        return None
+    if df.shape[1] == 1 and df.iloc[0, 0] == "No se encontraron resultados":
+        return None
+
+    numericas, fechas, categoricas = _tipos(df)
+    medidas = [c for c in numericas if not _es_identificador(c)]
+
+    # (fecha, número...) -> línea
+    if len(fechas) == 1 and medidas and not categoricas:
+        return {"tipo": "line", "x": fechas[0], "y": medidas[:3],
+                "titulo": f"{', '.join(medidas[:3])} por {fechas[0]}"}
+
+    # (categoría, número...) -> barras o pastel
+    if len(categoricas) == 1 and medidas and not fechas:
+        x = categoricas[0]
+        if not df[x].is_unique:
+            return None
+        y = medidas[:3]
+        if (len(y) == 1 and len(df) <= max_categorias_pastel
+                and (df[y[0]] >= 0).all() and df[y[0]].sum() > 0):
+            return {"tipo": "pie", "x": x, "y": y, "titulo": f"{y[0]} por {x}"}
+        horizontal = len(df) > 12 or df[x].astype(str).str.len().max() > 12
+        return {"tipo": "barh" if horizontal else "bar", "x": x, "y": y,
+                "titulo": f"{', '.join(y)} por {x}"}
+
+    # (número, número) -> dispersión
+    if not categoricas and not fechas and len(medidas) == 2:
+        return {"tipo": "scatter", "x": medidas[0], "y": [medidas[1]],
+                "titulo": f"{medidas[1]} frente a {medidas[0]}"}
+
+    return None
+
+
+def renderizar_png(df, spec, ancho=10, alto=6, dpi=100):
+    """Dibuja el gráfico con matplotlib (sin pyplot, seguro entre hilos) y devuelve los bytes PNG"""
+    fig = Figure(figsize=(ancho, alto), dpi=dpi)
+    ax = fig.add_subplot()
+    x, y, tipo = spec["x"], spec["y"], spec["tipo"]
+
+    if tipo == "line":
+        datos = df.sort_values(x)
+        for col in y:
+            ax.plot(datos[x], datos[col], marker="o" if len(datos) <= 50 else None, label=col)
+        fig.autofmt_xdate()
+    elif tipo == "pie":
+        ax.pie(df[y[0]], labels=df[x].astype(str), autopct="%1.1f%%", startangle=90)
+        ax.axis("equal")
+    elif tipo in ("bar", "barh"):
+        etiquetas = df[x].astype(str)
+        ancho_barra = 0.8 / len(y)
+        posiciones = range(len(df))
+        for i, col in enumerate(y):
+            desplazadas = [p + i * ancho_barra for p in posiciones]
+            if tipo == "bar":
+                ax.bar(desplazadas, df[col], width=ancho_barra, label=col)
+            else:
+                ax.barh(desplazadas, df[col], height=ancho_barra, label=col)
+        centros = [p + ancho_barra * (len(y) - 1) / 2 for p in posiciones]
+        if tipo == "bar":
+            ax.set_xticks(centros, etiquetas, rotation=45, ha="right")
+        else:
+            ax.set_yticks(centros, etiquetas)
+            ax.invert_yaxis()
+    elif tipo == "scatter":
+        ax.scatter(df[x], df[y[0]], alpha=0.7)
+
+    if tipo != "pie":
+        ax.set_xlabel(x if tipo != "barh" else ", ".join(y))
+        ax.set_ylabel(", ".join(y) if tipo != "barh" else x)
+        if len(y) > 1:
+            ax.legend()
+    ax.set_title(spec["titulo"])
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def renderizar_plotly(df, spec):
+    """Construye el mismo gráfico como figura de Plotly"""
+    x, y, tipo = spec["x"], spec["y"], spec["tipo"]
+    fig = go.Figure()
+    if tipo == "line":
+        datos = df.sort_values(x)
+        for col in y:
+            fig.add_trace(go.Scatter(x=datos[x], y=datos[col], mode="lines", name=col))
+    elif tipo == "pie":
+        fig.add_trace(go.Pie(labels=df[x].astype(str), values=df[y[0]]))
+    elif tipo in ("bar", "barh"):
+        for col in y:
+            if tipo == "bar":
+                fig.add_trace(go.Bar(x=df[x].astype(str), y=df[col], name=col))
+            else:
+                fig.add_trace(go.Bar(y=df[x].astype(str), x=df[col], name=col, orientation="h"))
+    elif tipo == "scatter":
+        fig.add_trace(go.Scatter(x=df[x], y=df[y[0]], mode="markers"))
+    fig.update_layout(title=spec["titulo"], barmode="group")
+    return fig
@@ -0,0 +1,107 @@
+"""Coalescencia de peticiones idénticas en curso (single-flight)
+
+Cuando varias peticiones con la misma clave llegan mientras la primera
+todavía se está ejecutando, todas comparten esa ejecución: la primera la
+lanza en una tarea propia y el resto se suscribe y recibe los mismos
+eventos desde el principio, los ya emitidos y los que vengan. Cuando la
+ejecución termina la clave se libera, así que una petición posterior
+vuelve a ejecutar (los resultados se reutilizan a más largo plazo con las
+cachés, no aquí).
+
+Cada suscriptor puede abandonar sin afectar a los demás; la ejecución solo
+se cancela cuando se va el último.
+"""
+import asyncio
+
+from tracing import tracer
+
+
+class _Vuelo:
+    """Una ejecución en curso y los eventos que ha emitido hasta ahora"""
+
+    def __init__(self, generador):
+        self.eventos = []
+        self.terminado = False
+        self.error = None
+        self.suscriptores = 0
+        self._nuevo = asyncio.Event()
+        self.tarea = asyncio.create_task(self._ejecutar(generador))
+
+    def _avisar(self):
+        self._nuevo.set()
+        self._nuevo = asyncio.Event()
+
+    async def _ejecutar(self, generador):
+        try:
+            async for evento in generador:
+                self.eventos.append(evento)
+                self._avisar()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            await generador.aclose()
+            self.terminado = True
+            self._avisar()
+
+    async def leer(self):
+        i = 0
+        while True:
+            if i < len(self.eventos):
+                yield self.eventos[i]
+                i += 1
+                continue
+            if self.terminado:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._nuevo.wait()
+
+
+class Coalescedor:
+    """Comparte una sola ejecución de un generador asíncrono entre peticiones con la misma clave"""
+
+    def __init__(self, etapa):
+        self.etapa = etapa
+        self._en_curso = {}
+        self.stats = {"ejecuciones": 0, "coalescidas": 0}
+
+    def _liberar(self, clave, vuelo):
+        if self._en_curso.get(clave) is vuelo:
+            del self._en_curso[clave]
+
+    def ejecutar(self, clave, crear):
+        """Eventos de la ejecución en curso con esa clave, o de una nueva creada con crear()
+
+        La ejecución se une o se lanza al llamar, no al iterar: la tarea nueva
+        hereda el contexto (y el span activo) de quien llama. El generador
+        devuelto hay que recorrerlo: hasta entonces cuenta como suscriptor.
+        """
+        vuelo = self._en_curso.get(clave)
+        if vuelo is None:
+            vuelo = _Vuelo(crear())
+            self._en_curso[clave] = vuelo
+            vuelo.tarea.add_done_callback(lambda _: self._liberar(clave, vuelo))
+            self.stats["ejecuciones"] += 1
+            tracer.metricas.incrementar("ragdb_ejecuciones_compartibles_total", self.etapa)
+        else:
+            self.stats["coalescidas"] += 1
+            tracer.metricas.incrementar("ragdb_coalescidas_total", self.etapa)
+        vuelo.suscriptores += 1
+        return self._leer(clave, vuelo)
+
+    async def _leer(self, clave, vuelo):
+        try:
+            async for evento in vuelo.leer():
+                yield evento
+        finally:
+            vuelo.suscriptores -= 1
+            if vuelo.suscriptores == 0 and not vuelo.tarea.done():
+                # Nadie espera ya el resultado: cancelar y no dejar que otra petición se una
+                self._liberar(clave, vuelo)
+                vuelo.tarea.cancel()
+
+    def estadisticas(self):
+        return dict(self.stats, en_curso=len(self._en_curso))
@@ -0,0 +1,278 @@
+"""Generador de datos sintéticos de la tienda para pruebas de carga
+
+Produce categorías, productos, clientes y ventas referencialmente consistentes
+a partir de un factor de escala, con sesgos realistas: la popularidad de los
+productos sigue una Zipf, los clientes compran con frecuencias desiguales y las
+ventas tienen tendencia anual, estacionalidad mensual y efecto de fin de
+semana. Las filas se envían con COPY FROM STDIN por lotes generados al vuelo,
+sin materializar la tabla en memoria. Las claves, claves foráneas e índices se
+crean después de la carga y al final se ejecuta ANALYZE.
+
+    python data_generator.py --escala 10    # ~1 millón de ventas
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+
+# Filas por unidad de escala (las categorías son fijas)
+FILAS_POR_ESCALA = {"productos": 1_000, "clientes": 10_000, "ventas": 100_000}
+
+CATEGORIAS = [
+    "Electronicos", "Ropa", "Libros", "Hogar", "Deportes", "Juguetes", "Alimentacion",
+    "Belleza", "Jardin", "Automovil", "Musica", "Oficina", "Mascotas", "Salud",
+    "Videojuegos", "Calzado", "Joyeria", "Bricolaje", "Fotografia", "Viajes",
+]
+ADJETIVOS = ["Basico", "Pro", "Plus", "Classic", "Eco", "Premium", "Mini", "Max", "Lite", "Ultra"]
+NOMBRES = [
+    "Ana", "Carlos", "Maria", "Jose", "Lucia", "Javier", "Elena", "David", "Carmen", "Pablo",
+    "Laura", "Miguel", "Sofia", "Daniel", "Marta", "Alberto", "Paula", "Sergio", "Sara", "Jorge",
+]
+APELLIDOS = [
+    "Garcia", "Lopez", "Rodriguez", "Martinez", "Sanchez", "Perez", "Gomez", "Martin",
+    "Jimenez", "Ruiz", "Hernandez", "Diaz", "Moreno", "Alvarez", "Romero", "Navarro",
+]
+
+INICIO_REGISTROS, FIN_REGISTROS = np.datetime64("2019-01-01"), np.datetime64("2022-01-01")
+INICIO_VENTAS, FIN_VENTAS = np.datetime64("2022-01-01"), np.datetime64("2025-01-01")
+# Peso relativo de cada mes (enero..diciembre) y de cada día (lunes..domingo)
+PESO_MES = np.array([0.85, 0.8, 0.9, 0.95, 1.0, 0.95, 1.05, 1.0, 0.9, 1.0, 1.3, 1.6])
+PESO_DIA_SEMANA = np.array([0.9, 0.9, 0.95, 1.0, 1.15, 1.35, 1.2])
+
+# Tablas sin claves ni índices: se crean tras la carga, que así es mucho más rápida
+DDL_TABLAS = """
+    DROP TABLE IF EXISTS ventas;
+    DROP TABLE IF EXISTS productos;
+    DROP TABLE IF EXISTS categorias;
+    DROP TABLE IF EXISTS clientes;
+
+    CREATE TABLE categorias (
+        id_categoria SERIAL,
+        nombre VARCHAR(50) COLLATE "C",
+        descripcion TEXT COLLATE "C"
+    );
+
+    CREATE TABLE productos (
+        id_producto SERIAL,
+        nombre VARCHAR(100) COLLATE "C",
+        precio DECIMAL(10,2),
+        stock INTEGER,
+        id_categoria INTEGER
+    );
+
+    CREATE TABLE clientes (
+        id_cliente SERIAL,
+        nombre VARCHAR(50) COLLATE "C",
+        email VARCHAR(100) COLLATE "C",
+        fecha_registro DATE
+    );
+
+    CREATE TABLE ventas (
+        id_venta SERIAL,
+        id_cliente INTEGER,
+        id_producto INTEGER,
+        cantidad INTEGER,
+        fecha_venta DATE,
+        total DECIMAL(10,2)
+    );
+"""
+
+DDL_RESTRICCIONES = """
+    ALTER TABLE categorias ADD PRIMARY KEY (id_categoria);
+    ALTER TABLE productos ADD PRIMARY KEY (id_producto);
+    ALTER TABLE clientes ADD PRIMARY KEY (id_cliente);
+    ALTER TABLE ventas ADD PRIMARY KEY (id_venta);
+
+    ALTER TABLE productos ADD FOREIGN KEY (id_categoria) REFERENCES categorias(id_categoria);
+    ALTER TABLE ventas ADD FOREIGN KEY (id_cliente) REFERENCES clientes(id_cliente);
+    ALTER TABLE ventas ADD FOREIGN KEY (id_producto) REFERENCES productos(id_producto);
+
+    CREATE INDEX ON productos (id_categoria);
+    CREATE INDEX ON ventas (id_cliente);
+    CREATE INDEX ON ventas (id_producto);
+    CREATE INDEX ON ventas (fecha_venta);
+
+    SELECT setval(pg_get_serial_sequence('categorias', 'id_categoria'), max(id_categoria)) FROM categorias;
+    SELECT setval(pg_get_serial_sequence('productos', 'id_producto'), max(id_producto)) FROM productos;
+    SELECT setval(pg_get_serial_sequence('clientes', 'id_cliente'), max(id_cliente)) FROM clientes;
+    SELECT setval(pg_get_serial_sequence('ventas', 'id_venta'), max(id_venta)) FROM ventas;
+"""
+
+
+def pesos_zipf(n, s):
+    """Probabilidades de una Zipf acotada a n elementos con exponente s"""
+    pesos = 1.0 / np.arange(1, n + 1) ** s
+    return pesos / pesos.sum()
+
+
+def pesos_dias(inicio, fin, crecimiento_anual=0.15):
+    """Probabilidad de venta de cada día: tendencia, estacionalidad mensual y día de la semana"""
+    dias = np.arange(inicio, fin, dtype="datetime64[D]")
+    # El 1970-01-01 fue jueves: (días + 3) % 7 da 0 para el lunes
+    dia_semana = (dias.astype(np.int64) + 3) % 7
+    mes = dias.astype("datetime64[M]").astype(np.int64) % 12
+    anos = (dias - inicio).astype(np.int64) / 365.25
+    pesos = (1 + crecimiento_anual) ** anos * PESO_MES[mes] * PESO_DIA_SEMANA[dia_semana]
+    return pesos / pesos.sum()
+
+
+class _FlujoCSV:
+    """Archivo de solo lectura que concatena los lotes CSV de un generador para COPY"""
+
+    def __init__(self, lotes):
+        self._lotes = iter(lotes)
+        self._actual = io.StringIO()
+
+    def read(self, size=-1):
+        partes = []
+        pendiente = size
+        while pendiente != 0:
+            datos = self._actual.read(pendiente)
+            if datos:
+                partes.append(datos)
+                if size >= 0:
+                    pendiente -= len(datos)
+                continue
+            lote = next(self._lotes, None)
+            if lote is None:
+                break
+            self._actual = io.StringIO(lote)
+        return "".join(partes)
+
+
+class GeneradorTienda:
+    """Genera los lotes CSV de cada tabla de forma determinista a partir de una semilla"""
+
+    def __init__(self, escala=1, semilla=42, tamano_lote=100_000):
+        self.escala = escala
+        self.tamano_lote = tamano_lote
+        self.rng = np.random.default_rng(semilla)
+        self.filas = {"categorias": len(CATEGORIAS)}
+        self.filas.update({tabla: max(1, int(n * escala)) for tabla, n in FILAS_POR_ESCALA.items()})
+        # Se rellenan al generar los productos; las ventas los necesitan para el total
+        self.precios = None
+
+    def _por_lotes(self, total, generar_lote):
+        for inicio in range(0, total, self.tamano_lote):
+            yield generar_lote(inicio, min(self.tamano_lote, total - inicio))
+
+    def categorias(self):
+        yield "".join(f"{i},{nombre},Productos de la categoria {nombre}\n"
+                      for i, nombre in enumerate(CATEGORIAS, start=1))
+
+    def productos(self):
+        n = self.filas["productos"]
+        # Unas pocas categorías concentran la mayor parte del catálogo
+        categorias = self.rng.choice(len(CATEGORIAS), n, p=pesos_zipf(len(CATEGORIAS), 0.8)) + 1
+        self.precios = np.maximum(np.round(self.rng.lognormal(3.3, 0.9, n), 2), 1.0)
+        adjetivos = self.rng.integers(0, len(ADJETIVOS), n)
+        stock = self.rng.integers(0, 500, n)
+
+        def lote(inicio, tamano):
+            return "".join(
+                f"{i + 1},{CATEGORIAS[c - 1]} {ADJETIVOS[a]} {i + 1},{p:.2f},{s},{c}\n"
+                for i, c, a, p, s in zip(
+                    range(inicio, inicio + tamano), categorias[inicio:inicio + tamano].tolist(),
+                    adjetivos[inicio:inicio + tamano].tolist(), self.precios[inicio:inicio + tamano].tolist(),
+                    stock[inicio:inicio + tamano].tolist()))
+        return self._por_lotes(n, lote)
+
+    def clientes(self):
+        n = self.filas["clientes"]
+        dias = (FIN_REGISTROS - INICIO_REGISTROS).astype(np.int64)
+
+        def lote(inicio, tamano):
+            nombres = self.rng.integers(0, len(NOMBRES), tamano).tolist()
+            apellidos = self.rng.integers(0, len(APELLIDOS), tamano).tolist()
+            # Todos se registran antes de la primera venta posible
+            fechas = (INICIO_REGISTROS + self.rng.integers(0, dias, tamano)).astype(str).tolist()
+            return "".join(
+                f"{i},{NOMBRES[nom]} {APELLIDOS[ape]},"
+                f"{NOMBRES[nom].lower()}.{APELLIDOS[ape].lower()}{i}@email.com,{f}\n"
+                for i, nom, ape, f in zip(range(inicio + 1, inicio + tamano + 1), nombres, apellidos, fechas))
+        return self._por_lotes(n, lote)
+
+    def ventas(self):
+        if self.precios is None:
+            raise RuntimeError("Hay que generar los productos antes que las ventas")
+        n_productos, n_clientes = self.filas["productos"], self.filas["clientes"]
+        # La popularidad se asigna a ids al azar para que el producto 1 no sea siempre el más vendido
+        p_productos, orden_productos = pesos_zipf(n_productos, 1.1), self.rng.permutation(n_productos)
+        p_clientes, orden_clientes = pesos_zipf(n_clientes, 0.6), self.rng.permutation(n_clientes)
+        p_dias = pesos_dias(INICIO_VENTAS, FIN_VENTAS)
+
+        def lote(inicio, tamano):
+            productos = orden_productos[self.rng.choice(n_productos, tamano, p=p_productos)]
+            clientes = orden_clientes[self.rng.choice(n_clientes, tamano, p=p_clientes)] + 1
+            cantidades = np.minimum(self.rng.geometric(0.55, tamano), 10)
+            totales = np.round(cantidades * self.precios[productos], 2)
+            fechas = (INICIO_VENTAS + self.rng.choice(len(p_dias), tamano, p=p_dias)).astype(str)
+            return "".join(
+                f"{i},{c},{p},{q},{f},{t:.2f}\n"
+                for i, c, p, q, f, t in zip(
+                    range(inicio + 1, inicio + tamano + 1), clientes.tolist(), (productos + 1).tolist(),
+                    cantidades.tolist(), fechas.tolist(), totales.tolist()))
+        return self._por_lotes(self.filas["ventas"], lote)
+
+
+def cargar_tienda(conn, escala=1, semilla=42, tamano_lote=100_000):
+    """Recrea las tablas de la tienda en `conn` y las llena con datos sintéticos
+
+    Devuelve el número de filas cargadas en cada tabla.
+    """
+    generador = GeneradorTienda(escala, semilla, tamano_lote)
+    tablas = [
+        ("categorias", "id_categoria, nombre, descripcion", generador.categorias),
+        ("productos", "id_producto, nombre, precio, stock, id_categoria", generador.productos),
+        ("clientes", "id_cliente, nombre, email, fecha_registro", generador.clientes),
+        ("ventas", "id_venta, id_cliente, id_producto, cantidad, fecha_venta, total", generador.ventas),
+    ]
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET client_encoding TO 'UTF8';")
+            # Nada de esto tiene que sobrevivir a un fallo: no hace falta esperar al WAL en disco
+            cur.execute("SET LOCAL synchronous_commit = off")
+            cur.execute("SET LOCAL maintenance_work_mem = '256MB'")
+            cur.execute(DDL_TABLAS)
+            for tabla, columnas, lotes in tablas:
+                inicio = time.perf_counter()
+                cur.copy_expert(f"COPY {tabla} ({columnas}) FROM STDIN WITH (FORMAT csv)",
+                                _FlujoCSV(lotes()), size=1 << 20)
+                print(f"{tabla}: {generador.filas[tabla]} filas en {time.perf_counter() - inicio:.1f} s")
+
+            inicio = time.perf_counter()
+            cur.execute(DDL_RESTRICCIONES)
+            print(f"Claves e índices creados en {time.perf_counter() - inicio:.1f} s")
+        conn.commit()
+
+        # Estadísticas para que el planificador vea la distribución real
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE categorias, productos, clientes, ventas")
+        conn.commit()
+        return dict(generador.filas)
+    except Exception as e:
+        print(f"Error generando los datos sintéticos: {e}")
+        conn.rollback()
+        raise
+
+
+def main():
+    from database_manager import obtener_db_compartida
+
+    parser = argparse.ArgumentParser(description="Carga datos sintéticos de la tienda con COPY")
+    parser.add_argument("--escala", type=float, default=1,
+                        help=f"factor de escala (1 = {FILAS_POR_ESCALA['ventas']:,} ventas)")
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--tamano-lote", type=int, default=100_000, help="filas por lote de COPY")
+    args = parser.parse_args()
+
+    db = obtener_db_compartida()
+    try:
+        db.generar_datos_tienda(args.escala, args.semilla, args.tamano_lote)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
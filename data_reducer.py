@@ -0,0 +1,137 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from chart_rules import _es_identificador
+from result_table import TablaResultados
+
+# Medidas que no se pueden sumar entre filas: precios, medias, tasas, mínimos y máximos
+_NO_ADITIVAS = re.compile(r"precio|media|medio|promedio|avg|mean|ratio|tasa|porcentaje|pct|"
+                          r"proporcion|^min|^max|_min$|_max$", re.IGNORECASE)
+
+
+def es_aditiva(col):
+    """Indica si la columna se puede sumar al agrupar filas (cantidades, importes, conteos)"""
+    return not _NO_ADITIVAS.search(str(col))
+
+
+def a_dataframe(columns, results):
+    """Convierte el resultado de una consulta en DataFrame con tipos nativos
+
+    Con una TablaResultados se reutilizan sus columnas ya convertidas; con una
+    lista de filas se envuelve en una. Decimal pasa a float y date a datetime64.
+    """
+    if not isinstance(results, TablaResultados):
+        results = TablaResultados(columns, results)
+    return results.a_dataframe()
+
+
+def lttb(x, y, n_salida):
+    """Índices elegidos por Largest-Triangle-Three-Buckets para reducir una serie a n_salida puntos"""
+    n = len(x)
+    if n_salida >= n or n_salida < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    indices = np.empty(n_salida, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    limites = np.linspace(1, n - 1, n_salida - 1).astype(int)
+    anterior = 0
+    for i in range(n_salida - 2):
+        inicio, fin = limites[i], limites[i + 1]
+        # Punto medio del siguiente bucket (o el último punto)
+        sig_inicio, sig_fin = fin, limites[i + 2] if i + 2 < len(limites) else n
+        media_x = x[sig_inicio:sig_fin].mean()
+        media_y = y[sig_inicio:sig_fin].mean()
+        areas = np.abs(
+            (x[anterior] - media_x) * (y[inicio:fin] - y[anterior])
+            - (x[anterior] - x[inicio:fin]) * (media_y - y[anterior])
+        )
+        anterior = inicio + int(np.argmax(areas))
+        indices[i + 1] = anterior
+    return indices
+
+
+def top_n_con_otros(df, col_categoria, cols_valor, n=15, etiqueta="Otros"):
+    """Agrupa por categoría, conserva las n mayores y suma el resto en una fila 'Otros'
+
+    Solo se suman las columnas aditivas; las demás (precios, medias...) se
+    promedian dentro de cada categoría y quedan vacías en 'Otros'. Se ordena
+    por la primera columna aditiva, o por la primera si no hay ninguna.
+    """
+    agregaciones = {col: "sum" if es_aditiva(col) else "mean" for col in cols_valor}
+    orden = next((col for col in cols_valor if es_aditiva(col)), cols_valor[0])
+    agrupado = df.groupby(col_categoria, sort=False, dropna=False).agg(agregaciones)
+    agrupado = agrupado.sort_values(orden, ascending=False)
+    if len(agrupado) <= n:
+        return agrupado.reset_index()
+    resto = pd.Series({col: agrupado[col].iloc[n:].sum() if es_aditiva(col) else np.nan
+                       for col in cols_valor}, name=etiqueta)
+    return pd.concat([agrupado.iloc[:n], resto.to_frame().T]).rename_axis(col_categoria).reset_index()
+
+
+def agrupar_en_bins(serie, bins=20):
+    """Histograma de una columna numérica como DataFrame (intervalo, frecuencia)"""
+    frecuencias, bordes = np.histogram(serie.dropna(), bins=bins)
+    etiquetas = [f"{bordes[i]:.4g} - {bordes[i + 1]:.4g}" for i in range(len(frecuencias))]
+    return pd.DataFrame({f"{serie.name}_intervalo": etiquetas, "frecuencia": frecuencias})
+
+
+def reducir(df, max_filas=200, max_categorias=15):
+    """Reduce el DataFrame a un tamaño apto para graficar; devuelve (df, descripción)"""
+    if len(df) <= max_filas:
+        return df, None
+
+    numericas = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
+    fechas = [c for c in df.columns if pd.api.types.is_datetime64_any_dtype(df[c])]
+    categoricas = [c for c in df.columns if c not in numericas and c not in fechas]
+    # Los identificadores numéricos no se suman ni sirven como serie
+    numericas = [c for c in numericas if not _es_identificador(c)]
+
+    if fechas and numericas:
+        ordenado = df.sort_values(fechas[0]).reset_index(drop=True)
+        x = ordenado[fechas[0]].astype("int64").to_numpy()
+        y = ordenado[numericas[0]].fillna(0).to_numpy()
+        indices = lttb(x, y, max_filas)
+        return ordenado.iloc[indices].reset_index(drop=True), \
+            f"serie temporal reducida con LTTB de {len(df)} a {len(indices)} puntos"
+
+    if categoricas and numericas:
+        reducido = top_n_con_otros(df, categoricas[0], numericas, n=max_categorias)
+        orden = next((c for c in numericas if es_aditiva(c)), numericas[0])
+        return reducido, \
+            f"top {max_categorias} de '{categoricas[0]}' por '{orden}' con el resto agrupado en 'Otros'"
+
+    if numericas and len(numericas) == 1:
+        reducido = agrupar_en_bins(df[numericas[0]], bins=min(max_filas, 30))
+        return reducido, f"histograma de '{numericas[0]}' en {len(reducido)} intervalos"
+
+    if categoricas:
+        conteo = df[categoricas[0]].value_counts(dropna=False)
+        reducido = conteo.iloc[:max_categorias].rename("cantidad").rename_axis(categoricas[0]).reset_index()
+        if len(conteo) > max_categorias:
+            otros = pd.DataFrame({categoricas[0]: ["Otros"], "cantidad": [conteo.iloc[max_categorias:].sum()]})
+            reducido = pd.concat([reducido, otros], ignore_index=True)
+        return reducido, f"conteo de '{categoricas[0]}' con las {max_categorias} categorías más frecuentes"
+
+    muestra = df.sample(n=max_filas, random_state=0).sort_index()
+    return muestra, f"muestra aleatoria de {max_filas} de {len(df)} filas"
+
+
+def perfil_columnas(df):
+    """Resumen compacto de cada columna para incluir en el prompt"""
+    perfil = []
+    for col in df.columns:
+        serie = df[col]
+        info = {"columna": col, "tipo": str(serie.dtype), "nulos": int(serie.isna().sum()),
+                "distintos": int(serie.nunique(dropna=True))}
+        if pd.api.types.is_numeric_dtype(serie) and not serie.dropna().empty:
+            info.update(min=round(float(serie.min()), 4), max=round(float(serie.max()), 4),
+                        media=round(float(serie.mean()), 4))
+        elif pd.api.types.is_datetime64_any_dtype(serie) and not serie.dropna().empty:
+            info.update(min=str(serie.min().date()), max=str(serie.max().date()))
+        else:
+            info["frecuentes"] = [str(v) for v in serie.value_counts().index[:5]]
+        perfil.append(info)
+    return perfil
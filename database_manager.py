@@ -1,7 +1,401 @@
-import psycopg2
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import ExitStack, contextmanager
+
+from dotenv import load_dotenv
+
+from index_advisor import proponer_indices
+from query_guard import ConsultaRechazada, GuardiaConsultas, es_explicable, plan_estimado
+from query_log import obtener_registro_consultas
+from replicas import EnrutadorReplicas, es_solo_lectura, replica_al_dia
+from result_cache import ResultCache, tablas_de_consulta, tamano_resultado, versiones_de_tablas
+from result_stream import ResultadoStream
+from rollups import ReescritorRollups, RefrescoPeriodico, crear_rollups, refrescar_rollups
+from schema_cache import SchemaCache, cache_esquemas
+from tracing import tracer
+
+
+# Columnas y claves foráneas de cada tabla del esquema public, agregadas en JSON
+CONSULTA_ESQUEMA = """
+    SELECT
+        c.relname,
+        json_agg(
+            json_build_array(
+                a.attname,
+                format_type(a.atttypid, NULL),
+                CASE WHEN a.attnotnull THEN 'NOT NULL' ELSE 'NULL' END
+            ) ORDER BY a.attnum
+        ) AS columns,
+        COALESCE((
+            SELECT json_agg(json_build_array(ka.attname, fc.relname, fa.attname)
+                            ORDER BY con.conname, k.ord)
+            FROM pg_constraint con
+            CROSS JOIN LATERAL unnest(con.conkey, con.confkey)
+                WITH ORDINALITY AS k(attnum, fattnum, ord)
+            JOIN pg_attribute ka ON ka.attrelid = con.conrelid AND ka.attnum = k.attnum
+            JOIN pg_class fc ON fc.oid = con.confrelid
+            JOIN pg_attribute fa ON fa.attrelid = con.confrelid AND fa.attnum = k.fattnum
+            WHERE con.conrelid = c.oid AND con.contype = 'f'
+        ), '[]'::json) AS foreign_keys
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p')
+    GROUP BY c.oid, c.relname
+    ORDER BY c.relname;
+"""
+
+# Hash de la definición de columnas y claves foráneas; cambia con cualquier DDL relevante
+CONSULTA_HUELLA_ESQUEMA = """
+    SELECT md5(COALESCE(string_agg(definicion, ',' ORDER BY definicion), ''))
+    FROM (
+        SELECT c.relname || '.' || a.attnum || '.' || a.attname || '.'
+               || a.atttypid || '.' || a.attnotnull AS definicion
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p')
+        UNION ALL
+        SELECT con.conrelid::regclass::text || '.' || con.conname || '.'
+               || con.confrelid::regclass::text || '.' || con.conkey::text || con.confkey::text
+        FROM pg_constraint con
+        JOIN pg_namespace n ON n.oid = con.connamespace
+        WHERE n.nspname = 'public' AND con.contype = 'f'
+    ) s;
+"""
+
+
+class PoolTimeoutError(Exception):
+    """No se pudo obtener una conexión del pool dentro del tiempo límite"""
+
+
+class ConnectionPool:
+    """Pool de conexiones thread-safe con health checks y expulsión de inactivas"""
+
+    def __init__(self, connection_params, minconn=1, maxconn=10, timeout=30.0,
+                 max_idle=300.0, health_check_interval=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Tamaño de pool inválido")
+        self.connection_params = connection_params
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+
+        self._lock = threading.Condition()
+        self._idle = []  # pila de (conexión, momento en que quedó libre)
+        self._in_use = set()
+        self._pending = 0  # conexiones que se están abriendo fuera del lock
+        self._closed = False
+        self.stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "evicted_idle": 0,
+            "discarded_broken": 0,
+        }
+
+        for _ in range(minconn):
+            self._idle.append((self._nueva_conexion(), time.monotonic()))
+
+    def _nueva_conexion(self):
+        import psycopg2
+
+        conn = psycopg2.connect(**self.connection_params)
+        conn.set_client_encoding('UTF8')
+        with self._lock:
+            self.stats["created"] += 1
+        return conn
+
+    def _total(self):
+        return len(self._idle) + len(self._in_use) + self._pending
+
+    def _conexion_valida(self, conn, idle_since):
+        """Comprueba que una conexión libre sigue siendo utilizable"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _expulsar_inactivas(self):
+        """Cierra las conexiones libres que superan max_idle, respetando minconn"""
+        ahora = time.monotonic()
+        conservadas = []
+        # Las más antiguas están al principio de la pila
+        sobrantes = self._total() - self.minconn
+        for conn, idle_since in self._idle:
+            if sobrantes > 0 and ahora - idle_since > self.max_idle:
+                conn.close()
+                sobrantes -= 1
+                self.stats["evicted_idle"] += 1
+            else:
+                conservadas.append((conn, idle_since))
+        self._idle = conservadas
+
+    def _reservar(self, timeout):
+        """Reserva una conexión libre o un hueco para abrir una nueva"""
+        limite = time.monotonic() + timeout
+        inicio_espera = None
+        with self._lock:
+            try:
+                while True:
+                    if self._closed:
+                        raise PoolTimeoutError("El pool está cerrado")
+                    self._expulsar_inactivas()
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        self._in_use.add(conn)
+                        return conn, idle_since
+                    if self._total() < self.maxconn:
+                        self._pending += 1
+                        return None, None
+                    if inicio_espera is None:
+                        inicio_espera = time.monotonic()
+                        self.stats["waits"] += 1
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self.stats["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            f"No hay conexiones libres tras {timeout} segundos"
+                        )
+                    self._lock.wait(restante)
+            finally:
+                if inicio_espera is not None:
+                    self.stats["wait_time"] += time.monotonic() - inicio_espera
+
+    def getconn(self, timeout=None):
+        """Obtiene una conexión del pool, esperando como máximo `timeout` segundos"""
+        timeout = self.timeout if timeout is None else timeout
+        while True:
+            conn, idle_since = self._reservar(timeout)
+            if conn is None:
+                # Abrir la conexión fuera del lock para no bloquear al resto de hilos
+                try:
+                    conn = self._nueva_conexion()
+                except Exception:
+                    with self._lock:
+                        self._pending -= 1
+                        self._lock.notify()
+                    raise
+                with self._lock:
+                    self._pending -= 1
+                    self._in_use.add(conn)
+                    self.stats["checkouts"] += 1
+                return conn
+
+            if self._conexion_valida(conn, idle_since):
+                with self._lock:
+                    self.stats["checkouts"] += 1
+                return conn
+
+            conn.close()
+            with self._lock:
+                self._in_use.discard(conn)
+                self.stats["discarded_broken"] += 1
+                self._lock.notify()
+
+    def putconn(self, conn, close=False):
+        """Devuelve una conexión al pool"""
+        import psycopg2.extensions
+
+        with self._lock:
+            self._in_use.discard(conn)
+            if not close and not self._closed and not conn.closed:
+                try:
+                    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except Exception:
+                    close = True
+            else:
+                close = True
+
+            if close or self._closed:
+                if not conn.closed:
+                    conn.close()
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager que presta una conexión y la devuelve al terminar"""
+        import psycopg2
+
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def closeall(self):
+        """Cierra todas las conexiones del pool"""
+        with self._lock:
+            self._closed = True
+            for conn, _ in self._idle:
+                conn.close()
+            for conn in self._in_use:
+                conn.close()
+            self._idle = []
+            self._in_use = set()
+            self._lock.notify_all()
+
+    def ocupadas(self):
+        """Número de conexiones prestadas en este momento"""
+        with self._lock:
+            return len(self._in_use) + self._pending
+
+    def estadisticas(self):
+        """Devuelve los contadores del pool junto con su ocupación actual"""
+        with self._lock:
+            return dict(self.stats, in_use=len(self._in_use), idle=len(self._idle),
+                        minconn=self.minconn, maxconn=self.maxconn)
+
+
+def cargar_config_bd():
+    """Lee la configuración de la base de datos desde el archivo .env"""
+    load_dotenv()
+    return {
+        "host": os.getenv("DB_HOST"),
+        "port": os.getenv("DB_PORT"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "database": os.getenv("DB_NAME")
+    }
+
+
+def cargar_config_pool():
+    """Lee el tamaño y los tiempos del pool desde variables de entorno"""
+    load_dotenv()
+    return {
+        "minconn": int(os.getenv("DB_POOL_MIN", "1")),
+        "maxconn": int(os.getenv("DB_POOL_MAX", "10")),
+        "timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "max_idle": float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+        "health_check_interval": float(os.getenv("DB_POOL_HEALTH_CHECK", "30")),
+    }
+
+
+_gestores_compartidos = {}
+_gestores_lock = threading.Lock()
+
+
+def cargar_config_limites():
+    """Lee los límites de lectura de resultados desde variables de entorno"""
+    load_dotenv()
+    return {
+        "max_filas": int(os.getenv("RESULT_MAX_ROWS", "100000")),
+        "max_bytes": int(float(os.getenv("RESULT_MAX_MB", "64")) * 1024 * 1024),
+        "tamano_lote": int(os.getenv("RESULT_BATCH_SIZE", "1000")),
+        "statement_timeout": int(os.getenv("SQL_STATEMENT_TIMEOUT_MS", "30000")),
+        "solo_lectura": os.getenv("SQL_SOLO_LECTURA", "1") == "1",
+    }
+
+
+def cargar_config_guardia():
+    """Lee los límites de coste estimado del SQL generado desde variables de entorno"""
+    load_dotenv()
+    return {
+        "max_coste": float(os.getenv("SQL_MAX_COSTE", "1000000")),
+        "max_filas": float(os.getenv("SQL_MAX_FILAS_ESTIMADAS", "1000000")),
+        "accion": os.getenv("SQL_ACCION_COSTE", "rechazar"),
+        "limite": int(os.getenv("SQL_LIMITE_AUTO", "1000")),
+    }
+
+
+def cargar_config_rollups():
+    """Lee la antigüedad máxima y los intervalos de refresco de los rollups desde variables de entorno"""
+    load_dotenv()
+    max_antiguedad = float(os.getenv("ROLLUP_MAX_ANTIGUEDAD", "3600"))
+    completo_cada = float(os.getenv("ROLLUP_COMPLETO_CADA", str(max_antiguedad / 2)))
+    if completo_cada >= max_antiguedad:
+        print(f"ROLLUP_COMPLETO_CADA ({completo_cada:g}s) no es menor que ROLLUP_MAX_ANTIGUEDAD "
+              f"({max_antiguedad:g}s): los rollups dejarán de usarse entre recálculos completos")
+    return {
+        "activos": os.getenv("ROLLUPS", "1") == "1",
+        "max_antiguedad": max_antiguedad,
+        "refresco": float(os.getenv("ROLLUP_REFRESCO", "0")),
+        "completo_cada": completo_cada,
+    }
+
+
+def cargar_config_replicas():
+    """Lee las réplicas de lectura (DB_REPLICAS=host[:puerto],...) y su política de reparto
+
+    Usuario, contraseña y base de datos son los del primario. Devuelve None
+    si no hay réplicas configuradas.
+    """
+    load_dotenv()
+    replicas = [r.strip() for r in os.getenv("DB_REPLICAS", "").split(",") if r.strip()]
+    if not replicas:
+        return None
+    return {
+        "endpoints": [(r.rsplit(":", 1)[0], r.rsplit(":", 1)[1]) if ":" in r else (r, os.getenv("DB_PORT"))
+                      for r in replicas],
+        "politica": os.getenv("DB_REPLICA_POLITICA", "round_robin"),
+        "max_retraso": float(os.getenv("DB_REPLICA_MAX_RETRASO", "30")),
+        "intervalo_retraso": float(os.getenv("DB_REPLICA_INTERVALO_RETRASO", "5")),
+        "reintento": float(os.getenv("DB_REPLICA_REINTENTO", "30")),
+        "espera": float(os.getenv("DB_REPLICA_ESPERA", "2")),
+        "max_silencio": float(os.getenv("DB_REPLICA_MAX_SILENCIO", "90")),
+    }
+
+
+def obtener_db_compartida(db_config=None, pool_config=None):
+    """Devuelve un DatabaseManager con pool compartido por todo el proceso"""
+    db_config = db_config or cargar_config_bd()
+    clave = tuple(sorted((k, str(v)) for k, v in db_config.items()))
+    with _gestores_lock:
+        db = _gestores_compartidos.get(clave)
+        if db is None or db.pool is None:
+            mb = float(os.getenv("RESULT_CACHE_MB", "64"))
+            rollups = cargar_config_rollups()
+            db = DatabaseManager(**db_config, pool_config=pool_config or cargar_config_pool(),
+                                 result_cache=ResultCache(int(mb * 1024 * 1024)) if mb > 0 else None,
+                                 guardia=GuardiaConsultas(**cargar_config_guardia()),
+                                 registro=obtener_registro_consultas(),
+                                 reescritor=(ReescritorRollups(rollups["max_antiguedad"])
+                                             if rollups["activos"] else None),
+                                 replicas=cargar_config_replicas(),
+                                 **cargar_config_limites())
+            db.connect()
+            if rollups["activos"] and rollups["refresco"] > 0:
+                db.refresco_rollups = RefrescoPeriodico(db, rollups["refresco"], rollups["completo_cada"])
+            _gestores_compartidos[clave] = db
+        return db
+
+
+def _cerrar_cursor(cur):
+    """Cierra un cursor ignorando errores de una transacción ya abortada"""
+    import psycopg2
+
+    try:
+        cur.close()
+    except psycopg2.Error:
+        pass
+
 
 class DatabaseManager:
-    def __init__(self, host, port, user, password, database):
+    def __init__(self, host, port, user, password, database, pool_config=None,
+                 result_cache=None, max_filas=None, max_bytes=None, tamano_lote=1000,
+                 guardia=None, statement_timeout=None, solo_lectura=False, registro=None,
+                 reescritor=None, replicas=None):
         self.connection_params = {
             "host": host,
             "port": port,
@@ -10,10 +404,45 @@ class DatabaseManager:
             "database": database
         }
         self.conn = None
+        # Con pool_config el gestor es thread-safe y cada operación toma
+        # prestada una conexión del pool en lugar de usar self.conn
+        self.pool_config = pool_config
+        self.pool = None
+        self.huella_esquema = None
+        # Caché opcional de resultados de consultas de solo lectura
+        self.result_cache = result_cache
+        # Límites por defecto de consultar_stream
+        self.max_filas = max_filas
+        self.max_bytes = max_bytes
+        self.tamano_lote = tamano_lote
+        # Revisión con EXPLAIN y límites de la transacción para el SQL generado
+        self.guardia = guardia
+        self.statement_timeout = statement_timeout
+        self.solo_lectura = solo_lectura
+        # Registro opcional de las consultas ejecutadas para el asesor de índices
+        self.registro = registro
+        # Reescritura opcional de agregados sobre ventas hacia los rollups
+        self.reescritor = reescritor
+        self.refresco_rollups = None
+        # Réplicas para las consultas de solo lectura (solo con pool): la
+        # configuración de cargar_config_replicas y el enrutador que se crea al conectar
+        self.config_replicas = replicas
+        self.replicas = None
+        # id_consulta -> conexión que la ejecuta, para poder cancelarla desde otro hilo
+        self._en_curso = {}
+        self._lock_en_curso = threading.Lock()
 
     def connect(self):
         """Establece la conexión con la base de datos"""
+        import psycopg2
+
         try:
+            if self.pool_config is not None:
+                self.pool = ConnectionPool(self.connection_params, **self.pool_config)
+                print("Pool de conexiones creado exitosamente")
+                if self.config_replicas:
+                    self.replicas = self._crear_enrutador_replicas()
+                return
             self.conn = psycopg2.connect(**self.connection_params)
             self.conn.set_client_encoding('UTF8')
             print("Conexión establecida exitosamente")
@@ -21,10 +450,95 @@ class DatabaseManager:
             print(f"Error al conectar a la base de datos: {e}")
             raise
 
+    def _crear_enrutador_replicas(self):
+        config = dict(self.config_replicas)
+        pools = {}
+        for host, port in config.pop("endpoints"):
+            # Sin conexiones iniciales: una réplica caída no impide arrancar
+            pools[f"{host}:{port}"] = ConnectionPool(dict(self.connection_params, host=host, port=port),
+                                                     **dict(self.pool_config, minconn=0))
+        print(f"Réplicas de lectura: {', '.join(pools)} ({config['politica']})")
+        return EnrutadorReplicas(pools, **config)
+
+    @contextmanager
+    def _conexion(self):
+        """Presta la conexión a usar: una del pool o la conexión directa"""
+        import psycopg2.extensions
+
+        if self.pool is not None:
+            with self.pool.connection() as conn:
+                yield conn
+        else:
+            try:
+                yield self.conn
+            finally:
+                # Como hace el pool: no dejar transacciones abiertas (ni SET LOCAL) entre operaciones
+                if (not self.conn.closed and self.conn.get_transaction_status()
+                        != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                    self.conn.rollback()
+
+    @contextmanager
+    def _conexion_lectura(self, query):
+        """Presta (conexión, réplica) para una consulta: una réplica si es de solo
+        lectura y hay alguna disponible, o el primario con réplica None"""
+        if self.replicas is not None and es_solo_lectura(query):
+            with self.replicas.conexion() as (conn, replica):
+                if conn is not None:
+                    yield conn, replica
+                    return
+        with self._conexion() as conn:
+            yield conn, None
+
+    def _preparar_transaccion(self, cur):
+        """Aplica el modo de solo lectura y el statement_timeout a la transacción actual"""
+        if self.solo_lectura:
+            cur.execute("SET TRANSACTION READ ONLY")
+        if self.statement_timeout:
+            cur.execute("SET LOCAL statement_timeout = %s", (int(self.statement_timeout),))
+
+    def _revisar(self, cur, query, span):
+        """Pasa la consulta por la guardia de coste
+
+        Devuelve (consulta, límite de filas o None, plan estimado o None).
+        """
+        if self.guardia is not None:
+            return self.guardia.revisar(cur, query, span)
+        # Sin guardia, el plan solo se pide si hay que registrarlo
+        if self.registro is not None and es_explicable(query):
+            return query, None, plan_estimado(cur, query)
+        return query, None, None
+
+    def _registrar_en_curso(self, id_consulta, conn):
+        with self._lock_en_curso:
+            self._en_curso[id_consulta] = conn
+
+    def _desregistrar_en_curso(self, id_consulta):
+        with self._lock_en_curso:
+            self._en_curso.pop(id_consulta, None)
+
+    def cancelar_consulta(self, id_consulta):
+        """Cancela en el servidor la consulta con ese id; devuelve False si ya no está en curso"""
+        with self._lock_en_curso:
+            conn = self._en_curso.get(id_consulta)
+        if conn is None or conn.closed:
+            return False
+        # PQcancel es seguro desde otro hilo: la consulta falla con QueryCanceled
+        conn.cancel()
+        print(f"Consulta {id_consulta} cancelada")
+        return True
+
+    def estadisticas_pool(self):
+        """Devuelve los contadores del pool, o None si no se usa pool"""
+        return self.pool.estadisticas() if self.pool is not None else None
+
     def crear_esquema_tienda(self):
         """Crea el esquema de la tienda con datos de ejemplo"""
+        with self._conexion() as conn:
+            self._crear_esquema_tienda(conn)
+
+    def _crear_esquema_tienda(self, conn):
         try:
-            with self.conn.cursor() as cur:
+            with conn.cursor() as cur:
                 cur.execute("SET client_encoding TO 'UTF8';")
                 
                 # Borrar tablas si existen
@@ -93,88 +607,296 @@ class DatabaseManager:
                     (3, 5, 1, '2024-01-17', 39.99);
                 """)
                 
-            self.conn.commit()
+            conn.commit()
+            cache_esquemas.invalidar(SchemaCache.clave(self.connection_params))
             print("Esquema de tienda creado exitosamente")
         except Exception as e:
             print(f"Error creando el esquema: {e}")
-            self.conn.rollback()
+            conn.rollback()
             raise
 
-    def obtener_esquema_bd(self):
+    def generar_datos_tienda(self, escala=1, semilla=42, tamano_lote=100_000):
+        """Recrea el esquema de la tienda con datos sintéticos a escala (ver data_generator)"""
+        # numpy solo hace falta para generar datos, no para consultar
+        from data_generator import cargar_tienda
+
+        with self._conexion() as conn:
+            filas = cargar_tienda(conn, escala, semilla, tamano_lote)
+        cache_esquemas.invalidar(SchemaCache.clave(self.connection_params))
+        return filas
+
+    def proponer_indices(self, max_indices=5, min_mejora=0.01, indices_reales=False, desde=None):
+        """Propone índices para la carga de trabajo registrada (ver index_advisor)"""
+        if self.registro is None:
+            raise ValueError("El registro de consultas está desactivado (QUERY_LOG=0)")
+        carga = self.registro.carga_de_trabajo(desde)
+        esquema = self.obtener_esquema_bd()
+        with self._conexion() as conn:
+            return proponer_indices(conn, esquema, carga, max_indices=max_indices,
+                                    min_mejora=min_mejora, indices_reales=indices_reales,
+                                    statement_timeout=self.statement_timeout)
+
+    def crear_rollups(self):
+        """Crea las tablas de los rollups de ventas si no existen (ver rollups)"""
+        with self._conexion() as conn:
+            crear_rollups(conn)
+
+    def refrescar_rollups(self, completo=False, completo_cada=1800):
+        """Refresca los rollups, de forma incremental salvo que haga falta recalcularlos"""
+        with self._conexion() as conn:
+            modos = refrescar_rollups(conn, completo, completo_cada)
+        if self.reescritor is not None:
+            self.reescritor.invalidar()
+        return modos
+
+    def obtener_huella_esquema(self):
+        """Calcula una huella barata de las tablas, columnas y claves foráneas"""
+        with self._conexion() as conn, conn.cursor() as cur:
+            cur.execute(CONSULTA_HUELLA_ESQUEMA)
+            return cur.fetchone()[0]
+
+    def obtener_esquema_bd(self, usar_cache=True):
         """Obtiene la estructura del esquema de la base de datos"""
-        try:
-            schema = {}
-            with self.conn.cursor() as cur:
-                # Obtener todas las tablas
-                cur.execute("""
-                    SELECT table_name 
-                    FROM information_schema.tables 
-                    WHERE table_schema = 'public'
-                    AND table_type = 'BASE TABLE';
-                """)
-                tables = cur.fetchall()
-                
-                for table in tables:
-                    table_name = table[0]
-                    cur.execute("""
-                        SELECT 
-                            column_name,
-                            data_type,
-                            CASE WHEN is_nullable = 'YES' THEN 'NULL' ELSE 'NOT NULL' END as nullable
-                        FROM information_schema.columns
-                        WHERE table_name = %s
-                        ORDER BY ordinal_position;
-                    """, (table_name,))
-                    columns = cur.fetchall()
-                    
-                    cur.execute("""
-                        SELECT
-                            kcu.column_name,
-                            ccu.table_name AS foreign_table_name,
-                            ccu.column_name AS foreign_column_name
-                        FROM information_schema.table_constraints AS tc
-                        JOIN information_schema.key_column_usage AS kcu
-                            ON tc.constraint_name = kcu.constraint_name
-                        JOIN information_schema.constraint_column_usage AS ccu
-                            ON ccu.constraint_name = tc.constraint_name
-                        WHERE tc.constraint_type = 'FOREIGN KEY'
-                            AND tc.table_name = %s;
-                    """, (table_name,))
-                    foreign_keys = cur.fetchall()
-                    
-                    schema[table_name] = {
-                        'columns': columns,
-                        'foreign_keys': foreign_keys
-                    }
-            
-            return schema
-        except Exception as e:
-            print(f"Error al obtener el esquema: {e}")
-            raise
+        with tracer.span("obtener_esquema_bd") as span:
+            try:
+                clave = SchemaCache.clave(self.connection_params)
+                if usar_cache:
+                    reciente = cache_esquemas.reciente(clave)
+                    if reciente:
+                        self.huella_esquema = reciente[0]
+                        span.registrar(cache="memoria", tablas=len(reciente[1]))
+                        return reciente[1]
+
+                huella = self.obtener_huella_esquema()
+                self.huella_esquema = huella
+                if usar_cache:
+                    schema = cache_esquemas.obtener(clave, huella)
+                    if schema is not None:
+                        span.registrar(cache="huella", tablas=len(schema))
+                        return schema
+
+                schema = {}
+                with self._conexion() as conn, conn.cursor() as cur:
+                    # Tablas, columnas y claves foráneas en una sola consulta al catálogo
+                    cur.execute(CONSULTA_ESQUEMA)
+                    for table_name, columns, foreign_keys in cur.fetchall():
+                        schema[table_name] = {
+                            'columns': [tuple(col) for col in columns],
+                            'foreign_keys': [tuple(fk) for fk in foreign_keys]
+                        }
+
+                cache_esquemas.guardar(clave, huella, schema)
+                span.registrar(cache="no", tablas=len(schema))
+                return schema
+            except Exception as e:
+                print(f"Error al obtener el esquema: {e}")
+                raise
+
+    def _cache_y_reescritura(self, cur, replica, query, usar_cache, span):
+        """Busca el resultado en la caché y, si no está, reescribe la consulta hacia un rollup
+
+        Devuelve (versiones para guardar el resultado o None, resultado
+        cacheado o None, consulta a ejecutar). Los contadores de pg_stat de una
+        réplica no cuentan las escrituras replicadas, así que con una réplica
+        las versiones y el estado de los rollups se leen en el primario, y el
+        resultado solo se guarda si la réplica ya aplicó el WAL hasta ese punto.
+        """
+        if replica is None or (self.result_cache is None and self.reescritor is None):
+            versiones, cacheado = self._buscar_en_cache(cur, query, usar_cache)
+            if cacheado is None and self.reescritor is not None:
+                query = self.reescritor.reescribir(cur, query, span)
+            return versiones, cacheado, query
 
-    def ejecutar_consulta(self, query):
-        """Ejecuta una consulta SQL y devuelve los resultados"""
+        with self._conexion() as primario, primario.cursor() as cur_primario:
+            versiones, cacheado = self._buscar_en_cache(cur_primario, query, usar_cache)
+            if cacheado is not None:
+                return versiones, cacheado, query
+            if self.reescritor is not None:
+                query = self.reescritor.reescribir(cur_primario, query, span)
+            if versiones:
+                cur_primario.execute("SELECT pg_current_wal_lsn()")
+                posicion = cur_primario.fetchone()[0]
+        if versiones and not replica_al_dia(cur, posicion):
+            versiones = None
+        return versiones, None, query
+
+    def _buscar_en_cache(self, cur, query, usar_cache):
+        """Devuelve (versiones de las tablas, resultado cacheado o None)"""
+        if not usar_cache or self.result_cache is None:
+            return None, None
+        # Las versiones se leen antes de ejecutar: si una tabla cambia
+        # mientras tanto, la entrada guardada ya nace invalidada
+        tablas = tablas_de_consulta(query)
+        versiones = versiones_de_tablas(cur, tablas) if tablas else None
+        if not versiones:
+            return None, None
+        return versiones, self.result_cache.obtener(query, versiones)
+
+    def ejecutar_consulta(self, query, usar_cache=True, id_consulta=None):
+        """Ejecuta una consulta SQL y devuelve los resultados
+
+        Con id_consulta, la ejecución se puede interrumpir con cancelar_consulta.
+        """
+        with tracer.span("ejecutar_consulta", modo="completo") as span:
+            return self._ejecutar_consulta(query, usar_cache, id_consulta, span)
+
+    def _ejecutar_consulta(self, query, usar_cache, id_consulta, span):
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(query)
+            with ExitStack() as recursos:
+                conn, replica = recursos.enter_context(self._conexion_lectura(query))
+                if replica is not None:
+                    span.registrar(replica=replica)
+                if id_consulta is not None:
+                    self._registrar_en_curso(id_consulta, conn)
+                    recursos.callback(self._desregistrar_en_curso, id_consulta)
+                cur = recursos.enter_context(conn.cursor())
+                self._preparar_transaccion(cur)
+                versiones, cacheado, revisada = self._cache_y_reescritura(cur, replica, query,
+                                                                           usar_cache, span)
+                if cacheado is not None:
+                    columns, results = cacheado
+                    span.registrar(cache="hit", filas=len(results),
+                                   bytes=tamano_resultado(columns, results))
+                    if not results:
+                        return columns, [["No se encontraron resultados"]]
+                    return columns, results
+
+                ejecutar, limite, plan = self._revisar(cur, revisada, span)
+                inicio = time.perf_counter()
+                cur.execute(ejecutar)
                 
                 if cur.description is None:
+                    span.registrar(filas_afectadas=cur.rowcount)
+                    if self.registro is not None:
+                        self.registro.registrar(ejecutar, time.perf_counter() - inicio,
+                                                cur.rowcount, plan)
                     return ["Affected rows"], [cur.rowcount]
                 
                 columns = [desc[0] for desc in cur.description]
                 results = cur.fetchall()
+                if self.registro is not None:
+                    self.registro.registrar(ejecutar, time.perf_counter() - inicio, len(results), plan)
+                span.registrar(filas=len(results), bytes=tamano_resultado(columns, results))
+                if limite is not None and len(results) > limite:
+                    # Resultado recortado por la guardia: no es el resultado completo
+                    results, versiones = results[:limite], None
+                if versiones:
+                    self.result_cache.guardar(query, versiones, columns, results,
+                                              time.perf_counter() - inicio)
                 
                 if not results:
                     return columns, [["No se encontraron resultados"]]
                 
                 return columns, results
                 
+        except ConsultaRechazada as e:
+            print(f"Consulta rechazada: {e.motivo}")
+            return ["Error"], [[f"Consulta rechazada: {e.motivo}"]]
         except Exception as e:
             print(f"Error al ejecutar la consulta: {e}")
+            span.registrar(error_sql=str(e))
             return ["Error"], [[str(e)]]
 
+    def consultar_stream(self, query, tamano_lote=None, max_filas=None, max_bytes=None,
+                         usar_cache=True, id_consulta=None):
+        """Ejecuta una consulta con un cursor de servidor y devuelve un ResultadoStream
+
+        Las filas se leen por lotes con fetchmany en lugar de materializar todo
+        el resultado. Las sentencias que no son de lectura se ejecutan con
+        ejecutar_consulta. Si la guardia rechaza la consulta, el stream contiene
+        el error y la excepción queda en `stream.rechazo`.
+        """
+        tamano_lote = tamano_lote or self.tamano_lote
+        max_filas = self.max_filas if max_filas is None else max_filas
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+
+        if not re.match(r"\s*(select|with|values|table)\b", query, re.IGNORECASE):
+            return ResultadoStream.desde_lista(*self.ejecutar_consulta(query, usar_cache, id_consulta))
+
+        # El span termina cuando se cierra el stream, no al devolverlo
+        span = tracer.iniciar("ejecutar_consulta", modo="stream")
+        recursos = ExitStack()
+        try:
+            conn, replica = recursos.enter_context(self._conexion_lectura(query))
+            if replica is not None:
+                span.registrar(replica=replica)
+            if id_consulta is not None:
+                self._registrar_en_curso(id_consulta, conn)
+                recursos.callback(self._desregistrar_en_curso, id_consulta)
+            with conn.cursor() as cur:
+                self._preparar_transaccion(cur)
+                versiones, cacheado, revisada = self._cache_y_reescritura(cur, replica, query,
+                                                                           usar_cache, span)
+                if cacheado is None:
+                    ejecutar, limite, plan = self._revisar(cur, revisada, span)
+            if cacheado is not None:
+                recursos.close()
+                span.registrar(cache="hit", filas=len(cacheado[1]),
+                               bytes=tamano_resultado(*cacheado))
+                span.terminar()
+                return ResultadoStream.desde_lista(*cacheado)
+
+            # El cursor con nombre vive en el servidor hasta que se cierra el stream
+            cur = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+            cur.itersize = tamano_lote
+            recursos.callback(_cerrar_cursor, cur)
+            inicio = time.perf_counter()
+            cur.execute(ejecutar)
+            if limite is not None:
+                max_filas = limite if max_filas is None else min(max_filas, limite)
+
+            al_completar = None
+            if versiones:
+                def al_completar(columns, results):
+                    self.result_cache.guardar(query, versiones, columns, results,
+                                              time.perf_counter() - inicio)
+
+            def al_cerrar():
+                recursos.close()
+                # La duración incluye el tiempo que el consumidor tarda en leer el stream
+                if self.registro is not None:
+                    self.registro.registrar(ejecutar, time.perf_counter() - inicio, stream.filas, plan)
+                span.registrar(filas=stream.filas, bytes=stream.bytes, truncado=stream.truncado)
+                span.terminar()
+
+            stream = ResultadoStream(cur, tamano_lote=tamano_lote, max_filas=max_filas,
+                                     max_bytes=max_bytes, al_cerrar=al_cerrar,
+                                     al_completar=al_completar)
+            return stream
+        except ConsultaRechazada as e:
+            recursos.close()
+            print(f"Consulta rechazada: {e.motivo}")
+            span.terminar()
+            stream = ResultadoStream.desde_lista(["Error"], [[f"Consulta rechazada: {e.motivo}"]])
+            stream.rechazo = e
+            return stream
+        except Exception as e:
+            recursos.close()
+            print(f"Error al ejecutar la consulta: {e}")
+            span.registrar(error_sql=str(e))
+            span.terminar()
+            return ResultadoStream.desde_lista(["Error"], [[str(e)]])
+
+    def estadisticas_replicas(self):
+        """Devuelve el reparto y el estado de las réplicas, o None si no hay réplicas"""
+        return self.replicas.estadisticas() if self.replicas is not None else None
+
+    def estadisticas_cache_resultados(self):
+        """Devuelve los contadores de la caché de resultados, o None si no se usa"""
+        return self.result_cache.estadisticas() if self.result_cache is not None else None
+
     def close(self):
         """Cierra la conexión con la base de datos"""
+        if self.refresco_rollups is not None:
+            self.refresco_rollups.parar()
+            self.refresco_rollups = None
+        if self.replicas is not None:
+            self.replicas.closeall()
+            self.replicas = None
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+            print("Pool de conexiones cerrado")
         if self.conn:
             self.conn.close()
             print("Conexión cerrada")
\ No newline at end of file
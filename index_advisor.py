@@ -0,0 +1,357 @@
+"""Asesor de índices a partir de la carga de trabajo registrada
+
+Lee las consultas guardadas por query_log y extrae de sus planes las
+columnas de los filtros, de las condiciones de join y de las ordenaciones y
+agrupaciones. Con ellas propone índices candidatos que no estén cubiertos ya
+por un índice existente y estima su beneficio comparando el coste de EXPLAIN
+de la carga con y sin el índice:
+
+- con índices hipotéticos de HypoPG si la extensión está instalada
+  (CREATE EXTENSION hypopg), sin construir nada;
+- con --indices-reales, construyendo cada índice dentro de una transacción
+  que se deshace. Mientras dura el análisis las tablas quedan bloqueadas
+  para escritura, así que solo conviene en una base de datos de pruebas.
+
+Los índices se eligen de forma voraz: cada ronda añade el candidato que más
+reduce el coste total de la carga, ponderado por el número de ejecuciones,
+evaluado junto con los ya elegidos.
+
+Uso:
+    python index_advisor.py [--max-indices 5] [--min-mejora 0.01] [--horas 24] [--indices-reales]
+"""
+import argparse
+import re
+import time
+
+from query_guard import plan_estimado
+
+# Columnas de cada índice completo (sin predicado) de las tablas del esquema public
+CONSULTA_INDICES = """
+    SELECT t.relname, array_agg(a.attname ORDER BY k.orden)
+    FROM pg_index i
+    JOIN pg_class t ON t.oid = i.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, orden)
+    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+    WHERE n.nspname = 'public' AND i.indpred IS NULL
+    GROUP BY i.indexrelid, t.relname;
+"""
+
+# Un literal con su conversión de tipo opcional: '2024-01-01'::date
+_LITERAL = re.compile(r"'(?:[^']|'')*'(?:::\w+(?:\[\])?)?")
+# Columna, calificada o no, que no es una llamada a función
+_REFERENCIA = re.compile(r"(?<![\w.:])(?:(\w+)\.)?([A-Za-z_]\w*)\b(?!\s*[(.])")
+_OPERADOR_DESPUES = re.compile(r"(<>|!=|<=|>=|=|<|>|~~\*?)")
+_OPERADOR_ANTES = re.compile(r"(<>|!=|<=|>=|=|<|>)$")
+_CLAVE_ORDEN = re.compile(r"(?:(\w+)\.)?(\w+)(?:\s+(?:ASC|DESC))?(?:\s+NULLS\s+(?:FIRST|LAST))?")
+
+CONDICIONES_JOIN = ("Hash Cond", "Merge Cond", "Join Filter")
+CLAVES_ORDEN = ("Sort Key", "Group Key")
+
+
+def _nodos(plan):
+    yield plan
+    for hijo in plan.get("Plans", ()):
+        yield from _nodos(hijo)
+
+
+def _limpiar(expresion):
+    return _LITERAL.sub("?", expresion).replace('"', "")
+
+
+def _resolver(alias, columna, relaciones, por_defecto, columnas):
+    """Tabla a la que pertenece la columna, o None si no se puede saber"""
+    if alias:
+        tabla = relaciones.get(alias)
+        return tabla if columna in columnas.get(tabla, ()) else None
+    if por_defecto and columna in columnas.get(por_defecto, ()):
+        return por_defecto
+    posibles = {tabla for tabla in relaciones.values() if columna in columnas.get(tabla, ())}
+    return posibles.pop() if len(posibles) == 1 else None
+
+
+def _comparacion(texto, inicio, fin):
+    """Tipo de comparación en la que aparece la columna: igualdad, rango o None
+
+    None cuando un índice b-tree sobre la columna no serviría (<>, ILIKE,
+    funciones o conversiones aplicadas a la columna).
+    """
+    despues = _OPERADOR_DESPUES.match(texto[fin:].lstrip())
+    antes = _OPERADOR_ANTES.search(texto[:inicio].rstrip())
+    operador = despues.group(1) if despues else antes.group(1) if antes else None
+    if operador is None or operador in ("<>", "!=", "~~*"):
+        return None
+    return "igualdad" if operador == "=" else "rango"
+
+
+def analizar_plan(plan, columnas):
+    """Devuelve {tabla: {"igualdad", "rango", "union", "orden": [columnas]}} usadas por el plan"""
+    nodos = list(_nodos(plan))
+    relaciones = {nodo.get("Alias", nodo["Relation Name"]): nodo["Relation Name"]
+                  for nodo in nodos if "Relation Name" in nodo}
+    usos = {}
+
+    def anotar(tabla, tipo, columna):
+        if tabla is None:
+            return
+        uso = usos.setdefault(tabla, {"igualdad": [], "rango": [], "union": [], "orden": []})
+        if columna not in uso[tipo]:
+            uso[tipo].append(columna)
+
+    for nodo in nodos:
+        por_defecto = nodo.get("Relation Name")
+        for clave in ("Filter",) + CONDICIONES_JOIN:
+            if clave not in nodo:
+                continue
+            texto = _limpiar(nodo[clave])
+            for m in _REFERENCIA.finditer(texto):
+                tipo = _comparacion(texto, m.start(), m.end())
+                if tipo is None:
+                    continue
+                if clave in CONDICIONES_JOIN:
+                    tipo = "union"
+                anotar(_resolver(m.group(1), m.group(2), relaciones, por_defecto, columnas),
+                       tipo, m.group(2))
+        for clave in CLAVES_ORDEN:
+            for expresion in nodo.get(clave, ()):
+                m = _CLAVE_ORDEN.fullmatch(_limpiar(expresion).strip())
+                if m:
+                    anotar(_resolver(m.group(1), m.group(2), relaciones, None, columnas),
+                           "orden", m.group(2))
+    return usos
+
+
+def candidatos_de_usos(usos):
+    """Índices de una columna y compuestos (igualdad o join primero, luego rango u orden)"""
+    for tabla, uso in usos.items():
+        todas = dict.fromkeys(uso["igualdad"] + uso["rango"] + uso["union"] + uso["orden"])
+        for columna in todas:
+            yield tabla, (columna,)
+        for primera in dict.fromkeys(uso["igualdad"] + uso["union"]):
+            for segunda in dict.fromkeys(uso["rango"] + uso["orden"] + uso["igualdad"]):
+                if segunda != primera:
+                    yield tabla, (primera, segunda)
+
+
+def indices_existentes(cur):
+    cur.execute(CONSULTA_INDICES)
+    existentes = {}
+    for tabla, columnas in cur.fetchall():
+        existentes.setdefault(tabla, []).append(tuple(columnas))
+    return existentes
+
+
+def _cubierto(candidato, existentes):
+    """Un índice existente que empieza por las mismas columnas ya sirve para lo mismo"""
+    tabla, columnas = candidato
+    return any(indice[:len(columnas)] == columnas for indice in existentes.get(tabla, ()))
+
+
+def _identificador(nombre):
+    if re.fullmatch(r"[a-z_][a-z0-9_]*", nombre):
+        return nombre
+    return '"' + nombre.replace('"', '""') + '"'
+
+
+def nombre_indice(tabla, columnas):
+    # Postgres trunca los identificadores a 63 bytes
+    return f"idx_{tabla}_{'_'.join(columnas)}"[:63]
+
+
+def ddl_indice(tabla, columnas, nombre=None, concurrente=False):
+    opciones = " CONCURRENTLY IF NOT EXISTS" if concurrente else ""
+    nombre = f" {_identificador(nombre)}" if nombre else ""
+    lista = ", ".join(_identificador(columna) for columna in columnas)
+    return f"CREATE INDEX{opciones}{nombre} ON {_identificador(tabla)} ({lista})"
+
+
+class _IndicesHipoteticos:
+    """Índices de HypoPG: solo existen en la sesión y el planificador los ve sin construirlos"""
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def crear(self, tabla, columnas):
+        self.cur.execute("SELECT indexrelid FROM hypopg_create_index(%s)", (ddl_indice(tabla, columnas),))
+        return self.cur.fetchone()[0]
+
+    def eliminar(self, indice):
+        self.cur.execute("SELECT hypopg_drop_index(%s)", (indice,))
+
+    def cerrar(self):
+        # Se llama tras el ROLLBACK: los índices hipotéticos no son transaccionales
+        with self.cur.connection.cursor() as cur:
+            cur.execute("SELECT hypopg_reset()")
+
+
+class _IndicesReales:
+    """Índices construidos dentro de la transacción y deshechos con ROLLBACK TO SAVEPOINT"""
+
+    def __init__(self, cur):
+        self.cur = cur
+        self._creados = 0
+
+    def crear(self, tabla, columnas):
+        self._creados += 1
+        punto = f"asesor_indice_{self._creados}"
+        self.cur.execute(f"SAVEPOINT {punto}")
+        self.cur.execute(ddl_indice(tabla, columnas, nombre=punto))
+        return punto
+
+    def eliminar(self, punto):
+        self.cur.execute(f"ROLLBACK TO SAVEPOINT {punto}")
+
+    def cerrar(self):
+        # El ROLLBACK final de proponer_indices elimina los que quedan
+        pass
+
+
+def hypopg_disponible(cur):
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'hypopg'")
+    return cur.fetchone() is not None
+
+
+def _coste(cur, query):
+    """Coste estimado de la consulta, o None si ya no se puede planificar (el esquema cambió)"""
+    import psycopg2
+
+    cur.execute("SAVEPOINT asesor_explain")
+    try:
+        coste = plan_estimado(cur, query)["Total Cost"]
+    except psycopg2.Error:
+        cur.execute("ROLLBACK TO SAVEPOINT asesor_explain")
+        return None
+    cur.execute("RELEASE SAVEPOINT asesor_explain")
+    return coste
+
+
+def _coste_carga(consultas, costes):
+    return sum(consulta["veces"] * costes[consulta["huella"]] for consulta in consultas)
+
+
+def proponer_indices(conn, esquema, carga, max_indices=5, min_mejora=0.01,
+                     indices_reales=False, statement_timeout=None):
+    """Propone índices para la carga de trabajo; devuelve una lista de propuestas con su DDL
+
+    `carga` es el resultado de RegistroConsultas.carga_de_trabajo. Un índice
+    solo se propone si reduce el coste estimado de la carga al menos en
+    `min_mejora` (fracción del coste total).
+    """
+    columnas = {tabla: {columna[0] for columna in info["columns"]} for tabla, info in esquema.items()}
+    consultas = []
+    candidatos = {}  # (tabla, columnas) -> huellas de las consultas que lo sugieren
+    for entrada in carga:
+        if not entrada["plan"]:
+            continue
+        usos = analizar_plan(entrada["plan"], columnas)
+        if not usos:
+            continue
+        consultas.append(dict(entrada, tablas=set(usos)))
+        for candidato in candidatos_de_usos(usos):
+            candidatos.setdefault(candidato, set()).add(entrada["huella"])
+
+    propuestas = []
+    simulador = None
+    try:
+        with conn.cursor() as cur:
+            if statement_timeout:
+                cur.execute("SET LOCAL statement_timeout = %s", (int(statement_timeout),))
+            existentes = indices_existentes(cur)
+            candidatos = {c: huellas for c, huellas in candidatos.items() if not _cubierto(c, existentes)}
+            if not candidatos:
+                return propuestas
+
+            if hypopg_disponible(cur):
+                simulador = _IndicesHipoteticos(cur)
+            elif indices_reales:
+                simulador = _IndicesReales(cur)
+            else:
+                raise RuntimeError("Instala la extensión hypopg (CREATE EXTENSION hypopg) "
+                                   "o usa indices_reales=True en una base de datos de pruebas")
+
+            actuales = {consulta["huella"]: _coste(cur, consulta["query"]) for consulta in consultas}
+            consultas = [consulta for consulta in consultas if actuales[consulta["huella"]]]
+            coste_base = _coste_carga(consultas, actuales)
+
+            while candidatos and len(propuestas) < max_indices:
+                mejor = None
+                for candidato in candidatos:
+                    afectadas = [consulta for consulta in consultas if candidato[0] in consulta["tablas"]]
+                    indice = simulador.crear(*candidato)
+                    try:
+                        nuevos = {}
+                        for consulta in afectadas:
+                            coste = _coste(cur, consulta["query"])
+                            nuevos[consulta["huella"]] = actuales[consulta["huella"]] if coste is None else coste
+                    finally:
+                        simulador.eliminar(indice)
+                    mejora = sum(consulta["veces"] * (actuales[consulta["huella"]] - nuevos[consulta["huella"]])
+                                 for consulta in afectadas)
+                    if mejor is None or mejora > mejor[1]:
+                        mejor = (candidato, mejora, afectadas, nuevos)
+
+                candidato, mejora, afectadas, nuevos = mejor
+                if mejora <= 0 or mejora < min_mejora * _coste_carga(consultas, actuales):
+                    break
+                # El índice elegido se queda para evaluar los siguientes junto a él
+                simulador.crear(*candidato)
+                # El tiempo registrado se reparte en proporción a la reducción de coste
+                segundos = sum(consulta["duracion_total"] * (1 - nuevos[consulta["huella"]]
+                                                             / actuales[consulta["huella"]])
+                               for consulta in afectadas
+                               if nuevos[consulta["huella"]] < actuales[consulta["huella"]])
+                actuales.update(nuevos)
+                tabla, columnas_indice = candidato
+                propuestas.append({
+                    "tabla": tabla,
+                    "columnas": list(columnas_indice),
+                    "mejora_coste": mejora,
+                    "mejora_relativa": mejora / coste_base if coste_base else 0.0,
+                    "segundos_ahorrados": segundos,
+                    "consultas": len(candidatos[candidato]),
+                    "ddl": ddl_indice(tabla, columnas_indice, nombre_indice(tabla, columnas_indice),
+                                      concurrente=True) + ";",
+                })
+                del candidatos[candidato]
+        return propuestas
+    finally:
+        conn.rollback()
+        if simulador is not None:
+            simulador.cerrar()
+            conn.rollback()
+
+
+def main():
+    from database_manager import obtener_db_compartida
+
+    parser = argparse.ArgumentParser(description="Propone índices para las consultas registradas")
+    parser.add_argument("--max-indices", type=int, default=5)
+    parser.add_argument("--min-mejora", type=float, default=0.01,
+                        help="reducción mínima del coste total de la carga (fracción)")
+    parser.add_argument("--horas", type=float, help="analizar solo las últimas N horas")
+    parser.add_argument("--indices-reales", action="store_true",
+                        help="sin hypopg, construir los índices en una transacción que se deshace")
+    args = parser.parse_args()
+
+    desde = time.time() - args.horas * 3600 if args.horas else None
+    db = obtener_db_compartida()
+    try:
+        propuestas = db.proponer_indices(args.max_indices, args.min_mejora, args.indices_reales, desde)
+    except (RuntimeError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+    finally:
+        db.close()
+
+    if not propuestas:
+        print("-- No hay índices que mejoren la carga registrada")
+    for propuesta in propuestas:
+        print(f"-- {propuesta['tabla']} ({', '.join(propuesta['columnas'])}): "
+              f"-{propuesta['mejora_relativa']:.1%} del coste estimado de la carga, "
+              f"~{propuesta['segundos_ahorrados']:.1f} s ahorrados, "
+              f"sugerido por {propuesta['consultas']} consultas")
+        print(propuesta["ddl"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import os
+import uuid
+
+from bi_agent import BIAgent
+from coalescing import Coalescedor
+from database_manager import obtener_db_compartida
+from result_table import TablaResultados
+from sql_agent import SQLAgent, extraer_sql, obtener_agente_sql
+from sql_cache import normalizar_pregunta
+from tracing import tracer
+
+# Veces que se pide otra consulta al LLM si la guardia de coste la rechaza
+MAX_REGENERACIONES = 1
+
+# Etapas en las que las peticiones idénticas en curso comparten una sola ejecución
+ETAPAS_COALESCIBLES = ("pipeline", "sql", "grafico")
+
+
+def _cerrar_stream(tarea):
+    """Cierra el stream que devuelve una lectura abandonada para liberar su conexión"""
+    if not tarea.cancelled() and tarea.exception() is None:
+        tarea.result().close()
+
+
+def _huella_resultado(columns, results):
+    """Resumen de columnas y filas: dos gráficos solo se comparten si los datos son los mismos"""
+    huella = hashlib.sha1(repr(list(columns)).encode("utf-8"))
+    for fila in results:
+        huella.update(repr(tuple(fila)).encode("utf-8"))
+    return huella.hexdigest()
+
+
+class PipelineAsync:
+    """Pipeline asíncrono pregunta -> SQL -> resultados -> gráfico
+
+    Cada etapa tiene su propio límite de concurrencia. Las llamadas a la base
+    de datos, que son bloqueantes, se ejecutan en hilos sobre el pool
+    compartido. procesar() es un generador asíncrono: entrega los resultados
+    en cuanto termina la consulta, mientras el gráfico se sigue generando en
+    segundo plano.
+
+    Las peticiones idénticas que coinciden en el tiempo se coalescen en las
+    etapas de `coalescer` (por defecto todas):
+
+    - pipeline: misma pregunta normalizada y misma huella de esquema; todas
+      reciben los eventos de una sola ejecución completa;
+    - sql: la generación del SQL de esa misma pregunta;
+    - grafico: el gráfico de la misma consulta (salvo espacios) con las mismas
+      columnas y filas, según un resumen SHA-1 del resultado, aunque venga de
+      preguntas distintas.
+    """
+
+    def __init__(self, db=None, max_llm=None, max_db=None, max_graficos=None,
+                 llm_sql=None, llm_graficos=None, usar_cache_sql=True, coalescer=None):
+        self.db = db or obtener_db_compartida()
+        self.sem_llm = asyncio.Semaphore(max_llm or int(os.getenv("PIPELINE_MAX_LLM", "2")))
+        self.sem_db = asyncio.Semaphore(max_db or int(os.getenv("PIPELINE_MAX_DB", "8")))
+        self.sem_graficos = asyncio.Semaphore(
+            max_graficos or int(os.getenv("PIPELINE_MAX_GRAFICOS", "2")))
+        self.bi_agent = BIAgent(llm=llm_graficos)
+        self.llm_sql = llm_sql
+        self.usar_cache_sql = usar_cache_sql
+        self._agente_sql = None
+        self._lock_agente = asyncio.Lock()
+        if coalescer is None:
+            coalescer = [e.strip() for e in os.getenv("PIPELINE_COALESCER", ",".join(ETAPAS_COALESCIBLES)).split(",")
+                         if e.strip()]
+        desconocidas = set(coalescer) - set(ETAPAS_COALESCIBLES)
+        if desconocidas:
+            raise ValueError(f"Etapas sin coalescencia: {', '.join(sorted(desconocidas))}")
+        self.coalescedores = {etapa: Coalescedor(etapa) for etapa in coalescer}
+
+    async def agente_sql(self):
+        """Devuelve el SQLAgent del esquema actual; solo se reconstruye si cambia la huella"""
+        async with self._lock_agente:
+            async with self.sem_db:
+                schema = await asyncio.to_thread(self.db.obtener_esquema_bd)
+            huella = self.db.huella_esquema
+            if self.llm_sql is None and self.usar_cache_sql:
+                # El agente del proceso: el prefijo del prompt se comparte con el resto de la aplicación
+                return obtener_agente_sql(schema, huella)
+            if self._agente_sql is None or self._agente_sql.huella_esquema != huella:
+                agente = SQLAgent(usar_cache=self.usar_cache_sql, llm=self.llm_sql)
+                agente.inicializar(schema, huella)
+                self._agente_sql = agente
+            return self._agente_sql
+
+    async def _leer_resultados(self, query, id_consulta):
+        """Ejecuta la consulta y devuelve (stream, iterador de lotes, primer lote)"""
+        tarea = asyncio.ensure_future(
+            asyncio.to_thread(self.db.consultar_stream, query, id_consulta=id_consulta))
+        try:
+            stream = await asyncio.shield(tarea)
+            lotes = iter(stream)
+            primer_lote = await asyncio.to_thread(next, lotes, None)
+        except asyncio.CancelledError:
+            # El hilo sigue ejecutando la consulta: cancelarla en el servidor
+            # y cerrar el stream que acabe devolviendo
+            self.db.cancelar_consulta(id_consulta)
+            tarea.add_done_callback(_cerrar_stream)
+            raise
+        return stream, lotes, primer_lote or []
+
+    async def cancelar(self, id_consulta):
+        """Cancela en el servidor la consulta de una petición (el id llega en el evento 'sql')"""
+        return await asyncio.to_thread(self.db.cancelar_consulta, id_consulta)
+
+    async def _eventos_grafico(self, columns, results):
+        """Tokens del script del gráfico y el gráfico final, con el PNG ya generado"""
+        async with self.sem_graficos:
+            async for evento in self.bi_agent.agenerar_grafico_stream(columns, results):
+                if "token" in evento:
+                    yield {"etapa": "grafico_token", "token": evento["token"]}
+                    continue
+                grafico = evento["grafico"]
+                if grafico["script"]:
+                    try:
+                        # El script corre en el pool de procesos aislados y devuelve el PNG
+                        grafico["png"] = await asyncio.to_thread(
+                            self.bi_agent.ejecutar_script, grafico["script"], grafico["datos"])
+                    except Exception as e:
+                        print(f"Error al ejecutar el script: {e}")
+                yield {"etapa": "grafico", "grafico": grafico}
+
+    async def _grafico(self, query, columns, results, cola):
+        """Genera el gráfico dejando en la cola los tokens del script y el resultado final"""
+        try:
+            if "grafico" in self.coalescedores:
+                # Sin pasar a minúsculas: los literales ('Madrid' frente a 'madrid') cambian el resultado
+                # El resumen recorre todas las filas: se calcula fuera del bucle de eventos
+                huella = await asyncio.to_thread(_huella_resultado, columns, results)
+                clave = (" ".join(query.split()), self.db.huella_esquema, huella)
+                eventos = self.coalescedores["grafico"].ejecutar(
+                    clave, lambda: self._eventos_grafico(columns, results))
+            else:
+                eventos = self._eventos_grafico(columns, results)
+            try:
+                async for evento in eventos:
+                    await cola.put(evento)
+            finally:
+                await eventos.aclose()
+        finally:
+            await cola.put(None)
+
+    async def _tokens_sql(self, consulta_stream):
+        # El semáforo se toma aquí dentro: quien espera una generación compartida no ocupa el LLM
+        try:
+            async with self.sem_llm:
+                async for token in consulta_stream:
+                    yield token
+        finally:
+            await consulta_stream.aclose()
+
+    def _consulta_sql(self, agente, pregunta):
+        """Tokens del SQL de la pregunta; las peticiones iguales en curso comparten la generación"""
+        def generar():
+            return self._tokens_sql(agente.agenerar_consulta_stream(pregunta))
+
+        if "sql" not in self.coalescedores:
+            return generar()
+        return self.coalescedores["sql"].ejecutar(
+            (normalizar_pregunta(pregunta), agente.huella_esquema), generar)
+
+    def estadisticas_coalescencia(self):
+        """Ejecuciones y peticiones coalescidas por etapa
+
+        Cada petición coalescida en "pipeline" se ahorra una generación de SQL,
+        una consulta a la base de datos y un gráfico.
+        """
+        return {etapa: c.estadisticas() for etapa, c in self.coalescedores.items()}
+
+    def procesar(self, pregunta):
+        """
+        Genera eventos ('sql_token', 'sql', 'regenerando', 'parcial', 'resultados',
+        'grafico_token', 'grafico') a medida que avanzan las etapas
+
+        Si el consumidor abandona el generador (por ejemplo, el botón de parar
+        de la interfaz), la consulta en curso se cancela en el servidor, salvo
+        que otra petición idéntica siga esperando la misma ejecución.
+        """
+        if "pipeline" not in self.coalescedores:
+            return self._procesar(pregunta)
+        return self.coalescedores["pipeline"].ejecutar(
+            (normalizar_pregunta(pregunta), self.db.huella_esquema), lambda: self._procesar(pregunta))
+
+    async def _procesar(self, pregunta):
+        # El span raíz solo se activa en tramos sin yield: entre yields el
+        # generador puede reanudarse en otra tarea con otro contexto
+        raiz = tracer.iniciar("pipeline")
+        error = None
+        try:
+            with tracer.activar(raiz):
+                agente = await self.agente_sql()
+                consulta_stream = self._consulta_sql(agente, pregunta)
+            texto_sql = ""
+            try:
+                async for token in consulta_stream:
+                    texto_sql += token
+                    yield {"etapa": "sql_token", "token": token, "texto": texto_sql}
+            finally:
+                # Cerrarlo ya libera el semáforo o deja de contar como suscriptor
+                await consulta_stream.aclose()
+            query = extraer_sql(texto_sql)
+            id_consulta = uuid.uuid4().hex
+            yield {"etapa": "sql", "query": query, "id_consulta": id_consulta}
+
+            regeneraciones = 0
+            while True:
+                async with self.sem_db:
+                    with tracer.activar(raiz):
+                        stream, lotes, primer_lote = await self._leer_resultados(query, id_consulta)
+                    rechazo = stream.rechazo
+                    if not (rechazo and rechazo.regenerar and regeneraciones < MAX_REGENERACIONES):
+                        try:
+                            columns = stream.columns
+                            if primer_lote:
+                                yield {"etapa": "parcial", "columns": columns, "results": primer_lote}
+                            results = TablaResultados(columns, primer_lote)
+                            while True:
+                                lote = await asyncio.to_thread(next, lotes, None)
+                                if lote is None:
+                                    break
+                                results.agregar(lote)
+                            results.truncado = stream.truncado
+                        finally:
+                            # Si el cliente abandona la petición, cancelar la consulta
+                            # y liberar la conexión del stream
+                            if not stream.terminado:
+                                self.db.cancelar_consulta(id_consulta)
+                            stream.close()
+                        break
+
+                # La guardia de coste rechazó la consulta: pedir otra fuera del semáforo de la BD
+                regeneraciones += 1
+                yield {"etapa": "regenerando", "motivo": rechazo.motivo}
+                async with self.sem_llm:
+                    with tracer.activar(raiz):
+                        query = await agente.acorregir_consulta(pregunta, query, rechazo.motivo)
+                yield {"etapa": "sql", "query": query, "id_consulta": id_consulta}
+
+            if columns == ["Error"]:
+                # No reutilizar SQL que no se pudo ejecutar
+                agente.descartar_consulta(pregunta)
+            if not results:
+                results = TablaResultados(columns, [["No se encontraron resultados"]])
+            raiz.registrar(filas=len(results), truncado=stream.truncado)
+
+            # El gráfico se genera en segundo plano mientras la interfaz ya muestra la tabla
+            cola = asyncio.Queue()
+            with tracer.activar(raiz):
+                # create_task copia el contexto actual: los spans del gráfico cuelgan de la raíz
+                tarea_grafico = asyncio.create_task(self._grafico(query, columns, results, cola))
+            try:
+                yield {"etapa": "resultados", "columns": columns, "results": results,
+                       "truncado": stream.truncado, "filas": stream.filas}
+                while True:
+                    evento = await cola.get()
+                    if evento is None:
+                        break
+                    yield evento
+            finally:
+                if not tarea_grafico.done():
+                    tarea_grafico.cancel()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            raiz.terminar(error=error)
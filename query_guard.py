@@ -0,0 +1,106 @@
+import json
+import re
+
+# Sentencias que admite EXPLAIN; el resto (SET, SHOW, DDL) no se evalúa
+_EXPLICABLE = re.compile(r"\s*(select|with|values|table|insert|update|delete|merge)\b", re.IGNORECASE)
+_LECTURA = re.compile(r"\s*(select|with|values|table)\b", re.IGNORECASE)
+# Literales, identificadores entre comillas y comentarios, que pueden contener ';'
+_LITERALES = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+ACCIONES = ("rechazar", "limitar", "regenerar")
+
+
+class ConsultaRechazada(Exception):
+    """La consulta no se ejecuta porque su plan estimado supera los límites"""
+
+    def __init__(self, motivo, coste=None, filas=None, regenerar=False):
+        super().__init__(motivo)
+        self.motivo = motivo
+        self.coste = coste
+        self.filas = filas
+        # El llamador puede pedir al LLM otra consulta en lugar de mostrar el error
+        self.regenerar = regenerar
+
+
+def sin_punto_y_coma(query):
+    return query.strip().rstrip(";").rstrip()
+
+
+def varias_sentencias(query):
+    """Detecta un ';' fuera de literales y comentarios, salvo el del final"""
+    return ";" in _LITERALES.sub("", sin_punto_y_coma(query))
+
+
+def es_explicable(query):
+    return bool(_EXPLICABLE.match(query)) and not varias_sentencias(query)
+
+
+def plan_estimado(cur, query):
+    """Devuelve el nodo raíz del plan de EXPLAIN (FORMAT JSON), sin ejecutar la consulta"""
+    cur.execute("EXPLAIN (FORMAT JSON) " + sin_punto_y_coma(query))
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+class GuardiaConsultas:
+    """Revisa con EXPLAIN el SQL generado antes de ejecutarlo
+
+    Si el coste o las filas estimadas superan el máximo, según `accion` la
+    consulta se rechaza, se envuelve en un LIMIT (si así queda por debajo del
+    máximo) o se rechaza marcándola para que el LLM la regenere.
+    """
+
+    def __init__(self, max_coste=1e6, max_filas=1e6, accion="rechazar", limite=1000):
+        if accion not in ACCIONES:
+            raise ValueError(f"Acción desconocida: {accion} (usa {', '.join(ACCIONES)})")
+        self.max_coste = max_coste
+        self.max_filas = max_filas
+        self.accion = accion
+        self.limite = limite
+
+    def plan(self, cur, query):
+        """Devuelve (coste total, filas, plan) estimados por el planificador"""
+        nodo = plan_estimado(cur, query)
+        return nodo["Total Cost"], nodo["Plan Rows"], nodo
+
+    def _exceso(self, coste, filas):
+        if self.max_coste and coste > self.max_coste:
+            return f"coste estimado {coste:,.0f} supera el máximo de {self.max_coste:,.0f}"
+        if self.max_filas and filas > self.max_filas:
+            return f"{filas:,} filas estimadas superan el máximo de {self.max_filas:,.0f}"
+        return None
+
+    def revisar(self, cur, query, span=None):
+        """Devuelve (consulta a ejecutar, límite de filas o None, plan o None)
+
+        Lanza ConsultaRechazada si la consulta supera los límites.
+        """
+        if varias_sentencias(query):
+            raise ConsultaRechazada("la consulta contiene varias sentencias")
+        if not _EXPLICABLE.match(query):
+            return query, None, None
+
+        coste, filas, plan = self.plan(cur, query)
+        if span is not None:
+            span.registrar(coste_estimado=coste, filas_estimadas=filas)
+        motivo = self._exceso(coste, filas)
+        if motivo is None:
+            return query, None, plan
+
+        if self.accion == "limitar" and _LECTURA.match(query):
+            # Una fila de más permite marcar el resultado como truncado
+            limitada = (f"SELECT * FROM ({sin_punto_y_coma(query)}) AS consulta_limitada "
+                        f"LIMIT {self.limite + 1}")
+            coste_limitada, filas_limitada, plan_limitada = self.plan(cur, limitada)
+            # LIMIT no abarata una agregación sobre un producto cartesiano
+            if self._exceso(coste_limitada, filas_limitada) is None:
+                print(f"Consulta limitada a {self.limite} filas: {motivo}")
+                if span is not None:
+                    span.registrar(guardia="limitada")
+                return limitada, self.limite, plan_limitada
+
+        if span is not None:
+            span.registrar(guardia="rechazada")
+        raise ConsultaRechazada(motivo, coste, filas, regenerar=self.accion == "regenerar")
@@ -0,0 +1,125 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from schema_cache import directorio_cache
+
+_LITERAL_TEXTO = re.compile(r"'(?:[^']|'')*'")
+_LITERAL_NUMERO = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+
+
+def huella_consulta(query):
+    """Normaliza la consulta sin literales para agrupar las que solo cambian de valores"""
+    texto = _LITERAL_TEXTO.sub("?", query.strip().rstrip(";"))
+    texto = _LITERAL_NUMERO.sub("?", texto)
+    return " ".join(texto.lower().split())
+
+
+class RegistroConsultas:
+    """Registro en SQLite de las consultas ejecutadas, con su duración y su plan estimado
+
+    Es la carga de trabajo que analiza index_advisor. Se conservan las
+    últimas `max_entradas` ejecuciones.
+    """
+
+    def __init__(self, ruta=None, max_entradas=50000):
+        self.ruta = ruta or os.path.join(directorio_cache(), "consultas.sqlite3")
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._desde_poda = 0
+
+        directorio = os.path.dirname(self.ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        self._db = sqlite3.connect(self.ruta, check_same_thread=False)
+        # Se escribe en cada consulta: WAL evita bloquear a quien lee el registro
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS ejecuciones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                huella TEXT,
+                query TEXT,
+                duracion REAL,
+                filas INTEGER,
+                coste REAL,
+                plan TEXT,
+                fecha REAL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS ejecuciones_huella ON ejecuciones (huella)")
+        self._db.commit()
+
+    def registrar(self, query, duracion, filas=None, plan=None):
+        """Guarda una ejecución; un fallo del registro nunca afecta a la consulta"""
+        try:
+            with self._lock:
+                self._db.execute("""
+                    INSERT INTO ejecuciones (huella, query, duracion, filas, coste, plan, fecha)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (huella_consulta(query), query, duracion, filas,
+                      plan["Total Cost"] if plan else None,
+                      json.dumps(plan) if plan else None, time.time()))
+                self._desde_poda += 1
+                if self._desde_poda >= 1000:
+                    self._desde_poda = 0
+                    self._db.execute(
+                        "DELETE FROM ejecuciones WHERE id <= (SELECT MAX(id) FROM ejecuciones) - ?",
+                        (self.max_entradas,))
+                self._db.commit()
+        except sqlite3.Error as e:
+            print(f"No se pudo registrar la consulta: {e}")
+
+    def carga_de_trabajo(self, desde=None):
+        """Agrupa las ejecuciones por huella
+
+        Cada elemento tiene la última query y el último plan de la huella, el
+        número de ejecuciones y su duración total.
+        """
+        desde = desde or 0
+        with self._lock:
+            filas = self._db.execute("""
+                SELECT e.huella, e.query, e.plan, g.veces, g.duracion_total
+                FROM (
+                    SELECT huella, MAX(id) AS ultimo, COUNT(*) AS veces,
+                           SUM(duracion) AS duracion_total
+                    FROM ejecuciones
+                    WHERE fecha >= ?
+                    GROUP BY huella
+                ) g
+                JOIN ejecuciones e ON e.id = g.ultimo
+                ORDER BY g.duracion_total DESC
+            """, (desde,)).fetchall()
+        return [
+            {"huella": huella, "query": query, "plan": json.loads(plan) if plan else None,
+             "veces": veces, "duracion_total": duracion_total or 0.0}
+            for huella, query, plan, veces, duracion_total in filas
+        ]
+
+    def vaciar(self):
+        with self._lock:
+            self._db.execute("DELETE FROM ejecuciones")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_registro_compartido = None
+_registro_lock = threading.Lock()
+
+
+def obtener_registro_consultas():
+    """Devuelve el registro de consultas compartido por todo el proceso, o None si está desactivado"""
+    global _registro_compartido
+    if os.getenv("QUERY_LOG", "1") != "1":
+        return None
+    with _registro_lock:
+        if _registro_compartido is None:
+            _registro_compartido = RegistroConsultas(
+                max_entradas=int(os.getenv("QUERY_LOG_MAX", "50000")))
+        return _registro_compartido
@@ -0,0 +1,228 @@
+"""Reparto de las consultas de solo lectura entre réplicas de PostgreSQL
+
+Cada réplica tiene su propio pool. La consulta va a la siguiente réplica en
+turno (round_robin) o a la que tiene menos conexiones prestadas
+(menos_conexiones). Una réplica se salta mientras:
+
+- no se puede conectar a ella: queda fuera `reintento` segundos;
+- su retraso de replicación supera `max_retraso` segundos: se vuelve a medir
+  pasado `intervalo_retraso`. Una réplica sin receptor de WAL conectado, o
+  que lleva más de `max_silencio` segundos sin recibir nada del primario,
+  cuenta como retrasada aunque haya aplicado todo lo recibido. Para ver
+  last_msg_receipt_time el usuario necesita el rol pg_read_all_stats; sin él
+  solo se comprueba que el receptor exista.
+
+Si ninguna está disponible la consulta va al primario. Las escrituras, el
+DDL y el mantenimiento (crear_esquema_tienda, rollups, asesor de índices)
+siempre van al primario.
+
+Comprobación con dos instancias locales (DB_REPLICAS=localhost:5433):
+    python replicas.py --consultas 20
+"""
+import argparse
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+POLITICAS = ("round_robin", "menos_conexiones")
+
+# Segundos sin aplicar WAL. Si la réplica ya aplicó todo lo recibido el retraso
+# es 0 aunque el primario lleve tiempo sin escribir, siempre que el receptor
+# siga conectado: sin receptor es infinito y, si lleva más de max_silencio
+# segundos sin mensajes del primario (que manda keepalives aunque no escriba),
+# es ese silencio. Fuera de recuperación (una instancia independiente) es 0
+CONSULTA_RETRASO = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+                         WHERE COALESCE(status, 'streaming') = 'streaming') THEN 'Infinity'::float8
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN (
+            SELECT COALESCE(MAX(EXTRACT(EPOCH FROM now() - last_msg_receipt_time))
+                                FILTER (WHERE now() - last_msg_receipt_time
+                                              > make_interval(secs => %(max_silencio)s)), 0)
+            FROM pg_stat_wal_receiver)
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+_LECTURA = re.compile(r"\s*(select|with|values|table)\b", re.IGNORECASE)
+# Lo que hace que un SELECT escriba o bloquee filas: esas consultas van al primario
+_ESCRITURA = re.compile(
+    r"\b(insert|update|delete|merge|truncate|into|nextval|setval|pg_advisory_\w+)\b|"
+    r"\bfor\s+(update|share|no\s+key\s+update|key\s+share)\b",
+    re.IGNORECASE,
+)
+
+
+def es_solo_lectura(query):
+    """Indica si la consulta se puede mandar a una réplica; ante la duda, no"""
+    return bool(_LECTURA.match(query)) and not _ESCRITURA.search(query)
+
+
+def replica_al_dia(cur, posicion):
+    """Indica si la réplica ya aplicó el WAL del primario hasta `posicion`"""
+    cur.execute("SELECT COALESCE(pg_last_wal_replay_lsn() >= %s::pg_lsn, false)", (posicion,))
+    return cur.fetchone()[0]
+
+
+class Replica:
+    def __init__(self, nombre, pool):
+        self.nombre = nombre
+        self.pool = pool
+        self.caida_hasta = 0.0
+        self.retraso = None
+        self.medido = 0.0
+        self.stats = {"consultas": 0, "fallos_conexion": 0, "retrasada": 0}
+
+
+class EnrutadorReplicas:
+    """Elige réplica para cada consulta de solo lectura y la presta desde su pool"""
+
+    def __init__(self, pools, politica="round_robin", max_retraso=30.0, intervalo_retraso=5.0,
+                 reintento=30.0, espera=2.0, max_silencio=90.0):
+        if politica not in POLITICAS:
+            raise ValueError(f"Política de réplicas desconocida: {politica}")
+        self.replicas = [Replica(nombre, pool) for nombre, pool in pools.items()]
+        self.politica = politica
+        self.max_retraso = max_retraso
+        self.intervalo_retraso = intervalo_retraso
+        # Segundos sin mensajes del primario a partir de los que el receptor se da por desconectado
+        self.max_silencio = max_silencio
+        self.reintento = reintento
+        # Segundos que se espera una conexión libre de una réplica antes de probar otra
+        self.espera = espera
+        self._lock = threading.Lock()
+        self._turno = 0
+        self.stats = {"al_primario": 0}
+
+    def _candidatas(self):
+        """Réplicas utilizables, en el orden en que se van a probar"""
+        ahora = time.monotonic()
+        with self._lock:
+            disponibles = [
+                r for r in self.replicas
+                if ahora >= r.caida_hasta and (
+                    r.retraso is None or r.retraso <= self.max_retraso
+                    or ahora - r.medido >= self.intervalo_retraso)
+            ]
+            if self.politica == "menos_conexiones":
+                return sorted(disponibles, key=lambda r: r.pool.ocupadas())
+            inicio = self._turno % len(disponibles) if disponibles else 0
+            self._turno += 1
+            return disponibles[inicio:] + disponibles[:inicio]
+
+    def _retraso_aceptable(self, replica, conn):
+        """Mide el retraso si toca; devuelve False si la réplica va demasiado atrasada"""
+        if time.monotonic() - replica.medido >= self.intervalo_retraso:
+            with conn.cursor() as cur:
+                cur.execute(CONSULTA_RETRASO, {"max_silencio": self.max_silencio})
+                retraso = float(cur.fetchone()[0])
+            conn.rollback()
+            with self._lock:
+                replica.retraso, replica.medido = retraso, time.monotonic()
+        if replica.retraso is not None and replica.retraso > self.max_retraso:
+            with self._lock:
+                replica.stats["retrasada"] += 1
+            return False
+        return True
+
+    def _obtener(self):
+        import psycopg2
+
+        for replica in self._candidatas():
+            try:
+                conn = replica.pool.getconn(self.espera)
+            except psycopg2.OperationalError as e:
+                print(f"Réplica {replica.nombre} no disponible: {e}")
+                with self._lock:
+                    replica.caida_hasta = time.monotonic() + self.reintento
+                    replica.stats["fallos_conexion"] += 1
+                continue
+            except Exception:
+                # Pool lleno o cerrado: probar la siguiente sin marcarla como caída
+                continue
+            try:
+                if self._retraso_aceptable(replica, conn):
+                    with self._lock:
+                        replica.stats["consultas"] += 1
+                    return replica, conn
+                replica.pool.putconn(conn)
+            except psycopg2.Error as e:
+                print(f"Réplica {replica.nombre} no disponible: {e}")
+                replica.pool.putconn(conn, close=True)
+                with self._lock:
+                    replica.caida_hasta = time.monotonic() + self.reintento
+                    replica.stats["fallos_conexion"] += 1
+        with self._lock:
+            self.stats["al_primario"] += 1
+        return None
+
+    @contextmanager
+    def conexion(self):
+        """Presta (conexión, nombre de la réplica), o (None, None) si ninguna está disponible"""
+        import psycopg2
+
+        elegida = self._obtener()
+        if elegida is None:
+            yield None, None
+            return
+        replica, conn = elegida
+        rota = False
+        try:
+            yield conn, replica.nombre
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            rota = True
+            raise
+        finally:
+            if rota and conn.closed:
+                # Se perdió la conexión a mitad de consulta: apartar la réplica un tiempo
+                with self._lock:
+                    replica.caida_hasta = time.monotonic() + self.reintento
+                    replica.stats["fallos_conexion"] += 1
+            replica.pool.putconn(conn, close=rota)
+
+    def closeall(self):
+        for replica in self.replicas:
+            replica.pool.closeall()
+
+    def estadisticas(self):
+        ahora = time.monotonic()
+        with self._lock:
+            replicas = {}
+            for r in self.replicas:
+                if ahora < r.caida_hasta:
+                    estado = "caida"
+                elif r.retraso is not None and r.retraso > self.max_retraso:
+                    estado = "retrasada"
+                else:
+                    estado = "disponible"
+                replicas[r.nombre] = dict(r.stats, estado=estado, retraso=r.retraso,
+                                          en_uso=r.pool.ocupadas())
+            return dict(self.stats, politica=self.politica, replicas=replicas)
+
+
+def main():
+    from database_manager import obtener_db_compartida
+
+    parser = argparse.ArgumentParser(description="Comprueba a qué servidor va cada consulta de lectura")
+    parser.add_argument("--consultas", type=int, default=20)
+    args = parser.parse_args()
+
+    db = obtener_db_compartida()
+    try:
+        servidores = Counter()
+        for _ in range(args.consultas):
+            columns, results = db.ejecutar_consulta(
+                "SELECT coalesce(inet_server_addr()::text, 'socket') || ':' || inet_server_port()", usar_cache=False)
+            servidores[str(results[0][0])] += 1
+        for servidor, veces in servidores.most_common():
+            print(f"{servidor}: {veces} consultas")
+        print(f"Estadísticas de réplicas: {db.estadisticas_replicas()}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import re
+import sys
+import threading
+
+# Consultas cuyo resultado depende del momento de ejecución y no deben cachearse
+_NO_DETERMINISTA = re.compile(
+    r"\b(now|random|clock_timestamp|statement_timestamp|timeofday|nextval|setseed)\s*\(|"
+    r"\b(current_date|current_time|current_timestamp|localtime|localtimestamp)\b",
+    re.IGNORECASE,
+)
+_TABLAS = re.compile(r'\b(?:from|join)\s+((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?)', re.IGNORECASE)
+_FROM = re.compile(r"\bfrom\s+", re.IGNORECASE)
+_IDENTIFICADOR = re.compile(r'(?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?')
+_PALABRA = re.compile(r'"[^"]+"|\w+')
+# Palabras que cierran la lista de relaciones de un FROM
+_FIN_FROM = re.compile(
+    r"(where|group|order|having|limit|offset|window|union|intersect|except|fetch|for|on|using|"
+    r"join|inner|left|right|full|cross|natural|lateral)",
+    re.IGNORECASE,
+)
+# Literales e identificadores entre comillas: su contenido no se normaliza en la clave
+_ENTRE_COMILLAS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+_ESPACIOS = re.compile(r"\s+")
+_CTES = re.compile(r'(?:\bwith(?:\s+recursive)?|,)\s*("[^"]+"|\w+)\s+as\s*\(', re.IGNORECASE)
+
+# Contadores de modificación por tabla; relfilenode cambia además con TRUNCATE
+CONSULTA_VERSIONES = """
+    SELECT c.relname, c.relkind, s.n_tup_ins, s.n_tup_upd, s.n_tup_del, c.relfilenode
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE n.nspname = 'public' AND c.relname = ANY(%s);
+"""
+
+
+def _nombre(identificador):
+    nombre = identificador.split(".")[-1]
+    return nombre[1:-1] if nombre.startswith('"') else nombre.lower()
+
+
+def _cierre(texto, i):
+    """Posición justo después del paréntesis que cierra el abierto en i"""
+    profundidad = 0
+    while i < len(texto):
+        c = texto[i]
+        if c in ("'", '"'):
+            fin = texto.find(c, i + 1)
+            i = len(texto) if fin == -1 else fin + 1
+            continue
+        if c == "(":
+            profundidad += 1
+        elif c == ")":
+            profundidad -= 1
+            if profundidad == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+def _lista_from(texto, i):
+    """Relaciones de la lista de un FROM separadas por comas: FROM ventas v, productos p
+
+    Las subconsultas se saltan; sus propias tablas las recoge su FROM.
+    """
+    nombres = []
+    esperando_relacion = True
+    while i < len(texto):
+        c = texto[i]
+        if c.isspace():
+            i += 1
+        elif c == "(":
+            # Subconsulta, argumentos de una función o lista de columnas del alias
+            i = _cierre(texto, i)
+            esperando_relacion = False
+        elif c == ",":
+            esperando_relacion = True
+            i += 1
+        elif esperando_relacion:
+            m = _IDENTIFICADOR.match(texto, i)
+            if not m:
+                break
+            if m.group().lower() == "lateral":
+                i = m.end()
+                continue
+            nombres.append(m.group())
+            i, esperando_relacion = m.end(), False
+        else:
+            # Alias (con o sin AS) hasta la palabra que termina el FROM
+            m = _PALABRA.match(texto, i)
+            if not m or _FIN_FROM.fullmatch(m.group()):
+                break
+            i = m.end()
+    return nombres
+
+
+def tablas_de_consulta(query):
+    """Devuelve los nombres que una consulta lee con FROM/JOIN, o None si no es cacheable
+
+    La lista puede incluir nombres que no son tablas (por ejemplo la columna de
+    EXTRACT(... FROM columna)); versiones_de_tablas los descarta.
+
+    >>> sorted(tablas_de_consulta("SELECT * FROM ventas v, productos AS p WHERE v.id = p.id"))
+    ['productos', 'ventas']
+    >>> sorted(tablas_de_consulta("SELECT * FROM (SELECT * FROM ventas) s, clientes c JOIN pedidos USING (id)"))
+    ['clientes', 'pedidos', 'ventas']
+    """
+    texto = query.strip().rstrip(";").strip()
+    if not re.match(r"(select|with)\b", texto, re.IGNORECASE):
+        return None
+    if ";" in texto or _NO_DETERMINISTA.search(texto):
+        return None
+    ctes = {_nombre(m) for m in _CTES.findall(texto)}
+    nombres = _TABLAS.findall(texto)
+    for m in _FROM.finditer(texto):
+        nombres.extend(_lista_from(texto, m.end()))
+    for nombre in nombres:
+        # Solo se siguen tablas del esquema public
+        if "." in nombre and nombre.split(".")[0].strip('"').lower() != "public":
+            return None
+    tablas = {_nombre(m) for m in nombres} - ctes
+    return tablas or None
+
+
+def versiones_de_tablas(cur, tablas):
+    """Devuelve {tabla: versión} o None si alguna relación no se puede seguir (vistas, etc.)"""
+    # Las estadísticas se congelan dentro de una transacción; forzar una lectura fresca
+    cur.execute("SELECT pg_stat_clear_snapshot();")
+    cur.execute(CONSULTA_VERSIONES, (sorted(tablas),))
+    versiones = {}
+    for relname, relkind, ins, upd, dele, relfilenode in cur.fetchall():
+        if relkind != "r" or ins is None:
+            return None
+        versiones[relname] = (ins, upd, dele, relfilenode)
+    return versiones or None
+
+
+def tamano_resultado(columns, results):
+    """Estimación en bytes de la memoria que ocupa un resultado"""
+    total = sys.getsizeof(results) + sum(sys.getsizeof(c) for c in columns)
+    for row in results:
+        total += sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row)
+    return total
+
+
+class ResultCache:
+    """Caché de resultados con presupuesto de memoria y expulsión GDSF
+
+    Cada entrada guarda las versiones de las tablas que lee. Deja de ser válida
+    en cuanto cambian los contadores de pg_stat_user_tables de alguna de ellas.
+    Esos contadores se publican al terminar cada transacción, con un retraso
+    de hasta un segundo.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_fraccion_entrada=0.25):
+        self.max_bytes = max_bytes
+        # Un resultado mayor que esta fracción del presupuesto no se cachea
+        self.max_bytes_entrada = int(max_bytes * max_fraccion_entrada)
+        self._lock = threading.Lock()
+        self._entradas = {}  # sql -> dict con resultado, versiones y prioridad
+        self._bytes = 0
+        # Valor de "inflación" de Greedy-Dual-Size-Frequency
+        self._inflacion = 0.0
+        self.stats = {"hits": 0, "misses": 0, "invalidadas": 0, "expulsadas": 0,
+                      "rechazadas_tamano": 0}
+
+    @staticmethod
+    def clave(query):
+        """SQL con los espacios normalizados fuera de literales
+
+        'a  b' y 'a b' son valores distintos. Los saltos de línea se conservan
+        (como uno solo) porque terminan los comentarios --.
+        """
+        partes = _ENTRE_COMILLAS.split(query.strip().rstrip(";").strip())
+        for i in range(0, len(partes), 2):
+            partes[i] = _ESPACIOS.sub(lambda m: "\n" if "\n" in m.group() else " ", partes[i])
+        return "".join(partes)
+
+    def _prioridad(self, entrada):
+        # Entradas pequeñas, caras de recalcular y muy usadas se conservan más
+        return self._inflacion + entrada["frecuencia"] * entrada["coste"] / entrada["bytes"]
+
+    def obtener(self, query, versiones):
+        """Devuelve (columns, results) si la entrada sigue siendo válida"""
+        clave = self.clave(query)
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                self.stats["misses"] += 1
+                return None
+            if entrada["versiones"] != versiones:
+                self._eliminar(clave)
+                self.stats["invalidadas"] += 1
+                self.stats["misses"] += 1
+                return None
+            entrada["frecuencia"] += 1
+            entrada["prioridad"] = self._prioridad(entrada)
+            self.stats["hits"] += 1
+            return entrada["columns"], list(entrada["results"])
+
+    def guardar(self, query, versiones, columns, results, coste):
+        """Guarda un resultado junto con las versiones de sus tablas y su coste en segundos"""
+        tamano = tamano_resultado(columns, results)
+        clave = self.clave(query)
+        with self._lock:
+            if tamano > self.max_bytes_entrada:
+                self.stats["rechazadas_tamano"] += 1
+                return False
+            if clave in self._entradas:
+                self._eliminar(clave)
+            entrada = {
+                "columns": columns,
+                "results": results,
+                "versiones": versiones,
+                "bytes": tamano,
+                "coste": max(coste, 1e-6),
+                "frecuencia": 1,
+            }
+            entrada["prioridad"] = self._prioridad(entrada)
+            while self._entradas and self._bytes + tamano > self.max_bytes:
+                victima = min(self._entradas, key=lambda k: self._entradas[k]["prioridad"])
+                self._inflacion = self._entradas[victima]["prioridad"]
+                self._eliminar(victima)
+                self.stats["expulsadas"] += 1
+            self._entradas[clave] = entrada
+            self._bytes += tamano
+            return True
+
+    def _eliminar(self, clave):
+        entrada = self._entradas.pop(clave)
+        self._bytes -= entrada["bytes"]
+
+    def invalidar(self):
+        """Vacía la caché"""
+        with self._lock:
+            self._entradas.clear()
+            self._bytes = 0
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.stats["hits"] + self.stats["misses"]
+            return dict(self.stats, entradas=len(self._entradas), bytes=self._bytes,
+                        max_bytes=self.max_bytes,
+                        tasa_aciertos=self.stats["hits"] / consultas if consultas else 0.0)
@@ -0,0 +1,108 @@
+from result_cache import tamano_resultado
+from result_table import TablaResultados
+
+
+class ResultadoStream:
+    """Resultado de una consulta que se lee por lotes desde un cursor de servidor
+
+    Se itera lote a lote. La lectura se corta al llegar a max_filas o
+    max_bytes, y entonces `truncado` queda en True. La conexión se libera al
+    agotar el stream o al llamar a close().
+    """
+
+    def __init__(self, cursor=None, tamano_lote=1000, max_filas=None, max_bytes=None,
+                 al_cerrar=None, al_completar=None):
+        self.tamano_lote = tamano_lote
+        self.max_filas = max_filas
+        self.max_bytes = max_bytes
+        self.filas = 0
+        self.bytes = 0
+        self.truncado = False
+        self.terminado = False
+        # ConsultaRechazada si la guardia de coste no dejó ejecutar la consulta
+        self.rechazo = None
+        self._cursor = cursor
+        self._al_cerrar = al_cerrar
+        # Recibe (columns, filas leídas) si el stream se lee entero sin truncar
+        self._al_completar = al_completar
+        self._leidas = [] if al_completar else None
+
+        self.columns = None
+        self._pendiente = None
+        if cursor is not None:
+            # Un cursor con nombre solo expone description tras el primer fetch
+            pedidas = self._siguiente_peticion()
+            lote = cursor.fetchmany(pedidas)
+            self._pendiente = (lote, len(lote) == pedidas)
+            self.columns = [desc[0] for desc in cursor.description]
+
+    @classmethod
+    def desde_lista(cls, columns, results):
+        """Envuelve un resultado ya materializado (errores, caché, sentencias sin filas)"""
+        stream = cls()
+        stream.columns = columns
+        stream._pendiente = (list(results), False)
+        return stream
+
+    def _siguiente_peticion(self):
+        if self.max_filas is None:
+            return self.tamano_lote
+        # Pedir una fila de más para saber si hay que marcar el resultado como truncado
+        return min(self.tamano_lote, self.max_filas - self.filas + 1)
+
+    def _leer_lote(self):
+        if self._pendiente is not None:
+            pendiente, self._pendiente = self._pendiente, None
+            return pendiente
+        if self._cursor is None:
+            return [], False
+        pedidas = self._siguiente_peticion()
+        lote = self._cursor.fetchmany(pedidas)
+        return lote, len(lote) == pedidas
+
+    def __iter__(self):
+        try:
+            while not self.terminado:
+                lote, puede_haber_mas = self._leer_lote()
+                if self.max_filas is not None and self.filas + len(lote) > self.max_filas:
+                    lote = lote[:self.max_filas - self.filas]
+                    self.truncado = True
+                if lote:
+                    self.filas += len(lote)
+                    self.bytes += tamano_resultado((), lote)
+                    if self._leidas is not None:
+                        self._leidas.extend(lote)
+                    yield lote
+                if self.truncado or not puede_haber_mas:
+                    break
+                if self.max_bytes is not None and self.bytes >= self.max_bytes:
+                    self.truncado = True
+                    break
+            if not self.truncado and self._al_completar is not None:
+                self._al_completar(self.columns, self._leidas)
+        finally:
+            self.close()
+
+    def leer_todo(self):
+        """Lee los lotes restantes y los devuelve como una sola lista de filas"""
+        filas = []
+        for lote in self:
+            filas.extend(lote)
+        return filas
+
+    def leer_tabla(self):
+        """Lee los lotes restantes en una TablaResultados"""
+        tabla = TablaResultados(self.columns)
+        for lote in self:
+            tabla.agregar(lote)
+        tabla.truncado = self.truncado
+        return tabla
+
+    def close(self):
+        """Cierra el cursor y devuelve la conexión"""
+        if self.terminado:
+            return
+        self.terminado = True
+        self._leidas = None
+        if self._al_cerrar is not None:
+            self._al_cerrar()
@@ -0,0 +1,134 @@
+"""Resultado de una consulta compartido por las interfaces y BIAgent
+
+TablaResultados guarda las filas tal como llegan del cursor y las pasa a
+columnas NumPy con tipo solo cuando alguien las pide: cada columna se
+convierte una vez (Decimal a float, fechas a datetime64) y el DataFrame de
+BIAgent se monta sobre esos mismos arrays. El texto para la interfaz se
+genera por páginas, de modo que formatear la tabla cuesta lo mismo con cien
+filas que con un millón.
+"""
+import datetime
+import math
+from decimal import Decimal
+from operator import itemgetter
+
+FILAS_POR_PAGINA = 50
+ANCHO_COLUMNA = 15
+
+
+def _convertir_columna(valores):
+    """Array NumPy con el tipo de la columna, decidido por su primer valor no nulo"""
+    import numpy as np
+
+    n = len(valores)
+    muestra = next((v for v in valores if v is not None), None)
+    hay_nulos = muestra is None or any(v is None for v in valores)
+    if isinstance(muestra, bool):
+        if not hay_nulos:
+            return np.fromiter(valores, dtype=bool, count=n)
+    elif isinstance(muestra, int) and not hay_nulos:
+        try:
+            return np.fromiter(valores, dtype=np.int64, count=n)
+        except (OverflowError, TypeError, ValueError):
+            pass
+    if isinstance(muestra, (Decimal, int, float)) and not isinstance(muestra, bool):
+        try:
+            return np.fromiter((math.nan if v is None else float(v) for v in valores),
+                               dtype=float, count=n)
+        except (TypeError, ValueError):
+            pass
+    elif isinstance(muestra, (datetime.date, datetime.datetime)) and getattr(muestra, "tzinfo", None) is None:
+        try:
+            return np.array(valores, dtype="datetime64[us]")
+        except (TypeError, ValueError):
+            pass
+    # Texto, tipos mixtos o con zona horaria: se quedan como objetos. Se rellena
+    # un array vacío para que las listas (columnas ARRAY) no se conviertan en 2D
+    columna = np.empty(n, dtype=object)
+    columna[:] = valores
+    return columna
+
+
+class TablaResultados:
+    """Columnas y filas de un resultado, con conversión a columnas y texto por páginas
+
+    Se comporta como la lista de filas que devolvían las consultas (len,
+    iteración e índices), así que los consumidores que solo recorren filas no
+    cambian.
+    """
+
+    def __init__(self, columns, filas=(), truncado=False):
+        self.columns = list(columns)
+        self.truncado = truncado
+        self._filas = list(filas)
+        self._columnas = None
+        self._df = None
+
+    def agregar(self, lote):
+        """Añade un lote de filas leído del stream"""
+        self._filas.extend(lote)
+        self._columnas = self._df = None
+
+    def __len__(self):
+        return len(self._filas)
+
+    def __iter__(self):
+        return iter(self._filas)
+
+    def __getitem__(self, indice):
+        return self._filas[indice]
+
+    def __bool__(self):
+        return bool(self._filas)
+
+    def columnas(self):
+        """Lista de arrays NumPy, uno por columna, convertidos una sola vez"""
+        if self._columnas is None:
+            if not self._filas:
+                import numpy as np
+
+                self._columnas = [np.empty(0, dtype=object) for _ in self.columns]
+            else:
+                # Las filas de aviso ("No se encontraron resultados") tienen menos celdas que columnas
+                ancho = min(len(self.columns), len(self._filas[0]))
+                self._columnas = [_convertir_columna(list(map(itemgetter(i), self._filas)))
+                                  for i in range(ancho)]
+        return self._columnas
+
+    def a_dataframe(self):
+        """DataFrame sobre los arrays de columnas(), sin volver a copiarlos"""
+        if self._df is None:
+            import pandas as pd
+
+            columnas = self.columnas()
+            df = pd.DataFrame({i: columna for i, columna in enumerate(columnas)}, copy=False)
+            # Se asignan después para conservar nombres repetidos (por ejemplo, de un JOIN)
+            df.columns = self.columns[:len(columnas)]
+            for i, columna in enumerate(columnas):
+                if columna.dtype == object and isinstance(
+                        next((v for v in columna if v is not None), None), datetime.date):
+                    # Fechas con zona horaria: las resuelve pandas
+                    df.isetitem(i, pd.to_datetime(df.iloc[:, i], errors="coerce", utc=True))
+            self._df = df
+        return self._df
+
+    def paginas(self, filas_por_pagina=FILAS_POR_PAGINA):
+        return max(1, math.ceil(len(self._filas) / filas_por_pagina))
+
+    def texto(self, pagina=1, filas_por_pagina=FILAS_POR_PAGINA):
+        """Texto de una página de la tabla; solo se formatean las filas visibles"""
+        paginas = self.paginas(filas_por_pagina)
+        pagina = min(max(1, pagina), paginas)
+        inicio = (pagina - 1) * filas_por_pagina
+        lineas = ["", "Resultados:", "-" * 80,
+                  " | ".join(f"{col:<{ANCHO_COLUMNA}}" for col in self.columns), "-" * 80]
+        lineas.extend(
+            " | ".join(f"{str(val)[:ANCHO_COLUMNA]:<{ANCHO_COLUMNA}}" for val in fila)
+            for fila in self._filas[inicio:inicio + filas_por_pagina])
+        lineas.append("=" * 80)
+        if paginas > 1:
+            fin = min(inicio + filas_por_pagina, len(self._filas))
+            lineas.append(f"Página {pagina} de {paginas} (filas {inicio + 1}-{fin} de {len(self._filas)})")
+        if self.truncado:
+            lineas.append(f"Resultado truncado a las primeras {len(self._filas)} filas")
+        return "\n".join(lineas)
@@ -0,0 +1,472 @@
+"""Rollups diarios de ventas y reescritura de las consultas agregadas
+
+Los rollups son tablas del esquema `rollups` (fuera de public, de modo que
+el LLM no las ve en el esquema) que la aplicación mantiene como vistas
+materializadas: ventas diarias por producto (con su categoría), por
+categoría y por cliente. Se refrescan de forma incremental con las ventas
+cuyo id_venta supera la marca del último refresco, y se recalculan enteras
+cuando en ventas o productos hubo UPDATE, DELETE o TRUNCATE, cuando se pide
+con `completo` o cuando el último recálculo es más antiguo que
+`completo_cada`. Este recálculo periódico recoge también las ventas de
+transacciones que confirmaron un id_venta menor que la marca después de
+tomarla, que el refresco incremental no ve.
+
+ReescritorRollups se aplica entre la generación del SQL y su ejecución
+(DatabaseManager._revisar). Detecta agregados simples sobre ventas, con
+joins a productos, categorias o clientes, y los redirige al rollup más
+pequeño que tenga las dimensiones que usa la consulta, siempre que se haya
+recalculado entero hace menos de `max_antiguedad` segundos y que ventas y
+productos no hayan cambiado salvo por inserciones. Se mide desde el último
+recálculo completo y no desde el último refresco porque solo aquel recoge
+las ventas confirmadas tarde, así que `completo_cada` tiene que ser menor que
+`max_antiguedad` para que los rollups se sigan usando. Cualquier cosa que no
+sepa reescribir con el mismo resultado se ejecuta tal cual.
+
+Uso:
+    python rollups.py [--completo]
+"""
+import argparse
+import json
+import re
+import threading
+import time
+
+from query_guard import sin_punto_y_coma
+from result_cache import versiones_de_tablas
+
+ESQUEMA = "rollups"
+
+# Columnas de ventas que pueden ser dimensiones de un rollup
+DIMENSIONES_VENTAS = ("fecha_venta", "id_producto", "id_cliente")
+# Medidas: columna del rollup -> expresión sobre ventas (v)
+MEDIDAS = {
+    "cantidad": "SUM(v.cantidad)",
+    "total": "SUM(v.total)",
+    "num_ventas": "COUNT(*)",
+    "num_cantidad": "COUNT(v.cantidad)",
+    "num_total": "COUNT(v.total)",
+}
+TIPOS_MEDIDAS = {"cantidad": "BIGINT", "total": "NUMERIC", "num_ventas": "BIGINT",
+                 "num_cantidad": "BIGINT", "num_total": "BIGINT"}
+
+# Las dimensiones son (columna, tipo, expresión); el LEFT JOIN conserva las ventas sin producto
+ROLLUPS = {
+    "ventas_producto_dia": {
+        "dimensiones": (("fecha_venta", "DATE", "v.fecha_venta"),
+                        ("id_producto", "INTEGER", "v.id_producto"),
+                        ("id_categoria", "INTEGER", "p.id_categoria")),
+        "origen": "ventas v LEFT JOIN productos p ON p.id_producto = v.id_producto",
+        "tablas": ("ventas", "productos"),
+    },
+    "ventas_categoria_dia": {
+        "dimensiones": (("fecha_venta", "DATE", "v.fecha_venta"),
+                        ("id_categoria", "INTEGER", "p.id_categoria")),
+        "origen": "ventas v LEFT JOIN productos p ON p.id_producto = v.id_producto",
+        "tablas": ("ventas", "productos"),
+    },
+    "ventas_cliente_dia": {
+        "dimensiones": (("fecha_venta", "DATE", "v.fecha_venta"),
+                        ("id_cliente", "INTEGER", "v.id_cliente")),
+        "origen": "ventas v",
+        "tablas": ("ventas",),
+    },
+}
+
+TABLAS_DIMENSION = {"productos", "categorias", "clientes"}
+
+DDL_ESTADO = f"""
+    CREATE SCHEMA IF NOT EXISTS {ESQUEMA};
+    CREATE TABLE IF NOT EXISTS {ESQUEMA}.estado (
+        nombre TEXT PRIMARY KEY,
+        actualizado TIMESTAMPTZ,
+        completo TIMESTAMPTZ,
+        ultimo_id_venta BIGINT,
+        firma TEXT,
+        filas BIGINT
+    );
+"""
+
+
+def _ddl_rollup(nombre, definicion):
+    columnas = [f"{columna} {tipo}" for columna, tipo, _ in definicion["dimensiones"]]
+    columnas += [f"{medida} {TIPOS_MEDIDAS[medida]}" for medida in MEDIDAS]
+    clave = ", ".join(columna for columna, _, _ in definicion["dimensiones"])
+    # Con dimensiones NULL el upsert añade otra fila en lugar de sumar: los agregados no cambian
+    return (f"CREATE TABLE IF NOT EXISTS {ESQUEMA}.{nombre} ({', '.join(columnas)});"
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {nombre}_clave ON {ESQUEMA}.{nombre} ({clave});")
+
+
+def _select_rollup(definicion, filtro=""):
+    expresiones = ", ".join(expresion for _, _, expresion in definicion["dimensiones"])
+    medidas = ", ".join(MEDIDAS.values())
+    return (f"SELECT {expresiones}, {medidas} FROM {definicion['origen']} {filtro} "
+            f"GROUP BY {expresiones}")
+
+
+def _columnas_rollup(definicion):
+    return ", ".join([columna for columna, _, _ in definicion["dimensiones"]] + list(MEDIDAS))
+
+
+def _firma(versiones, tablas):
+    """Contadores de UPDATE y DELETE y relfilenode de las tablas de origen; las inserciones no cuentan"""
+    if not versiones or any(tabla not in versiones for tabla in tablas):
+        return None
+    return json.dumps({tabla: list(versiones[tabla][1:]) for tabla in tablas}, sort_keys=True)
+
+
+def _leer_estado(cur):
+    cur.execute(f"""
+        SELECT nombre, extract(epoch FROM actualizado), extract(epoch FROM completo),
+               ultimo_id_venta, firma, filas
+        FROM {ESQUEMA}.estado
+    """)
+    return {nombre: {"actualizado": float(actualizado), "completo": float(completo),
+                     "ultimo_id_venta": ultimo_id, "firma": firma, "filas": filas}
+            for nombre, actualizado, completo, ultimo_id, firma, filas in cur.fetchall()}
+
+
+def crear_rollups(conn):
+    """Crea el esquema, la tabla de estado y las tablas de los rollups si no existen"""
+    with conn.cursor() as cur:
+        cur.execute(DDL_ESTADO)
+        for nombre, definicion in ROLLUPS.items():
+            cur.execute(_ddl_rollup(nombre, definicion))
+    conn.commit()
+
+
+def refrescar_rollups(conn, completo=False, completo_cada=1800):
+    """Refresca todos los rollups en una transacción; devuelve {rollup: "completo" | "incremental"}"""
+    modos = {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT MAX(id_venta) FROM ventas")
+            hasta = cur.fetchone()[0] or 0
+            versiones = versiones_de_tablas(cur, {"ventas", "productos"})
+            estado = _leer_estado(cur)
+            for nombre, definicion in ROLLUPS.items():
+                inicio = time.perf_counter()
+                firma = _firma(versiones, definicion["tablas"])
+                previo = estado.get(nombre)
+                recalcular = (completo or previo is None or firma is None or previo["firma"] != firma
+                              or previo["ultimo_id_venta"] > hasta
+                              or time.time() - previo["completo"] > completo_cada)
+                tabla = f"{ESQUEMA}.{nombre}"
+                if recalcular:
+                    # DELETE en lugar de TRUNCATE: las consultas en curso siguen viendo la versión anterior
+                    cur.execute(f"DELETE FROM {tabla}")
+                    cur.execute(f"INSERT INTO {tabla} ({_columnas_rollup(definicion)}) "
+                                + _select_rollup(definicion))
+                else:
+                    clave = ", ".join(columna for columna, _, _ in definicion["dimensiones"])
+                    sumas = ", ".join(f"{medida} = COALESCE(r.{medida}, 0) + COALESCE(EXCLUDED.{medida}, 0)"
+                                      for medida in MEDIDAS)
+                    cur.execute(
+                        f"INSERT INTO {tabla} AS r ({_columnas_rollup(definicion)}) "
+                        + _select_rollup(definicion, "WHERE v.id_venta > %(desde)s AND v.id_venta <= %(hasta)s")
+                        + f" ON CONFLICT ({clave}) DO UPDATE SET {sumas}",
+                        {"desde": previo["ultimo_id_venta"], "hasta": hasta})
+                if recalcular:
+                    cur.execute(f"ANALYZE {tabla}")
+                cur.execute(f"SELECT COUNT(*) FROM {tabla}")
+                filas = cur.fetchone()[0]
+                cur.execute(f"""
+                    INSERT INTO {ESQUEMA}.estado (nombre, actualizado, completo, ultimo_id_venta, firma, filas)
+                    VALUES (%(nombre)s, now(), now(), %(hasta)s, %(firma)s, %(filas)s)
+                    ON CONFLICT (nombre) DO UPDATE SET
+                        actualizado = EXCLUDED.actualizado,
+                        completo = CASE WHEN %(recalcular)s THEN EXCLUDED.completo
+                                        ELSE {ESQUEMA}.estado.completo END,
+                        ultimo_id_venta = EXCLUDED.ultimo_id_venta,
+                        firma = EXCLUDED.firma,
+                        filas = EXCLUDED.filas
+                """, {"nombre": nombre, "hasta": hasta, "firma": firma, "filas": filas,
+                      "recalcular": recalcular})
+                modos[nombre] = "completo" if recalcular else "incremental"
+                print(f"Rollup {nombre} ({modos[nombre]}): {filas:,} filas en "
+                      f"{time.perf_counter() - inicio:.1f} s")
+        conn.commit()
+    except Exception as e:
+        print(f"Error refrescando los rollups: {e}")
+        conn.rollback()
+        raise
+    return modos
+
+
+# --- Reescritura ---
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+_CLAUSULA = re.compile(r"\b(select|from|where|group\s+by|having|order\s+by|limit|offset)\b", re.IGNORECASE)
+# Construcciones cuyo resultado cambiaría al leer filas ya agregadas, o que no se analizan
+_NO_REESCRIBIBLE = re.compile(
+    r"\b(union|intersect|except|over|filter|outer|left|right|full|cross|natural|lateral|using|"
+    r"grouping|rollup|cube|for|with|distinct\s+on)\b|--|/\*|(?<!\()\*\s*(?:,|\bfrom\b)",
+    re.IGNORECASE)
+_PALABRAS = r"(?:on|join|inner|where|group|order|having|limit|offset|as)\b"
+_TABLA = re.compile(rf"(?:^|\bjoin)\s+(?:public\.)?(\w+)(?:\s+(?:as\s+)?(?!{_PALABRAS})(\w+))?",
+                    re.IGNORECASE)
+_AGREGADO = re.compile(r"\b(sum|count|avg|min|max)\s*\(\s*(distinct\s+)?([^()]*?)\s*\)", re.IGNORECASE)
+_COLUMNA = re.compile(r"(?:(\w+)\.)?(\w+)")
+_ALIAS_SALIDA = re.compile(r"\bas\s+(\w+)", re.IGNORECASE)
+
+
+def _enmascarar(texto):
+    """Sustituye el contenido de literales e identificadores entre comillas por espacios"""
+    return _LITERAL.sub(lambda m: m.group(0)[0] + " " * (len(m.group(0)) - 2) + m.group(0)[-1], texto)
+
+
+def _clausulas(texto):
+    """Posiciones de las cláusulas de nivel superior de una SELECT, o None si alguna se repite"""
+    profundidad, niveles = 0, []
+    for caracter in texto:
+        if caracter == "(":
+            profundidad += 1
+        niveles.append(profundidad)
+        if caracter == ")":
+            profundidad -= 1
+    marcas = [(" ".join(m.group(1).lower().split()), m.start(), m.end())
+              for m in _CLAUSULA.finditer(texto) if niveles[m.start()] == 0]
+    clausulas = {}
+    for i, (nombre, _, fin) in enumerate(marcas):
+        if nombre in clausulas:
+            return None
+        siguiente = marcas[i + 1][1] if i + 1 < len(marcas) else len(texto)
+        clausulas[nombre] = (fin, siguiente)
+    return clausulas
+
+
+def _agregado_rollup(funcion, distinto, argumento, alias, solo_ventas):
+    """Expresión equivalente sobre el rollup y dimensión que necesita, o None si no la hay"""
+    funcion = funcion.lower()
+    if argumento == "*":
+        return (f"SUM({alias}.num_ventas)::bigint", None) if funcion == "count" and not distinto else None
+    m = _COLUMNA.fullmatch(argumento)
+    if m is None:
+        return None
+    calificador, columna = m.group(1), m.group(2).lower()
+    if calificador and calificador != alias or not calificador and not solo_ventas and columna not in (
+            "id_venta", "cantidad", "total", "fecha_venta"):
+        # Columna de una tabla de dimensión: la multiplicidad de filas cambia en el rollup
+        if funcion in ("min", "max") or (funcion == "count" and distinto):
+            return f"{funcion.upper()}({distinto or ''}{argumento})", None
+        return None
+    if columna == "id_venta" and funcion == "count":
+        return f"SUM({alias}.num_ventas)::bigint", None
+    if columna in ("cantidad", "total") and not distinto:
+        # Conservar el tipo de la consulta original: SUM(integer) y COUNT son bigint
+        if funcion == "sum":
+            return f"SUM({alias}.{columna})" + ("::bigint" if columna == "cantidad" else ""), None
+        if funcion == "count":
+            return f"SUM({alias}.num_{columna})::bigint", None
+        if funcion == "avg":
+            return f"(SUM({alias}.{columna})::numeric / NULLIF(SUM({alias}.num_{columna}), 0))", None
+        return None
+    if columna in DIMENSIONES_VENTAS and (funcion in ("min", "max") or (funcion == "count" and distinto)):
+        return f"{funcion.upper()}({distinto or ''}{alias}.{columna})", columna
+    return None
+
+
+def analizar_agregado(query):
+    """Analiza si la consulta es un agregado sobre ventas que un rollup puede responder
+
+    Devuelve (dimensiones de ventas que usa, función que recibe el nombre
+    completo del rollup y devuelve la consulta reescrita), o None.
+
+    Un alias de salida solo se acepta en ORDER BY: en WHERE, GROUP BY,
+    HAVING u ON el mismo nombre es la columna de ventas, un filtro por fila.
+
+    >>> analizar_agregado("SELECT fecha_venta, SUM(total) AS total FROM ventas "
+    ...                   "WHERE total > 100 GROUP BY fecha_venta") is None
+    True
+    >>> analizar_agregado("SELECT fecha_venta, COUNT(*) AS cantidad FROM ventas "
+    ...                   "WHERE cantidad > 1 GROUP BY fecha_venta") is None
+    True
+    >>> analizar_agregado("SELECT fecha_venta, SUM(total) AS total FROM ventas "
+    ...                   "GROUP BY fecha_venta ORDER BY total DESC")[0]
+    {'fecha_venta'}
+    """
+    texto = sin_punto_y_coma(query)
+    mascara = _enmascarar(texto)
+    if (not re.match(r"\s*select\b", mascara, re.IGNORECASE)
+            or len(re.findall(r"\bselect\b", mascara, re.IGNORECASE)) != 1):
+        return None
+    if ";" in mascara or _NO_REESCRIBIBLE.search(mascara):
+        return None
+    clausulas = _clausulas(mascara)
+    if clausulas is None or "from" not in clausulas:
+        return None
+
+    inicio_from, fin_from = clausulas["from"]
+    origen = mascara[inicio_from:fin_from]
+    if "," in origen:
+        return None
+    tablas = [(m.group(1).lower(), m.group(2), m.start(1), m.end(1)) for m in _TABLA.finditer(origen)]
+    ventas = [tabla for tabla in tablas if tabla[0] == "ventas"]
+    if len(ventas) != 1 or any(t[0] != "ventas" and t[0] not in TABLAS_DIMENSION for t in tablas):
+        return None
+    # Todas las tablas deben aparecer al principio o tras JOIN
+    if len(re.findall(r"\bjoin\b", origen, re.IGNORECASE)) != len(tablas) - 1:
+        return None
+    _, alias, inicio_ventas, fin_ventas = ventas[0]
+    sin_alias = alias is None
+    alias = alias or "ventas"
+    solo_ventas = len(tablas) == 1
+
+    necesarias = set()
+    agregados = 0
+    reemplazos = []
+    residuo = list(mascara)
+    for m in _AGREGADO.finditer(mascara):
+        resultado = _agregado_rollup(m.group(1), m.group(2), m.group(3), alias, solo_ventas)
+        if resultado is None:
+            return None
+        expresion, dimension = resultado
+        if dimension:
+            necesarias.add(dimension)
+        reemplazos.append((m.start(), m.end(), expresion))
+        residuo[m.start():m.end()] = " " * (m.end() - m.start())
+        agregados += 1
+    if not agregados and "group by" not in clausulas:
+        # Sin agregar, cada fila de ventas es una fila del resultado
+        return None
+
+    # Fuera de los agregados, las medidas de ventas no pueden aparecer (filtros por fila, etc.)
+    residuo = "".join(residuo)
+    alias_salida = {m.start(1): m.group(1).lower() for m in _ALIAS_SALIDA.finditer(residuo)}
+    salida = set(alias_salida.values())
+    inicio_orden, fin_orden = clausulas.get("order by", (0, 0))
+    for m in re.finditer(r"(?<![\w.])(?:(\w+)\.)?(\w+)\b(?!\s*\()", residuo):
+        calificador, columna = m.group(1), m.group(2).lower()
+        if calificador is not None and calificador != alias:
+            continue
+        if calificador is None and (
+                m.start(2) in alias_salida
+                or (columna in salida and inicio_orden <= m.start() < fin_orden)
+                or (not solo_ventas and columna not in ("id_venta", "cantidad", "total", "fecha_venta"))):
+            continue
+        if columna in ("id_venta", "cantidad", "total"):
+            return None
+        if columna in DIMENSIONES_VENTAS:
+            necesarias.add(columna)
+    if re.search(rf"(?<![\w.]){re.escape(alias)}\.\*", residuo):
+        return None
+
+    def reescribir(tabla_rollup):
+        # El rollup conserva el alias de ventas, así el resto de la consulta no cambia
+        tabla = f"{tabla_rollup} ventas" if sin_alias else tabla_rollup
+        resultado = texto
+        for inicio, fin, expresion in sorted(reemplazos + [(inicio_from + inicio_ventas,
+                                                            inicio_from + fin_ventas, tabla)],
+                                             reverse=True):
+            resultado = resultado[:inicio] + expresion + resultado[fin:]
+        return resultado
+
+    return necesarias, reescribir
+
+
+class ReescritorRollups:
+    """Redirige los agregados sobre ventas al rollup más pequeño que los puede responder"""
+
+    def __init__(self, max_antiguedad=3600, ttl_estado=10):
+        self.max_antiguedad = max_antiguedad
+        self.ttl_estado = ttl_estado
+        self._lock = threading.Lock()
+        self._estado = None
+        self._leido = 0.0
+        self.stats = {"reescritas": 0, "no_reescribibles": 0, "antiguas": 0}
+
+    def _estado_rollups(self, cur):
+        with self._lock:
+            if self._estado is not None and time.monotonic() - self._leido < self.ttl_estado:
+                return self._estado
+        cur.execute("SELECT to_regclass(%s)", (f"{ESQUEMA}.estado",))
+        estado = _leer_estado(cur) if cur.fetchone()[0] else {}
+        with self._lock:
+            self._estado, self._leido = estado, time.monotonic()
+        return estado
+
+    def invalidar(self):
+        with self._lock:
+            self._estado = None
+
+    def reescribir(self, cur, query, span=None):
+        """Devuelve la consulta reescrita sobre un rollup, o la original si no se puede"""
+        analisis = analizar_agregado(query)
+        if analisis is None:
+            return query
+        necesarias, reescribir = analisis
+        estado = self._estado_rollups(cur)
+        if not estado:
+            return query
+
+        ahora = time.time()
+        versiones = versiones_de_tablas(cur, {"ventas", "productos"})
+        posibles = []
+        for nombre, definicion in ROLLUPS.items():
+            info = estado.get(nombre)
+            dimensiones = {columna for columna, _, _ in definicion["dimensiones"]}
+            if info is None or not necesarias <= dimensiones:
+                continue
+            # Las ventas confirmadas tarde con un id_venta bajo solo entran con el recálculo completo
+            if (ahora - info["completo"] > self.max_antiguedad
+                    or info["firma"] is None or info["firma"] != _firma(versiones, definicion["tablas"])):
+                with self._lock:
+                    self.stats["antiguas"] += 1
+                continue
+            posibles.append((info["filas"], nombre))
+        if not posibles:
+            with self._lock:
+                self.stats["no_reescribibles"] += 1
+            return query
+
+        _, nombre = min(posibles)
+        with self._lock:
+            self.stats["reescritas"] += 1
+        if span is not None:
+            span.registrar(rollup=nombre)
+        return reescribir(f"{ESQUEMA}.{nombre}")
+
+    def estadisticas(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+class RefrescoPeriodico:
+    """Hilo en segundo plano que refresca los rollups cada `intervalo` segundos"""
+
+    def __init__(self, db, intervalo, completo_cada=1800):
+        self.db = db
+        self.intervalo = intervalo
+        self.completo_cada = completo_cada
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._bucle, daemon=True)
+        self._hilo.start()
+
+    def _bucle(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                self.db.refrescar_rollups(completo_cada=self.completo_cada)
+            except Exception:
+                # refrescar_rollups ya informó del error; se reintenta en el siguiente intervalo
+                pass
+
+    def parar(self):
+        self._parar.set()
+
+
+def main():
+    from database_manager import cargar_config_rollups, obtener_db_compartida
+
+    parser = argparse.ArgumentParser(description="Crea y refresca los rollups de ventas")
+    parser.add_argument("--completo", action="store_true", help="recalcular enteros en lugar de incrementalmente")
+    args = parser.parse_args()
+
+    db = obtener_db_compartida()
+    try:
+        db.crear_rollups()
+        db.refrescar_rollups(args.completo, cargar_config_rollups()["completo_cada"])
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def directorio_cache():
+    """Directorio donde se guardan las cachés en disco"""
+    return os.getenv("CACHE_DIR", ".cache")
+
+
+class SchemaCache:
+    """Caché en memoria y en disco de esquemas, indexada por huella del esquema"""
+
+    def __init__(self, directorio=None, intervalo_verificacion=10.0):
+        self.directorio = directorio or directorio_cache()
+        # Tiempo durante el que se confía en la huella sin volver a consultarla
+        self.intervalo_verificacion = intervalo_verificacion
+        self._lock = threading.Lock()
+        self._memoria = {}  # clave -> (huella, esquema, momento de la última verificación)
+
+    @staticmethod
+    def clave(connection_params):
+        """Identifica una base de datos por host, puerto y nombre"""
+        datos = f"{connection_params.get('host')}:{connection_params.get('port')}/{connection_params.get('database')}"
+        return hashlib.sha1(datos.encode("utf-8")).hexdigest()[:16]
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, f"esquema_{clave}.json")
+
+    def reciente(self, clave):
+        """Devuelve (huella, esquema) si se verificó hace menos de intervalo_verificacion"""
+        with self._lock:
+            entrada = self._memoria.get(clave)
+        if entrada and time.monotonic() - entrada[2] < self.intervalo_verificacion:
+            return entrada[0], entrada[1]
+        return None
+
+    def obtener(self, clave, huella):
+        """Devuelve el esquema cacheado si coincide con la huella actual"""
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada and entrada[0] == huella:
+                self._memoria[clave] = (huella, entrada[1], time.monotonic())
+                return entrada[1]
+
+        try:
+            with open(self._ruta(clave), encoding="utf-8") as f:
+                datos = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if datos.get("huella") != huella:
+            return None
+
+        esquema = {
+            tabla: {
+                "columns": [tuple(col) for col in detalles["columns"]],
+                "foreign_keys": [tuple(fk) for fk in detalles["foreign_keys"]],
+            }
+            for tabla, detalles in datos["esquema"].items()
+        }
+        with self._lock:
+            self._memoria[clave] = (huella, esquema, time.monotonic())
+        return esquema
+
+    def guardar(self, clave, huella, esquema):
+        """Guarda el esquema en memoria y en disco"""
+        with self._lock:
+            self._memoria[clave] = (huella, esquema, time.monotonic())
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            ruta = self._ruta(clave)
+            temporal = f"{ruta}.{os.getpid()}.tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump({"huella": huella, "esquema": esquema}, f)
+            os.replace(temporal, ruta)
+        except OSError as e:
+            print(f"No se pudo guardar el esquema en disco: {e}")
+
+    def invalidar(self, clave):
+        """Descarta el esquema cacheado de una base de datos"""
+        with self._lock:
+            self._memoria.pop(clave, None)
+        try:
+            os.remove(self._ruta(clave))
+        except OSError:
+            pass
+
+
+# Caché compartida por todos los DatabaseManager del proceso
+cache_esquemas = SchemaCache()
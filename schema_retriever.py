@@ -0,0 +1,148 @@
+import math
+import re
+import unicodedata
+from collections import Counter, deque
+
+STOPWORDS = {
+    "a", "al", "cada", "como", "con", "cual", "cuales", "cuantas", "cuantos", "cuanto",
+    "de", "del", "dame", "donde", "el", "en", "es", "esta", "este", "hay", "la", "las",
+    "lo", "los", "mas", "me", "mi", "muestra", "muestrame", "o", "para", "por", "que",
+    "quien", "quienes", "se", "sin", "sobre", "su", "sus", "un", "una", "uno", "y",
+    "the", "of", "and", "by", "for", "in", "show", "list",
+}
+
+
+def estimar_tokens(texto):
+    """Aproximación del número de tokens de un texto (unos 4 caracteres por token)"""
+    return max(1, len(texto) // 4)
+
+
+def _palabras(texto):
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    # snake_case y camelCase se separan en palabras
+    texto = re.sub(r"([a-z])([A-Z])", r"\1 \2", texto).replace("_", " ")
+    return [p for p in re.findall(r"[a-z0-9]+", texto) if p not in STOPWORDS]
+
+
+def _raiz(palabra):
+    """Stemming mínimo para plurales en español e inglés"""
+    for sufijo in ("es", "s"):
+        if len(palabra) > 4 and palabra.endswith(sufijo):
+            return palabra[:-len(sufijo)]
+    return palabra
+
+
+def terminos(texto):
+    """Palabras normalizadas más trigramas de caracteres para tolerar variaciones morfológicas"""
+    resultado = []
+    for palabra in _palabras(texto):
+        raiz = _raiz(palabra)
+        resultado.append(raiz)
+        relleno = f"^{raiz}$"
+        resultado.extend(f"#{relleno[i:i + 3]}" for i in range(len(relleno) - 2))
+    return resultado
+
+
+class SchemaRetriever:
+    """Índice BM25 local sobre tablas, columnas y relaciones del esquema"""
+
+    def __init__(self, schema, top_k=4, k1=1.2, b=0.75, peso_trigramas=0.3):
+        self.schema = schema
+        self.top_k = top_k
+        self.k1 = k1
+        self.b = b
+        self.peso_trigramas = peso_trigramas
+
+        # Grafo no dirigido de claves foráneas para poder unir las tablas elegidas
+        self.vecinos = {tabla: set() for tabla in schema}
+        self.referenciadas = {tabla: set() for tabla in schema}
+        for tabla, detalles in schema.items():
+            for fk in detalles["foreign_keys"]:
+                destino = fk[1]
+                if destino in self.vecinos and destino != tabla:
+                    self.vecinos[tabla].add(destino)
+                    self.vecinos[destino].add(tabla)
+                    self.referenciadas[tabla].add(destino)
+
+        self.documentos = {}
+        for tabla, detalles in schema.items():
+            # El nombre de la tabla pesa más que sus columnas y relaciones
+            texto = " ".join([tabla] * 3 + [col[0] for col in detalles["columns"]]
+                             + [fk[1] for fk in detalles["foreign_keys"]])
+            self.documentos[tabla] = Counter(terminos(texto))
+        self.longitud_media = (
+            sum(sum(doc.values()) for doc in self.documentos.values()) / len(self.documentos)
+            if self.documentos else 0.0
+        )
+        frecuencia_docs = Counter()
+        for doc in self.documentos.values():
+            frecuencia_docs.update(doc.keys())
+        total = len(self.documentos)
+        self.idf = {
+            termino: math.log(1 + (total - n + 0.5) / (n + 0.5))
+            for termino, n in frecuencia_docs.items()
+        }
+
+    def puntuar(self, pregunta):
+        """Devuelve la puntuación BM25 de cada tabla para la pregunta"""
+        consulta = Counter(terminos(pregunta))
+        puntuaciones = {}
+        for tabla, doc in self.documentos.items():
+            longitud = sum(doc.values())
+            puntuacion = 0.0
+            for termino, veces in consulta.items():
+                tf = doc.get(termino)
+                if not tf:
+                    continue
+                peso = self.peso_trigramas if termino.startswith("#") else 1.0
+                norma = tf + self.k1 * (1 - self.b + self.b * longitud / self.longitud_media)
+                puntuacion += peso * veces * self.idf[termino] * tf * (self.k1 + 1) / norma
+            puntuaciones[tabla] = puntuacion
+        return puntuaciones
+
+    def _camino(self, origen, destinos):
+        """Camino más corto en el grafo de FKs desde origen hasta cualquiera de los destinos"""
+        anteriores = {origen: None}
+        cola = deque([origen])
+        while cola:
+            actual = cola.popleft()
+            if actual in destinos and actual != origen:
+                camino = []
+                while actual is not None:
+                    camino.append(actual)
+                    actual = anteriores[actual]
+                return camino
+            for vecino in self.vecinos[actual]:
+                if vecino not in anteriores:
+                    anteriores[vecino] = actual
+                    cola.append(vecino)
+        return []
+
+    def seleccionar(self, pregunta, top_k=None):
+        """Elige las tablas relevantes y las amplía por FKs para que los joins sigan siendo posibles"""
+        top_k = top_k or self.top_k
+        if len(self.schema) <= top_k:
+            return list(self.schema)
+
+        puntuaciones = self.puntuar(pregunta)
+        candidatas = sorted((t for t, p in puntuaciones.items() if p > 0),
+                            key=lambda t: -puntuaciones[t])[:top_k]
+        if not candidatas:
+            # Sin coincidencias no se puede recortar con seguridad
+            return list(self.schema)
+
+        elegidas = set(candidatas)
+        # Tablas intermedias necesarias para unir las candidatas entre sí
+        for tabla in candidatas:
+            otras = set(candidatas) - {tabla}
+            if otras:
+                elegidas.update(self._camino(tabla, otras))
+        # Tablas referenciadas directamente, para poder resolver nombres y descripciones
+        for tabla in candidatas:
+            elegidas.update(self.referenciadas[tabla])
+        return sorted(elegidas, key=lambda t: (-puntuaciones.get(t, 0.0), t))
+
+    def subesquema(self, tablas):
+        """Devuelve el esquema reducido a las tablas indicadas"""
+        return {tabla: self.schema[tabla] for tabla in tablas}
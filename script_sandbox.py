@@ -0,0 +1,370 @@
+"""Ejecución aislada de los scripts de gráficos generados por el LLM
+
+Los scripts se ejecutan en un pool de procesos trabajadores que ya tienen
+matplotlib (backend Agg), pandas y numpy importados. Cada trabajador tiene
+límites de memoria y de CPU por script, y el proceso padre aplica además un
+timeout de reloj: si se supera, el trabajador se mata y se arranca otro. La
+figura se devuelve como bytes PNG en memoria, sin archivos compartidos.
+
+Entre scripts el trabajador vuelve a los valores por defecto de matplotlib y
+pandas y cada script recibe un espacio de nombres nuevo. Lo que un script
+pueda dejar modificado en los propios módulos no se deshace: por eso cada
+trabajador se sustituye tras `max_scripts` ejecuciones.
+
+Las respuestas del trabajador son una cabecera JSON más los bytes del PNG,
+de modo que el proceso padre nunca deserializa con pickle lo que produce el
+script.
+"""
+import io
+import json
+import os
+import pickle
+import queue
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+try:
+    import resource
+except ImportError:  # Windows: solo se aplica el timeout
+    resource = None
+
+_LONGITUD = struct.Struct(">Q")
+
+# Variables que el trabajador hereda; el resto (DB_*, claves de API...) no llega al script
+VARIABLES_HEREDADAS = ("PATH", "HOME", "LANG", "LC_ALL", "LC_CTYPE", "TZ", "TMPDIR", "PYTHONPATH",
+                       "SYSTEMROOT", "MPLCONFIGDIR")
+
+
+class ErrorScript(Exception):
+    """El script del gráfico falló, superó un límite o no produjo ninguna figura"""
+
+
+def _escribir_trama(salida, datos):
+    salida.write(_LONGITUD.pack(len(datos)) + datos)
+
+
+def _leer_trama(entrada):
+    cabecera = entrada.read(_LONGITUD.size)
+    if len(cabecera) < _LONGITUD.size:
+        raise EOFError("El proceso trabajador terminó")
+    longitud = _LONGITUD.unpack(cabecera)[0]
+    datos = entrada.read(longitud)
+    if len(datos) < longitud:
+        raise EOFError("El proceso trabajador terminó")
+    return datos
+
+
+class _Trabajador:
+    """Proceso hijo que ejecuta scripts de uno en uno"""
+
+    def __init__(self, memoria_mb, cpu_segundos):
+        # Cada trabajador tiene su propio directorio: si el script guarda archivos, no se pisan
+        self.directorio = tempfile.mkdtemp(prefix="ragdb_script_")
+        entorno = {nombre: os.environ[nombre] for nombre in VARIABLES_HEREDADAS if nombre in os.environ}
+        entorno.update(OPENBLAS_NUM_THREADS="1", OMP_NUM_THREADS="1", MKL_NUM_THREADS="1", MPLBACKEND="Agg")
+        self.proceso = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(memoria_mb), str(cpu_segundos)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self.directorio, env=entorno)
+        self.scripts = 0
+        self._respuestas = queue.Queue()
+        threading.Thread(target=self._leer, daemon=True).start()
+
+    def _leer(self):
+        try:
+            while True:
+                cabecera = json.loads(_leer_trama(self.proceso.stdout))
+                png = _leer_trama(self.proceso.stdout)
+                self._respuestas.put((cabecera, png))
+        except (EOFError, OSError, ValueError):
+            self._respuestas.put(None)
+
+    def vivo(self):
+        return self.proceso.poll() is None
+
+    def enviar(self, codigo, datos, timeout):
+        """Escribe la tarea en la entrada del trabajador; queue.Empty si no la acepta a tiempo
+
+        Un trabajador colgado deja de leer y la escritura se bloquea con la
+        tubería llena; se hace en un hilo para no esperar más que el timeout.
+        Al matar el proceso la escritura pendiente falla y el hilo termina.
+        """
+        trama = pickle.dumps((codigo, datos), protocol=pickle.HIGHEST_PROTOCOL)
+        errores = []
+
+        def escribir():
+            try:
+                _escribir_trama(self.proceso.stdin, trama)
+                self.proceso.stdin.flush()
+            except (OSError, ValueError) as e:
+                errores.append(e)
+
+        hilo = threading.Thread(target=escribir, daemon=True)
+        hilo.start()
+        hilo.join(max(0.0, timeout))
+        if hilo.is_alive():
+            raise queue.Empty
+        if errores:
+            raise OSError(errores[0])
+        self.scripts += 1
+
+    def recibir(self, timeout):
+        """Espera la respuesta del script; None si el proceso murió, queue.Empty si se agota el tiempo"""
+        limite = time.monotonic() + timeout
+        while True:
+            respuesta = self._respuestas.get(timeout=max(0.0, limite - time.monotonic()))
+            # El primer mensaje solo avisa de que las librerías ya están importadas
+            if respuesta is None or not respuesta[0].get("listo"):
+                return respuesta
+
+    def terminar(self):
+        if self.vivo():
+            self.proceso.kill()
+        try:
+            self.proceso.stdin.close()
+            self.proceso.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+        shutil.rmtree(self.directorio, ignore_errors=True)
+
+
+class PoolScripts:
+    """Pool de procesos precalentados que ejecutan scripts con timeout y límites de recursos"""
+
+    def __init__(self, procesos=2, timeout=20.0, memoria_mb=2048, cpu_segundos=15, max_scripts=100):
+        self.procesos = procesos
+        self.timeout = timeout
+        # Scripts que ejecuta un trabajador antes de sustituirlo por uno limpio
+        self.max_scripts = max_scripts
+        self.memoria_mb = memoria_mb
+        self.cpu_segundos = cpu_segundos
+        self._condicion = threading.Condition()
+        self._libres = []
+        self._cerrado = False
+        self.stats = {"ejecuciones": 0, "errores": 0, "timeouts": 0, "reinicios": 0}
+        for _ in range(procesos):
+            self._libres.append(self._nuevo_trabajador())
+
+    def _nuevo_trabajador(self):
+        return _Trabajador(self.memoria_mb, self.cpu_segundos)
+
+    def _reponer(self):
+        """Arranca un trabajador nuevo en segundo plano para no retrasar a quien llamó"""
+        def arrancar():
+            trabajador = self._nuevo_trabajador()
+            with self._condicion:
+                if self._cerrado:
+                    trabajador.terminar()
+                    return
+                self.stats["reinicios"] += 1
+                self._libres.append(trabajador)
+                self._condicion.notify()
+        threading.Thread(target=arrancar, daemon=True).start()
+
+    def _tomar(self, timeout):
+        limite = time.monotonic() + timeout
+        with self._condicion:
+            while True:
+                if self._cerrado:
+                    raise ErrorScript("El pool de scripts está cerrado")
+                while self._libres:
+                    trabajador = self._libres.pop()
+                    if trabajador.vivo():
+                        return trabajador
+                    # Murió mientras esperaba (por ejemplo, el OOM killer)
+                    trabajador.terminar()
+                    self._reponer()
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self.stats["timeouts"] += 1
+                    raise ErrorScript(f"No hay trabajadores libres tras {timeout} segundos")
+                self._condicion.wait(restante)
+
+    def _devolver(self, trabajador):
+        if self.max_scripts and trabajador.scripts >= self.max_scripts:
+            trabajador.terminar()
+            self._reponer()
+            return
+        with self._condicion:
+            if self._cerrado:
+                trabajador.terminar()
+                return
+            self._libres.append(trabajador)
+            self._condicion.notify()
+
+    def ejecutar(self, codigo, datos=None):
+        """Ejecuta el script con `df` = datos y devuelve el PNG de la figura que crea"""
+        inicio = time.monotonic()
+        trabajador = self._tomar(self.timeout)
+        with self._condicion:
+            self.stats["ejecuciones"] += 1
+        # Si el proceso muere sin responder es que el sistema lo mató por un límite
+        error = "El script superó el límite de CPU o de memoria y el proceso terminó"
+        try:
+            trabajador.enviar(codigo, datos, self.timeout - (time.monotonic() - inicio))
+            respuesta = trabajador.recibir(self.timeout - (time.monotonic() - inicio))
+        except queue.Empty:
+            respuesta, error = None, f"El script superó el tiempo límite de {self.timeout} segundos"
+            with self._condicion:
+                self.stats["timeouts"] += 1
+        except OSError:
+            respuesta, error = None, "El proceso trabajador no acepta tareas"
+
+        if respuesta is None:
+            # El trabajador está colgado o muerto: se descarta y se arranca otro
+            trabajador.terminar()
+            self._reponer()
+            with self._condicion:
+                self.stats["errores"] += 1
+            raise ErrorScript(error)
+
+        self._devolver(trabajador)
+        cabecera, png = respuesta
+        if cabecera.get("error"):
+            with self._condicion:
+                self.stats["errores"] += 1
+            raise ErrorScript(cabecera["error"])
+        return png
+
+    def estadisticas(self):
+        with self._condicion:
+            return dict(self.stats, libres=len(self._libres), procesos=self.procesos)
+
+    def cerrar(self):
+        with self._condicion:
+            self._cerrado = True
+            libres, self._libres = self._libres, []
+            self._condicion.notify_all()
+        for trabajador in libres:
+            trabajador.terminar()
+
+
+_pool_compartido = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool_scripts():
+    """Devuelve el pool de scripts compartido por todo el proceso"""
+    global _pool_compartido
+    with _pool_lock:
+        if _pool_compartido is None:
+            _pool_compartido = PoolScripts(
+                procesos=int(os.getenv("SCRIPT_WORKERS", "2")),
+                timeout=float(os.getenv("SCRIPT_TIMEOUT", "20")),
+                memoria_mb=int(os.getenv("SCRIPT_MAX_MB", "2048")),
+                cpu_segundos=int(os.getenv("SCRIPT_MAX_CPU", "15")),
+                max_scripts=int(os.getenv("SCRIPT_MAX_POR_TRABAJADOR", "100")),
+            )
+        return _pool_compartido
+
+
+# --- Lado del proceso trabajador ---
+
+def _limitar_memoria(memoria_mb):
+    if resource is None or not memoria_mb:
+        return
+    limite = memoria_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    # Los scripts no tienen por qué escribir archivos grandes
+    resource.setrlimit(resource.RLIMIT_FSIZE, (50 * 1024 * 1024, 50 * 1024 * 1024))
+
+
+def _limitar_cpu(cpu_segundos):
+    """RLIMIT_CPU es acumulado: el límite blando se mueve antes de cada script"""
+    if resource is None or not cpu_segundos:
+        return
+    usado = resource.getrusage(resource.RUSAGE_SELF)
+    _, duro = resource.getrlimit(resource.RLIMIT_CPU)
+    blando = int(usado.ru_utime + usado.ru_stime) + cpu_segundos + 1
+    if duro != resource.RLIM_INFINITY:
+        blando = min(blando, duro)
+    resource.setrlimit(resource.RLIMIT_CPU, (blando, duro))
+
+
+def _figura(namespace, plt, Figure):
+    """La figura activa de pyplot o, si no hay, la última Figure creada sin pyplot"""
+    if plt.get_fignums():
+        return plt.gcf()
+    figuras = [valor for valor in namespace.values() if isinstance(valor, Figure)]
+    return figuras[-1] if figuras else None
+
+
+def _vaciar_directorio(directorio):
+    """Borra lo que haya dejado el script en el directorio del trabajador"""
+    for nombre in os.listdir(directorio):
+        ruta = os.path.join(directorio, nombre)
+        if os.path.isdir(ruta) and not os.path.islink(ruta):
+            shutil.rmtree(ruta, ignore_errors=True)
+        else:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+
+def _ejecutar_en_trabajador(codigo, datos, plt, Figure, pd, np, directorio):
+    plt.close("all")
+    namespace = {"__name__": "__main__", "pd": pd, "np": np, "plt": plt, "df": datos}
+    inicio = time.perf_counter()
+    try:
+        exec(codigo, namespace)
+        figura = _figura(namespace, plt, Figure)
+        if figura is None:
+            return {"error": "El script no creó ninguna figura"}, b""
+        buffer = io.BytesIO()
+        figura.savefig(buffer, format="png")
+        return {"error": None, "duracion": time.perf_counter() - inicio}, buffer.getvalue()
+    except MemoryError:
+        return {"error": "El script superó el límite de memoria"}, b""
+    except (Exception, SystemExit) as e:
+        return {"error": f"{type(e).__name__}: {e}"}, b""
+    finally:
+        plt.close("all")
+        # Lo que el script cambió en la configuración no debe llegar al siguiente
+        plt.rcdefaults()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            pd.reset_option("all")
+        # El script puede haber cambiado de directorio: volver y limpiar por ruta absoluta
+        os.chdir(directorio)
+        _vaciar_directorio(directorio)
+
+
+def _trabajador(memoria_mb, cpu_segundos):
+    entrada, salida = sys.stdin.buffer, sys.stdout.buffer
+    # Lo que imprima el script no debe mezclarse con el protocolo
+    sys.stdout = sys.stderr
+    sys.stdin = open(os.devnull)
+    directorio = os.path.abspath(os.getcwd())
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import pandas as pd
+    from matplotlib.figure import Figure
+
+    _limitar_memoria(memoria_mb)
+
+    def responder(cabecera, png=b""):
+        _escribir_trama(salida, json.dumps(cabecera).encode("utf-8"))
+        _escribir_trama(salida, png)
+        salida.flush()
+
+    responder({"listo": True})
+    while True:
+        try:
+            codigo, datos = pickle.loads(_leer_trama(entrada))
+        except EOFError:
+            break
+        _limitar_cpu(cpu_segundos)
+        responder(*_ejecutar_en_trabajador(codigo, datos, plt, Figure, pd, np, directorio))
+
+
+if __name__ == "__main__":
+    _trabajador(int(sys.argv[1]), int(sys.argv[2]))
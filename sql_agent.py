@@ -1,68 +1,472 @@
-from langchain_community.llms import Ollama
-from langchain_core.callbacks import CallbackManager
-from langchain_core.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain_core.prompts import PromptTemplate
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+
+from arranque import evaluar_prompt, parametros_ollama
+from schema_retriever import SchemaRetriever, estimar_tokens
+from sql_cache import obtener_cache_sql
+from tracing import tracer
+
+# Instrucciones y esquema: el prefijo, idéntico byte a byte en todas las preguntas
+PREFIJO_SQL = """Eres un experto en SQL que convierte consultas en lenguaje natural a consultas SQL.
+Utiliza el siguiente esquema de base de datos:
+
+{esquema}
+
+Convertir la siguiente consulta en lenguaje natural a una consulta SQL válida.
+Solo devuelve la consulta SQL, sin explicaciones adicionales.
+"""
+
+MODOS_PROMPT = ("prefijo", "recortado")
+
 
 class SQLAgent:
-    def __init__(self):
+    """Genera SQL con el LLM a partir de preguntas en lenguaje natural
+
+    Con modo_prompt "prefijo" todas las preguntas comparten el prefijo con el
+    esquema completo y solo cambia el final (tablas sugeridas y pregunta):
+    Ollama reutiliza la caché KV del prefijo y solo procesa ese final. Con
+    "recortado" cada prompt lleva solo las tablas relevantes: menos tokens,
+    pero un prefijo distinto en cada combinación de tablas. Si el esquema
+    completo supera max_tokens_prefijo se usa "recortado".
+    """
+    MODELO = "llama3"
+
+    def __init__(self, cache=None, usar_cache=True, top_k_tablas=4, llm=None,
+                 modo_prompt=None, max_tokens_prefijo=None):
         self.llm = None
-        self.prompt = None
+        # Modelo alternativo a Ollama (por ejemplo el simulado de benchmark.py)
+        self._llm_externo = llm
+        self.modo_prompt = modo_prompt or os.getenv("SQL_PROMPT_MODO", "prefijo")
+        if self.modo_prompt not in MODOS_PROMPT:
+            raise ValueError(f"Modo de prompt desconocido: {self.modo_prompt}")
+        self.max_tokens_prefijo = max_tokens_prefijo or int(os.getenv("SQL_PREFIJO_MAX_TOKENS", "4000"))
+        self.prefijo = None
+        self.huella_esquema = None
+        # Por defecto se usa la caché compartida por todo el proceso
+        self.cache = (cache or obtener_cache_sql()) if usar_cache else None
+        # Solo las tablas relevantes para cada pregunta entran en el prompt
+        self.top_k_tablas = top_k_tablas
+        self.retriever = None
+        self._prompts_recortados = {}
+        self.ultimo_ahorro = None
+        self.stats_prompt = {"consultas": 0, "tokens_completos": 0, "tokens_enviados": 0, "tokens_nuevos": 0}
 
-    def inicializar(self, schema):
+    def inicializar(self, schema, huella_esquema=None):
         """Inicializa el agente con el esquema de la base de datos"""
         try:
-            # Configurar el modelo
-            self.llm = Ollama(
-                model="llama3",
-                callback_manager=CallbackManager([StreamingStdOutCallbackHandler()]),
-                temperature=0.1
-            )
+            # Sin huella de la base de datos se usa un hash del propio esquema
+            self.huella_esquema = huella_esquema or huella_de_esquema(schema)
+
+            # Configurar el modelo; los tokens se entregan a la interfaz con generar_consulta_stream
+            self.llm = self._llm_externo or self._crear_llm()
             
-            # Crear el prompt
-            self.prompt = self._crear_prompt_sql(schema)
+            # Crear el prefijo con el esquema completo
+            self.prefijo = self._crear_prefijo_sql(schema)
+            self.retriever = SchemaRetriever(schema, top_k=self.top_k_tablas)
+            self._prompts_recortados = {}
+            if self.modo_prompt == "prefijo" and estimar_tokens(self.prefijo) > self.max_tokens_prefijo:
+                print(f"Esquema de {estimar_tokens(self.prefijo)} tokens estimados: "
+                      f"se usan prompts recortados a las tablas relevantes")
+                self.modo_prompt = "recortado"
             print("Agente SQL inicializado correctamente")
         except Exception as e:
             print(f"Error al inicializar el agente: {e}")
             raise
 
-    def _crear_prompt_sql(self, schema):
-        """Crea el prompt especializado para consultas SQL"""
+    def _crear_llm(self):
+        # langchain solo se importa cuando hace falta el modelo real
+        from langchain_community.llms import Ollama
+
+        return Ollama(model=self.MODELO, temperature=0.1, **parametros_ollama())
+
+    def _crear_prefijo_sql(self, schema):
+        """Crea el prefijo del prompt con el esquema; siempre el mismo texto para el mismo esquema"""
         schema_info = []
-        for table, details in schema.items():
+        # Orden fijo de tablas: el texto no depende del orden en que llegue el esquema
+        for table in sorted(schema):
+            details = schema[table]
             columns = [f"{col[0]} ({col[1]})" for col in details['columns']]
             foreign_keys = [f"{fk[0]} -> {fk[1]}.{fk[2]}" for fk in details['foreign_keys']]
-            
-            schema_info.append(f"""
-Tabla: {table}
-Columnas: {', '.join(columns)}
-Relaciones: {', '.join(foreign_keys) if foreign_keys else 'Ninguna'}
-            """)
-        
-        template = """Eres un experto en SQL que convierte consultas en lenguaje natural a consultas SQL.
-Utiliza el siguiente esquema de base de datos:
+            schema_info.append(f"Tabla: {table}\n"
+                               f"Columnas: {', '.join(columns)}\n"
+                               f"Relaciones: {', '.join(foreign_keys) if foreign_keys else 'Ninguna'}\n")
+        return PREFIJO_SQL.format(esquema='\n'.join(schema_info))
 
-{0}
+    def calentar_prefijo(self):
+        """Procesa el prefijo en Ollama para que la primera pregunta ya lo encuentre en caché"""
+        if self._llm_externo is not None or self.modo_prompt != "prefijo":
+            return None
+        tokens, segundos = evaluar_prompt(self.MODELO, self.prefijo)
+        print(f"Prefijo SQL procesado: {tokens} tokens en {segundos:.2f} s")
+        return tokens, segundos
 
-Convertir la siguiente consulta en lenguaje natural a una consulta SQL válida.
-Solo devuelve la consulta SQL, sin explicaciones adicionales.
+    def generar_consulta(self, pregunta):
+        """Genera una consulta SQL a partir de una pregunta en lenguaje natural"""
+        with tracer.span("generar_consulta", modo="completo") as span:
+            try:
+                query = self._consulta_cacheada(pregunta, span)
+                if query is not None:
+                    return query
 
-Consulta: {{input}}
+                prompt = self._prompt_para(pregunta)
+                respuesta = self.llm.invoke(prompt)
+                span.registrar(tokens_prompt=estimar_tokens(prompt),
+                               tokens_completion=estimar_tokens(respuesta))
+                query = extraer_sql(respuesta)
+                self._guardar_consulta(pregunta, query)
+                return query
+            except Exception as e:
+                print(f"Error al generar la consulta: {e}")
+                raise
 
-SQL:"""
+    async def agenerar_consulta(self, pregunta):
+        """Versión asíncrona de generar_consulta que usa el cliente asíncrono del LLM"""
+        with tracer.span("generar_consulta", modo="completo") as span:
+            try:
+                query = self._consulta_cacheada(pregunta, span)
+                if query is not None:
+                    return query
 
-        template = template.format('\n'.join(schema_info))
-        return PromptTemplate(
-            input_variables=["input"],
-            template=template
-        )
+                prompt = self._prompt_para(pregunta)
+                respuesta = await self.llm.ainvoke(prompt)
+                span.registrar(tokens_prompt=estimar_tokens(prompt),
+                               tokens_completion=estimar_tokens(respuesta))
+                query = extraer_sql(respuesta)
+                self._guardar_consulta(pregunta, query)
+                return query
+            except Exception as e:
+                print(f"Error al generar la consulta: {e}")
+                raise
 
-    def generar_consulta(self, pregunta):
-        """Genera una consulta SQL a partir de una pregunta en lenguaje natural"""
+    def corregir_consulta(self, pregunta, query, motivo):
+        """Pide otra consulta cuando la guardia de coste rechazó la anterior"""
+        with tracer.span("generar_consulta", modo="correccion") as span:
+            prompt = self._prompt_correccion(pregunta, query, motivo)
+            respuesta = self.llm.invoke(prompt)
+            span.registrar(tokens_prompt=estimar_tokens(prompt),
+                           tokens_completion=estimar_tokens(respuesta))
+            query = extraer_sql(respuesta)
+            self._guardar_consulta(pregunta, query)
+            return query
+
+    async def acorregir_consulta(self, pregunta, query, motivo):
+        """Versión asíncrona de corregir_consulta"""
+        with tracer.span("generar_consulta", modo="correccion") as span:
+            prompt = self._prompt_correccion(pregunta, query, motivo)
+            respuesta = await self.llm.ainvoke(prompt)
+            span.registrar(tokens_prompt=estimar_tokens(prompt),
+                           tokens_completion=estimar_tokens(respuesta))
+            query = extraer_sql(respuesta)
+            self._guardar_consulta(pregunta, query)
+            return query
+
+    def _prompt_correccion(self, pregunta, query, motivo):
+        # El prompt termina en "SQL:", así que la consulta rechazada queda como respuesta previa
+        return (f"{self._prompt_para(pregunta)} {query}\n\n"
+                f"Esta consulta se rechazó antes de ejecutarla: {motivo}.\n"
+                "Escribe una consulta corregida que evite el problema, por ejemplo añadiendo "
+                "las condiciones de join que falten o agregando los datos.\n"
+                "Solo devuelve la consulta SQL, sin explicaciones adicionales.\n\nSQL:")
+
+    def generar_consulta_stream(self, pregunta):
+        """
+        Genera la consulta SQL token a token y corta la generación en cuanto la
+        sentencia termina con ';'. Concatenar los fragmentos y pasarlos por
+        extraer_sql da la consulta final.
+        """
+        # El span se crea al llamar, en el contexto de quien llama, y termina con el generador
+        span = tracer.iniciar("generar_consulta", modo="stream")
+        return self._generar_consulta_stream(pregunta, span)
+
+    def _generar_consulta_stream(self, pregunta, span):
+        fragmentos, error = 0, None
         try:
-            if not self.llm or not self.prompt:
-                raise Exception("El agente no ha sido inicializado")
-            
-            return self.llm.invoke(self.prompt.format(input=pregunta))
+            query = self._consulta_cacheada(pregunta, span)
+            if query is not None:
+                yield query
+                return
+
+            prompt = self._prompt_para(pregunta)
+            span.registrar(tokens_prompt=estimar_tokens(prompt))
+            acumulado = ""
+            for token in self.llm.stream(prompt):
+                token, completo = _recortar_token(acumulado, token)
+                acumulado += token
+                fragmentos += 1
+                yield token
+                if completo:
+                    # Cerrar el stream evita pagar por los tokens que vendrían después
+                    break
+            self._guardar_consulta(pregunta, extraer_sql(acumulado))
         except Exception as e:
             print(f"Error al generar la consulta: {e}")
+            error = e
             raise
+        finally:
+            # Ollama entrega un token por fragmento
+            span.registrar(tokens_completion=fragmentos)
+            span.terminar(error=error)
+
+    def agenerar_consulta_stream(self, pregunta):
+        """Versión asíncrona de generar_consulta_stream"""
+        span = tracer.iniciar("generar_consulta", modo="stream")
+        return self._agenerar_consulta_stream(pregunta, span)
+
+    async def _agenerar_consulta_stream(self, pregunta, span):
+        fragmentos, error = 0, None
+        try:
+            query = self._consulta_cacheada(pregunta, span)
+            if query is not None:
+                yield query
+                return
+
+            prompt = self._prompt_para(pregunta)
+            span.registrar(tokens_prompt=estimar_tokens(prompt))
+            acumulado = ""
+            async for token in self.llm.astream(prompt):
+                token, completo = _recortar_token(acumulado, token)
+                acumulado += token
+                fragmentos += 1
+                yield token
+                if completo:
+                    break
+            self._guardar_consulta(pregunta, extraer_sql(acumulado))
+        except Exception as e:
+            print(f"Error al generar la consulta: {e}")
+            error = e
+            raise
+        finally:
+            span.registrar(tokens_completion=fragmentos)
+            span.terminar(error=error)
+
+    def _consulta_cacheada(self, pregunta, span):
+        if not self.llm or not self.prefijo:
+            raise Exception("El agente no ha sido inicializado")
+
+        if self.cache is not None:
+            query = self.cache.obtener(pregunta, self.huella_esquema)
+            span.registrar(cache="hit" if query is not None else "miss")
+            if query is not None:
+                print("Consulta SQL obtenida de la caché")
+                return query
+        return None
+
+    def _guardar_consulta(self, pregunta, query):
+        if self.cache is not None:
+            self.cache.guardar(pregunta, self.huella_esquema, query)
+
+    def _prompt_para(self, pregunta):
+        """Construye el prompt de la pregunta y registra cuántos tokens tiene que procesar el modelo
+
+        En modo prefijo solo el final (tablas sugeridas y pregunta) es nuevo
+        para Ollama; en modo recortado el prompt entero cambia con las tablas.
+        """
+        tablas = tuple(self.retriever.seleccionar(pregunta)) if self.retriever else ()
+        if tablas and len(tablas) == len(self.retriever.schema):
+            tablas = ()
+        if self.modo_prompt == "prefijo":
+            final = _final_prompt(pregunta, tablas)
+            texto = self.prefijo + final
+            tokens_nuevos = estimar_tokens(final)
+        else:
+            final = _final_prompt(pregunta)
+            prefijo = self.prefijo
+            if tablas:
+                prefijo = self._prompts_recortados.get(tablas)
+                if prefijo is None:
+                    prefijo = self._crear_prefijo_sql(self.retriever.subesquema(tablas))
+                    self._prompts_recortados[tablas] = prefijo
+            texto = prefijo + final
+            tokens_nuevos = estimar_tokens(texto)
+
+        tokens_completos = estimar_tokens(self.prefijo + final)
+        tokens_enviados = estimar_tokens(texto)
+        self.ultimo_ahorro = {
+            "modo": self.modo_prompt,
+            "tablas": list(tablas),
+            "tokens_completos": tokens_completos,
+            "tokens_enviados": tokens_enviados,
+            "tokens_nuevos": tokens_nuevos,
+            "ahorro": 1 - tokens_nuevos / tokens_completos,
+        }
+        self.stats_prompt["consultas"] += 1
+        self.stats_prompt["tokens_completos"] += tokens_completos
+        self.stats_prompt["tokens_enviados"] += tokens_enviados
+        self.stats_prompt["tokens_nuevos"] += tokens_nuevos
+        print(f"Prompt SQL ({self.modo_prompt}, {len(tablas)} tablas sugeridas): {tokens_enviados} de "
+              f"{tokens_completos} tokens estimados, {tokens_nuevos} fuera del prefijo en caché")
+        return texto
+
+    def fijar_consulta(self, pregunta):
+        """Marca como validado el SQL cacheado de una pregunta"""
+        if self.cache is None:
+            return False
+        return self.cache.fijar(pregunta, self.huella_esquema)
+
+    def descartar_consulta(self, pregunta):
+        """Elimina de la caché el SQL de una pregunta, por ejemplo si falló al ejecutarse"""
+        if self.cache is not None:
+            self.cache.descartar(pregunta, self.huella_esquema)
+
+
+def huella_de_esquema(schema):
+    return hashlib.sha1(json.dumps(schema, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _final_prompt(pregunta, tablas=()):
+    """Parte del prompt que cambia con cada pregunta; va después del prefijo"""
+    sugeridas = f"Tablas más relevantes: {', '.join(tablas)}\n" if tablas else ""
+    return f"\n{sugeridas}Consulta: {pregunta}\n\nSQL:"
+
+
+_agente_compartido = None
+_agente_lock = threading.Lock()
+
+
+def obtener_agente_sql(schema, huella_esquema):
+    """Devuelve el SQLAgent compartido por todo el proceso
+
+    Solo se reconstruye si cambia la huella del esquema, así el prefijo del
+    prompt (y su caché en Ollama) se mantiene entre preguntas.
+    """
+    global _agente_compartido
+    huella_esquema = huella_esquema or huella_de_esquema(schema)
+    with _agente_lock:
+        if _agente_compartido is None or _agente_compartido.huella_esquema != huella_esquema:
+            agente = SQLAgent()
+            agente.inicializar(schema, huella_esquema)
+            _agente_compartido = agente
+        return _agente_compartido
+
+
+# Solo al principio de una línea (o del bloque ```): "To select..." o "with a join" en la prosa no cuentan
+_INICIO_SQL = re.compile(r"^[ \t]*(select|with|insert|update|delete)\b", re.IGNORECASE | re.MULTILINE)
+
+
+def fin_de_sentencia(texto):
+    """Posición justo después del primer ';' que cierra una sentencia SQL, o -1
+
+    Ignora los ';' dentro de literales, identificadores entre comillas y
+    comentarios, y los que aparecen antes de que empiece la sentencia.
+    """
+    inicio = _INICIO_SQL.search(texto)
+    if not inicio:
+        return -1
+    i, n = inicio.start(1), len(texto)
+    while i < n:
+        c = texto[i]
+        if c in ("'", '"'):
+            cierre = texto.find(c, i + 1)
+            if cierre == -1:
+                return -1
+            i = cierre + 1
+            continue
+        if texto.startswith("--", i):
+            salto = texto.find("\n", i)
+            if salto == -1:
+                return -1
+            i = salto + 1
+            continue
+        if texto.startswith("/*", i):
+            cierre = texto.find("*/", i + 2)
+            if cierre == -1:
+                return -1
+            i = cierre + 2
+            continue
+        if c == ";":
+            return i + 1
+        i += 1
+    return -1
+
+
+def _recortar_token(acumulado, token):
+    """Recorta el token si completa la sentencia; devuelve (token, sentencia completa)"""
+    fin = fin_de_sentencia(acumulado + token)
+    if fin == -1:
+        return token, False
+    return token[:fin - len(acumulado)], True
+
+
+def extraer_sql(texto):
+    """Limpia la respuesta del modelo: quita bloques ``` y texto previo, y corta tras el primer ';'"""
+    bloque = re.search(r"```(?:sql)?\s*\n?(.*?)(?:```|$)", texto, re.DOTALL | re.IGNORECASE)
+    if bloque:
+        texto = bloque.group(1)
+    inicio = _INICIO_SQL.search(texto)
+    if inicio:
+        texto = texto[inicio.start(1):]
+    fin = fin_de_sentencia(texto)
+    return (texto[:fin] if fin != -1 else texto).strip()
+
+
+PREGUNTAS_PRUEBA = [
+    "¿Cuáles son los 10 productos más vendidos?",
+    "Ventas totales por categoría",
+    "¿Qué clientes han gastado más este año?",
+    "Número de ventas por mes",
+    "Productos con menos de 10 unidades en stock",
+    "Ticket medio por cliente",
+    "¿Qué categoría tiene más productos?",
+    "Ingresos por día de la última semana",
+]
+
+
+def medir_prefill(schema, huella_esquema, preguntas, modos=MODOS_PROMPT):
+    """Tokens y segundos de prefill en Ollama de las mismas preguntas con cada modo de prompt
+
+    Las preguntas se evalúan seguidas, como llegarían a un servidor con el
+    modelo cargado; con el modo prefijo solo la primera procesa el esquema.
+    """
+    resultados = {}
+    for modo in modos:
+        agente = SQLAgent(usar_cache=False, modo_prompt=modo)
+        agente.inicializar(schema, huella_esquema)
+        medidas = [evaluar_prompt(agente.MODELO, agente._prompt_para(pregunta)) for pregunta in preguntas]
+        segundos = [s for _, s in medidas]
+        resultados[modo] = {
+            "modo_usado": agente.modo_prompt,
+            "tokens": sum(t for t, _ in medidas),
+            "segundos": sum(segundos),
+            "primera": segundos[0],
+            "media_resto": sum(segundos[1:]) / (len(segundos) - 1) if len(segundos) > 1 else None,
+        }
+    return resultados
+
+
+def main():
+    from database_manager import obtener_db_compartida
+
+    parser = argparse.ArgumentParser(description="Mide el tiempo de prefill del prompt SQL en Ollama")
+    parser.add_argument("--preguntas", help="archivo con una pregunta por línea (por defecto, unas de prueba)")
+    parser.add_argument("--repeticiones", type=int, default=1, help="veces que se repite la lista")
+    args = parser.parse_args()
+
+    preguntas = PREGUNTAS_PRUEBA
+    if args.preguntas:
+        with open(args.preguntas, encoding="utf-8") as f:
+            preguntas = [linea.strip() for linea in f if linea.strip()]
+    preguntas = preguntas * args.repeticiones
+
+    db = obtener_db_compartida()
+    try:
+        schema = db.obtener_esquema_bd()
+        resultados = medir_prefill(schema, db.huella_esquema, preguntas)
+    finally:
+        db.close()
+
+    print(f"\nPrefill de {len(preguntas)} preguntas con {SQLAgent.MODELO}:")
+    for modo, r in resultados.items():
+        resto = f"{r['media_resto'] * 1000:.0f} ms" if r["media_resto"] is not None else "-"
+        print(f"  {modo:<10} {r['tokens']:>7} tokens procesados, {r['segundos']:.2f} s en total, "
+              f"primera {r['primera'] * 1000:.0f} ms, media del resto {resto}")
+    if "prefijo" in resultados and "recortado" in resultados and resultados["recortado"]["segundos"]:
+        ahorro = 1 - resultados["prefijo"]["segundos"] / resultados["recortado"]["segundos"]
+        print(f"Ahorro de prefill con el prefijo estable: {ahorro:.0%}")
+
+
+if __name__ == "__main__":
+    main()
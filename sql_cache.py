@@ -0,0 +1,203 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from schema_cache import directorio_cache
+
+
+def normalizar_pregunta(pregunta):
+    """Normaliza mayúsculas, acentos, espacios, signos y formato de números"""
+    texto = unicodedata.normalize("NFKD", pregunta.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    # Separadores de miles y ceros decimales sobrantes: "1.000,00" / "1,000.00" -> "1000"
+    texto = re.sub(r"(?<=\d)[.,](?=\d{3}\b)", "", texto)
+    texto = re.sub(r"(\d)[.,]0+\b", r"\1", texto)
+    texto = re.sub(r"(\d)[.,](\d+)", r"\1.\2", texto)
+    texto = re.sub(r"(\d\.\d*?[1-9])0+\b", r"\1", texto)
+    texto = re.sub(r"[¿?¡!;:]+|[.,](?!\d)|(?<!\d)[.,]", " ", texto)
+    return " ".join(texto.split())
+
+
+class SQLCache:
+    """Caché LRU en memoria respaldada por SQLite para las consultas generadas por el LLM"""
+
+    def __init__(self, ruta=None, max_memoria=512, ttl=7 * 24 * 3600, volcado_usos=30.0):
+        self.ruta = ruta or os.path.join(directorio_cache(), "sql_cache.sqlite3")
+        self.max_memoria = max_memoria
+        self.ttl = ttl
+        # Segundos entre escrituras de los contadores de uso: un acierto no escribe en disco
+        self.volcado_usos = volcado_usos
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()  # clave -> (sql, creado, fijada)
+        self._usos = {}  # clave -> (último uso, aciertos pendientes de escribir)
+        self._volcado = time.monotonic()
+        self.stats = {"hits_memoria": 0, "hits_disco": 0, "misses": 0, "expiradas": 0}
+
+        directorio = os.path.dirname(self.ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        self._db = sqlite3.connect(self.ruta, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS consultas (
+                clave TEXT PRIMARY KEY,
+                pregunta TEXT,
+                huella_esquema TEXT,
+                sql TEXT,
+                creado REAL,
+                usado REAL,
+                aciertos INTEGER DEFAULT 0,
+                fijada INTEGER DEFAULT 0
+            )
+        """)
+        self._db.commit()
+
+    @staticmethod
+    def clave(pregunta, huella_esquema):
+        datos = f"{huella_esquema}\x00{normalizar_pregunta(pregunta)}"
+        return hashlib.sha256(datos.encode("utf-8")).hexdigest()
+
+    def _expirada(self, creado, fijada):
+        return not fijada and self.ttl is not None and time.time() - creado > self.ttl
+
+    def _anotar_uso(self, clave):
+        """Cuenta el acierto en memoria; los contadores se escriben juntos cada volcado_usos segundos"""
+        _, aciertos = self._usos.get(clave, (None, 0))
+        self._usos[clave] = (time.time(), aciertos + 1)
+        if time.monotonic() - self._volcado >= self.volcado_usos:
+            self._volcar_usos()
+
+    def _volcar_usos(self):
+        self._volcado = time.monotonic()
+        if not self._usos:
+            return
+        self._db.executemany(
+            "UPDATE consultas SET usado = ?, aciertos = aciertos + ? WHERE clave = ?",
+            [(usado, aciertos, clave) for clave, (usado, aciertos) in self._usos.items()])
+        self._db.commit()
+        self._usos.clear()
+
+    def _recordar(self, clave, sql, creado, fijada):
+        self._memoria[clave] = (sql, creado, fijada)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_memoria:
+            self._memoria.popitem(last=False)
+
+    def obtener(self, pregunta, huella_esquema):
+        """Devuelve el SQL cacheado para la pregunta, o None"""
+        clave = self.clave(pregunta, huella_esquema)
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada and not self._expirada(entrada[1], entrada[2]):
+                self._memoria.move_to_end(clave)
+                self.stats["hits_memoria"] += 1
+                self._anotar_uso(clave)
+                return entrada[0]
+
+            fila = self._db.execute(
+                "SELECT sql, creado, fijada FROM consultas WHERE clave = ?", (clave,)
+            ).fetchone()
+            if fila is None:
+                self.stats["misses"] += 1
+                return None
+            sql, creado, fijada = fila
+            if self._expirada(creado, fijada):
+                self._memoria.pop(clave, None)
+                self._usos.pop(clave, None)
+                self._db.execute("DELETE FROM consultas WHERE clave = ?", (clave,))
+                self._db.commit()
+                self.stats["expiradas"] += 1
+                self.stats["misses"] += 1
+                return None
+
+            self._recordar(clave, sql, creado, bool(fijada))
+            self._anotar_uso(clave)
+            self.stats["hits_disco"] += 1
+            return sql
+
+    def guardar(self, pregunta, huella_esquema, sql):
+        """Guarda el SQL generado para la pregunta"""
+        clave = self.clave(pregunta, huella_esquema)
+        ahora = time.time()
+        with self._lock:
+            fila = self._db.execute(
+                "SELECT fijada FROM consultas WHERE clave = ?", (clave,)).fetchone()
+            if fila and fila[0]:
+                # Una entrada fijada solo se sustituye explícitamente con descartar()
+                return
+            self._recordar(clave, sql, ahora, False)
+            self._usos.pop(clave, None)
+            self._db.execute("""
+                INSERT OR REPLACE INTO consultas
+                    (clave, pregunta, huella_esquema, sql, creado, usado, aciertos, fijada)
+                VALUES (?, ?, ?, ?, ?, ?, 0, 0)
+            """, (clave, pregunta, huella_esquema, sql, ahora, ahora))
+            self._db.commit()
+
+    def fijar(self, pregunta, huella_esquema, fijada=True):
+        """Marca una entrada como validada: no expira por TTL ni se sobrescribe"""
+        clave = self.clave(pregunta, huella_esquema)
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE consultas SET fijada = ? WHERE clave = ?", (int(fijada), clave))
+            self._db.commit()
+            if clave in self._memoria:
+                sql, creado, _ = self._memoria[clave]
+                self._memoria[clave] = (sql, creado, fijada)
+            return cursor.rowcount > 0
+
+    def descartar(self, pregunta, huella_esquema):
+        """Elimina la entrada de una pregunta, por ejemplo si su SQL falló"""
+        clave = self.clave(pregunta, huella_esquema)
+        with self._lock:
+            self._memoria.pop(clave, None)
+            self._usos.pop(clave, None)
+            self._db.execute("DELETE FROM consultas WHERE clave = ?", (clave,))
+            self._db.commit()
+
+    def purgar(self):
+        """Borra del disco las entradas expiradas no fijadas"""
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM consultas WHERE fijada = 0 AND creado < ?",
+                (time.time() - self.ttl,))
+            self._db.commit()
+            return cursor.rowcount
+
+    def estadisticas(self):
+        """Devuelve aciertos, fallos y tamaño de la caché"""
+        with self._lock:
+            total, fijadas = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(fijada), 0) FROM consultas").fetchone()
+            hits = self.stats["hits_memoria"] + self.stats["hits_disco"]
+            consultas = hits + self.stats["misses"]
+            return dict(self.stats, entradas_memoria=len(self._memoria),
+                        entradas_disco=total, fijadas=fijadas,
+                        tasa_aciertos=hits / consultas if consultas else 0.0)
+
+    def close(self):
+        with self._lock:
+            self._volcar_usos()
+            self._db.close()
+
+
+_cache_compartida = None
+_cache_lock = threading.Lock()
+
+
+def obtener_cache_sql():
+    """Devuelve la caché de SQL compartida por todo el proceso"""
+    global _cache_compartida
+    with _cache_lock:
+        if _cache_compartida is None:
+            _cache_compartida = SQLCache(
+                max_memoria=int(os.getenv("SQL_CACHE_MAX_MEMORIA", "512")),
+                ttl=float(os.getenv("SQL_CACHE_TTL", str(7 * 24 * 3600))),
+            )
+        return _cache_compartida
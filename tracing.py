@@ -0,0 +1,242 @@
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from schema_cache import directorio_cache
+
+# Atributos numéricos de los spans que además se acumulan como contadores
+ATRIBUTOS_CONTADOR = ("tokens_prompt", "tokens_completion", "filas", "bytes")
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_span_actual = contextvars.ContextVar("span_actual", default=None)
+
+
+class Span:
+    """Intervalo medido de una etapa: tiempo de pared, CPU del hilo y atributos"""
+
+    def __init__(self, tracer, nombre, padre=None, **atributos):
+        self.tracer = tracer
+        self.nombre = nombre
+        self.trace_id = padre.trace_id if padre else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:8]
+        self.padre_id = padre.span_id if padre else None
+        self.atributos = dict(atributos)
+        self.error = None
+        self.terminado = False
+        self._inicio = time.perf_counter()
+        # thread_time solo cuenta la CPU del hilo actual; en etapas que saltan
+        # entre hilos es una cota inferior
+        self._inicio_cpu = time.thread_time()
+        self.inicio_unix = time.time()
+
+    def registrar(self, **atributos):
+        """Añade o actualiza atributos del span"""
+        self.atributos.update(atributos)
+
+    def terminar(self, error=None):
+        """Cierra el span y lo envía al log y a las métricas; es idempotente"""
+        if self.terminado:
+            return
+        self.terminado = True
+        self.error = str(error) if error else None
+        self.duracion = time.perf_counter() - self._inicio
+        self.cpu = time.thread_time() - self._inicio_cpu
+        self.tracer._finalizar(self)
+
+    def como_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "padre_id": self.padre_id,
+            "etapa": self.nombre,
+            "inicio": self.inicio_unix,
+            "duracion_s": round(self.duracion, 6),
+            "cpu_s": round(self.cpu, 6),
+            "error": self.error,
+            **self.atributos,
+        }
+
+
+def percentiles(valores):
+    """p50/p95/p99 por rango más cercano, más media y número de muestras"""
+    if not valores:
+        return {"n": 0, "p50": None, "p95": None, "p99": None, "media": None}
+    ordenados = sorted(valores)
+
+    def percentil(p):
+        return round(ordenados[max(0, math.ceil(p / 100 * len(ordenados)) - 1)], 6)
+
+    return {"n": len(ordenados), "p50": percentil(50), "p95": percentil(95),
+            "p99": percentil(99), "media": round(sum(ordenados) / len(ordenados), 6)}
+
+
+class Metricas:
+    """Histogramas y contadores por etapa en formato de texto de Prometheus"""
+
+    def __init__(self, buckets=BUCKETS_LATENCIA):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histogramas = {}  # etapa -> [cuentas por bucket, suma, total]
+        self._contadores = {}  # (métrica, etapa) -> valor
+
+    def observar(self, span):
+        with self._lock:
+            histograma = self._histogramas.setdefault(
+                span.nombre, [[0] * len(self.buckets), 0.0, 0])
+            for i, limite in enumerate(self.buckets):
+                if span.duracion <= limite:
+                    histograma[0][i] += 1
+            histograma[1] += span.duracion
+            histograma[2] += 1
+            self._sumar("ragdb_etapa_cpu_segundos_total", span.nombre, span.cpu)
+            if span.error:
+                self._sumar("ragdb_etapa_errores_total", span.nombre, 1)
+            for atributo in ATRIBUTOS_CONTADOR:
+                valor = span.atributos.get(atributo)
+                if isinstance(valor, (int, float)):
+                    self._sumar(f"ragdb_{atributo}_total", span.nombre, valor)
+
+    def _sumar(self, metrica, etapa, valor):
+        clave = (metrica, etapa)
+        self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def incrementar(self, metrica, etapa, valor=1):
+        """Suma a un contador arbitrario (por ejemplo aciertos de caché)"""
+        with self._lock:
+            self._sumar(metrica, etapa, valor)
+
+    def exportar_prometheus(self):
+        """Devuelve todas las métricas en el formato de exposición de texto de Prometheus"""
+        lineas = [
+            "# HELP ragdb_etapa_duracion_segundos Latencia de cada etapa del pipeline",
+            "# TYPE ragdb_etapa_duracion_segundos histogram",
+        ]
+        with self._lock:
+            for etapa, (cuentas, suma, total) in sorted(self._histogramas.items()):
+                for limite, cuenta in zip(self.buckets, cuentas):
+                    lineas.append(
+                        f'ragdb_etapa_duracion_segundos_bucket{{etapa="{etapa}",le="{limite}"}} {cuenta}')
+                lineas.append(f'ragdb_etapa_duracion_segundos_bucket{{etapa="{etapa}",le="+Inf"}} {total}')
+                lineas.append(f'ragdb_etapa_duracion_segundos_sum{{etapa="{etapa}"}} {suma}')
+                lineas.append(f'ragdb_etapa_duracion_segundos_count{{etapa="{etapa}"}} {total}')
+            metricas = sorted({metrica for metrica, _ in self._contadores})
+            for metrica in metricas:
+                lineas.append(f"# TYPE {metrica} counter")
+                for (nombre, etapa), valor in sorted(self._contadores.items()):
+                    if nombre == metrica:
+                        lineas.append(f'{metrica}{{etapa="{etapa}"}} {valor}')
+        return "\n".join(lineas) + "\n"
+
+
+class Tracer:
+    """Crea spans anidados por contexto y los publica como JSON y como métricas"""
+
+    def __init__(self, metricas=None, logger=None):
+        self.metricas = metricas or Metricas()
+        self.logger = logger or _logger_por_defecto()
+        # Funciones que reciben cada span terminado (por ejemplo el benchmark)
+        self.suscriptores = []
+
+    def iniciar(self, nombre, **atributos):
+        """Crea un span hijo del span actual sin activarlo (útil en generadores)"""
+        return Span(self, nombre, _span_actual.get(), **atributos)
+
+    @contextmanager
+    def activar(self, span):
+        """Hace de `span` el padre de los spans creados dentro del bloque
+
+        El bloque no debe contener un yield: el contexto podría reanudarse en otra tarea.
+        """
+        token = _span_actual.set(span)
+        try:
+            yield span
+        finally:
+            _span_actual.reset(token)
+
+    @contextmanager
+    def span(self, nombre, **atributos):
+        """Mide el bloque como un span y lo convierte en el span actual"""
+        span = self.iniciar(nombre, **atributos)
+        try:
+            with self.activar(span):
+                yield span
+        except BaseException as e:
+            span.terminar(error=e)
+            raise
+        finally:
+            span.terminar()
+
+    def suscribir(self, funcion):
+        """Llama a funcion(span) cada vez que termina un span; devuelve cómo anular la suscripción"""
+        self.suscriptores.append(funcion)
+        return lambda: self.suscriptores.remove(funcion)
+
+    def _finalizar(self, span):
+        self.metricas.observar(span)
+        for funcion in list(self.suscriptores):
+            funcion(span)
+        self.logger.info(json.dumps(span.como_dict(), ensure_ascii=False, default=str))
+
+
+def _logger_por_defecto():
+    logger = logging.getLogger("rag_db.trazas")
+    if not logger.handlers:
+        ruta = os.getenv("TRACE_LOG", os.path.join(directorio_cache(), "trazas.jsonl"))
+        try:
+            os.makedirs(os.path.dirname(ruta) or ".", exist_ok=True)
+            manejador = logging.FileHandler(ruta, encoding="utf-8")
+        except OSError:
+            manejador = logging.StreamHandler()
+        manejador.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(manejador)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+tracer = Tracer()
+
+_servidor_metricas = None
+_servidor_lock = threading.Lock()
+
+
+def iniciar_servidor_metricas(puerto=None):
+    """Sirve /metrics en formato Prometheus desde un hilo en segundo plano (una vez por proceso)"""
+    global _servidor_metricas
+    puerto = int(os.getenv("METRICS_PORT", "9464") if puerto is None else puerto)
+    if not puerto:
+        return None
+    with _servidor_lock:
+        if _servidor_metricas is not None:
+            return _servidor_metricas
+
+        class _Manejador(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                cuerpo = tracer.metricas.exportar_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            _servidor_metricas = ThreadingHTTPServer(("0.0.0.0", puerto), _Manejador)
+        except OSError as e:
+            print(f"No se pudo iniciar el servidor de métricas en el puerto {puerto}: {e}")
+            return None
+        threading.Thread(target=_servidor_metricas.serve_forever, daemon=True).start()
+        print(f"Métricas disponibles en http://localhost:{puerto}/metrics")
+        return _servidor_metricas